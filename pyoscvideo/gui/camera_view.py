@@ -21,7 +21,7 @@ import logging
 from typing import List, Optional
 
 import numpy as np
-from PyQt5.QtCore import Qt, QSize
+from PyQt5.QtCore import Qt, QSize, QThread, pyqtSignal
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtWidgets import (QLabel, QSizePolicy, QComboBox,
                              QHBoxLayout, QVBoxLayout, QWidget)
@@ -61,6 +61,8 @@ class CameraView(QWidget):
     #     self._ui.cameraSelectionComboBox = combo_box
     #     self._ui.imageLabel = label
         self._camera = camera
+        self._camera_in_use = False
+        self._open_threads: List[OpenCameraThread] = []
     #
         self._init_image_label()
     #
@@ -106,16 +108,39 @@ class CameraView(QWidget):
 
     def _start_capturing(self):
         """
-        Notifies the video manager that we want to use this camera, so
-        it should start capturing.
+        Opens the camera in a separate thread, so the GUI stays responsive
+        and several cameras can be opened at the same time. Once opened
+        the camera is used in _on_camera_opened().
         """
         if self._camera:
-            if not self._video_manager.use_camera(self._camera):
-                self._logger.warning(f"Failed to use '{self._camera.name}'")
-                self._camera = None
-                return
-            self._camera.add_change_pixmap_cb(self._on_new_frame)
-            self._camera.add_update_fps_label_cb(self._update_fps_label)
+            self._ui.frameRateLabel.setText("Opening...")
+            thread = OpenCameraThread(self._camera)
+            thread.opened.connect(self._on_camera_opened)
+            self._open_threads.append(thread)
+            thread.start()
+
+    def _on_camera_opened(self, thread: 'OpenCameraThread'):
+        """
+        Notifies the video manager that we want to use the opened camera, so
+        it should start capturing.
+        """
+        thread.wait()
+        self._open_threads.remove(thread)
+        camera = thread.camera
+        if camera is not self._camera:
+            # another camera was selected while opening this one
+            if camera not in self._video_manager.cameras:
+                camera.close_source()
+            return
+
+        if not thread.success or not self._video_manager.use_camera(camera):
+            self._logger.warning(f"Failed to use '{camera.name}'")
+            self._ui.frameRateLabel.setText("Failed")
+            self._camera = None
+            return
+        self._camera_in_use = True
+        camera.add_change_pixmap_cb(self._on_new_frame)
+        camera.add_update_fps_label_cb(self._update_fps_label)
 
     def _update_fps_label(self, fps: float):
         """
@@ -176,7 +201,24 @@ class CameraView(QWidget):
         Releases all the callbacks and report to the manager we no longer use
         the camera.
         """
-        if self._camera:
+        if self._camera and self._camera_in_use:
             self._camera.remove_change_pixmap_cb(self._on_new_frame)
             self._camera.remove_update_fps_label_cb(self._update_fps_label)
             self._video_manager.unuse_camera(self._camera)
+        self._camera_in_use = False
+
+
+class OpenCameraThread(QThread):
+    """
+    Thread opening the source of a camera, see Camera.open_source().
+    """
+    opened = pyqtSignal(object)
+
+    def __init__(self, camera: Camera):
+        super().__init__()
+        self.camera = camera
+        self.success = False
+
+    def run(self):
+        self.success = self.camera.open_source()
+        self.opened.emit(self)
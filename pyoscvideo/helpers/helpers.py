@@ -23,10 +23,22 @@
 import json
 import logging.config
 import os
+import time
 
 import cv2
 
 
+def get_conf_dir():
+    """
+    Get the directory for the files we keep between runs (logs, caches),
+    inside the virtualenv if running in one.
+    """
+    venv_dir = os.environ.get("VIRTUAL_ENV", False)
+    if venv_dir:
+        return os.path.join(venv_dir, "pyoscvideo")
+    return os.path.join(os.environ.get("HOME"), ".pyoscvideo")
+
+
 def setup_logging(settings_path='logging/logging_settings.json',
                   default_level=logging.INFO, ):
     """Set up logging configuration."""
@@ -36,12 +48,7 @@ def setup_logging(settings_path='logging/logging_settings.json',
         with open(path, 'rt') as config_file:
             config = json.load(config_file)
 
-        venv_dir = os.environ.get("VIRTUAL_ENV", False)
-        if venv_dir:
-            conf_dir = os.path.join(venv_dir, "pyoscvideo")
-        else:
-            conf_dir = os.path.join(os.environ.get("HOME"), ".pyoscvideo")
-
+        conf_dir = get_conf_dir()
         logs_dir = os.path.join(conf_dir, "logs")
         if not os.path.exists(logs_dir):
             os.makedirs(logs_dir)
@@ -67,3 +74,17 @@ def get_cv_cap_property_id(cv_property):
         print('{} is not a valid OpenCV property!'.format(cv_property))
         return None
     return integer_value
+
+
+def monotonic_to_wall_time(timestamp):
+    """
+    Convert a time.monotonic() timestamp to seconds since the epoch.
+    """
+    return time.time() - time.monotonic() + timestamp
+
+
+def wall_to_monotonic_time(timestamp):
+    """
+    Convert seconds since the epoch to a time.monotonic() timestamp.
+    """
+    return time.monotonic() - time.time() + timestamp
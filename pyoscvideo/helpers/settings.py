@@ -36,7 +36,8 @@ def _remove_unused_configuration(
             _logger.warning(f"Unknow config option: {k}")
             del loaded[k]
         else:
-            if isinstance(v, dict):
+            # an empty default takes any keys, e.g. camera names
+            if isinstance(v, dict) and default[k]:
                 _remove_unused_configuration(v, default[k])
 
 
@@ -51,6 +52,7 @@ def load_settings(path: str):
                 'port': 57220,
                 'remote_address': '127.0.0.1',
                 'remote_port': 57210,
+                'metrics_interval': 1.0,
                 },
             'gui': {
                 'enabled': True,
@@ -59,6 +61,31 @@ def load_settings(path: str):
             'camera': {
                 'recording_fps': 25,
                 'codec': 'MJPG',
+                'capture_format': 'MJPG',
+                'capture_backend': 'opencv',
+                'capture_process': False,
+                'synchronized_capture': False,
+                'variable_frame_rate': False,
+                'pre_roll': 0.0,
+                'pre_roll_max_mb': 256,
+                'segment_duration': 0,
+                'encoder': 'opencv',
+                'ffmpeg': {
+                    'codec': 'libx264',
+                    'preset': 'ultrafast',
+                    'threads': 0,
+                    'pix_fmt': None,
+                    'options': [],
+                    'binary': 'ffmpeg',
+                    'cameras': {},
+                },
+                'write_queue_mb': 512,
+                'spill_dir': '',
+                'resize_interpolation': 'linear',
+                'resize_workers': 0,
+                'proxies': [],
+                'source_files': [],
+                'synthetic_cameras': 1,
                 'resolution': {
                     'width': 1920,
                     'height': 1080,
@@ -508,7 +508,7 @@ class v4l2_frmsize_discrete(ctypes.Structure):
 class v4l2_frmsize_stepwise(ctypes.Structure):
     _fields_ = [
         ('min_width', ctypes.c_uint32),
-        ('min_height', ctypes.c_uint32),
+        ('max_width', ctypes.c_uint32),
         ('step_width', ctypes.c_uint32),
         ('min_height', ctypes.c_uint32),
         ('max_height', ctypes.c_uint32),
@@ -667,6 +667,10 @@ V4L2_BUF_FLAG_PFRAME = 0x0010
 V4L2_BUF_FLAG_BFRAME = 0x0020
 V4L2_BUF_FLAG_TIMECODE = 0x0100
 V4L2_BUF_FLAG_INPUT = 0x0200
+V4L2_BUF_FLAG_TIMESTAMP_MASK = 0xe000
+V4L2_BUF_FLAG_TIMESTAMP_UNKNOWN = 0x0000
+V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC = 0x2000
+V4L2_BUF_FLAG_TIMESTAMP_COPY = 0x4000
 
 
 #
@@ -18,99 +18,192 @@
 # *****************************************************************************
 
 
-from typing import Any, Sequence, Type
-
-from pythonosc.osc_server import ThreadingOSCUDPServer
-from pythonosc.dispatcher import Dispatcher
-from pythonosc.udp_client import SimpleUDPClient
-
-from PyQt5.QtCore import QThread
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional, Sequence, Tuple
 
+from pyoscvideo.helpers.helpers import wall_to_monotonic_time
+from pyoscvideo.osc.server import OSCServerThread
 from pyoscvideo.video.manager import VideoManager
 
-import asyncio
+import itertools
 import logging
+import time
 
 
-class OSCInterface(QThread):
+class OSCInterface(OSCServerThread):
     """
     Spawns a thread for sending and receiving OSC messages to
     stop and start the recorder.
+
+    Messages are received and replied to by the event loop of that thread,
+    the commands they carry run in a worker of their own, one after the
+    other, see _queue_command().
     """
     def __init__(self,
                  video_manager: VideoManager,
                  address: str = "0.0.0.0",
                  port: int = 57220,
                  remote_address: str = "127.0.0.1",
-                 remote_port: int = 57120
+                 remote_port: int = 57120,
+                 metrics_interval: float = 1.0
                  ):
-        super().__init__()
+        super().__init__(address, port)
         self._logger = logging.getLogger(__name__+".OSCInterface")
         self._logger.info("Initializing OSC thread")
         self._video_manager = video_manager
-        self._address = address
-        self._port = port
-        self._remote_address = remote_address
-        self._remote_port = remote_port
+        self._remote = (remote_address, remote_port)
+        self._metrics_interval = metrics_interval
 
-        self.server: ThreadingOSCUDPServer = None
-        self.client: SimpleUDPClient = None
+        # runs the commands one at a time, in the order received
+        self._commands = ThreadPoolExecutor(max_workers=1)
+        self._command_ids = itertools.count(1)
 
     def _send_message(self, path: str, args: Sequence[Any]):
         self._logger.info(
                 f"Sending message '{path}' with args '{args}' to client")
-        self.client.send_message(path, args)
+        self.send_message(self._remote, path, args)
+
+    def _queue_command(self, addr: str,
+                       command: Callable[..., Tuple[bool, str]],
+                       args: Sequence[Any], command_id: Any = None,
+                       at: Optional[float] = None):
+        """
+        Acknowledge a command right away and queue it for the command
+        worker, at time `at` (seconds since the epoch) if given.
+
+        The acknowledgement is sent as `/oscVideo/ack id address` and the
+        (success, message) returned by `command` as `/oscVideo/status
+        success message id`, where `id` is the one sent along with the
+        command or else a number counting the commands received.
+        """
+        if command_id is None:
+            command_id = next(self._command_ids)
+        self._send_message("/oscVideo/ack", (command_id, addr))
+
+        def finished(future: Future):
+            try:
+                success, message = future.result()
+            except Exception:
+                self._logger.exception(f"Command {addr} failed")
+                success, message = False, f"Failed to run {addr}"
+            self._send_message("/oscVideo/status",
+                               (success, message, command_id))
+
+        def run():
+            self.loop.run_in_executor(
+                    self._commands, command, *args).add_done_callback(
+                            finished)
+
+        delay = 0.0 if at is None else at - time.time()
+        if delay > 0:
+            self.loop.call_later(delay, run)
+        else:
+            run()
 
-    def _prepare_recording(self, addr: str, filename: str = ""):
+    def _prepare_recording(self, addr: str, filename: str = "",
+                           command_id: Any = None, at: Optional[float] = None):
+        self._queue_command(addr, self._run_prepare_recording, (filename,),
+                            command_id, at)
+
+    def _run_prepare_recording(self, filename: str) -> Tuple[bool, str]:
         self._logger.info(
                 f"Prepare recording with filename: {filename}")
         if filename == "":
             self._logger.warning("No filename argument")
-            self._send_message("/oscVideo/status",
-                               (False, "No filename provided"))
-        elif self._video_manager.prepare_recording(filename):
-            self._send_message("/oscVideo/status",
-                               (True, "Prepared Recording"))
-        else:
-            self._send_message("/oscVideo/status",
-                               (False, "Could not prepare Recording"))
+            return False, "No filename provided"
+        if self._video_manager.prepare_recording(filename):
+            return True, "Prepared Recording"
+        return False, "Could not prepare Recording"
 
-    def _record(self, addr: str, record: bool):
+    def _record(self, addr: str, record: Optional[bool] = None,
+                command_id: Any = None, at: Optional[float] = None):
+        """
+        Handle a /oscVideo/record, bundled for time `at` if given.
+        Recordings start with the frames captured closest to that time,
+        even if a camera is started a bit later, they stop at that time.
+        """
         if record is None:
             self._logger.warning(f"No argument sent, expecting "
                                  f"a boolean to start or stop recording")
-        elif record:
-            if self._video_manager.start_recording():
-                self._send_message("/oscVideo/status",
-                                   (True, "Started Recording"))
-            else:
-                self._send_message("/oscVideo/status",
-                                   (False, "Couldn't start recording"))
+        elif record and at is not None:
+            self._logger.info(f"Scheduling recording start at {at:.6f}")
+            self._queue_command(addr, self._run_record,
+                                (record, wall_to_monotonic_time(at)),
+                                command_id)
         else:
+            self._queue_command(addr, self._run_record, (record,),
+                                command_id, at)
+
+    def _scheduled(self, handler: Callable) -> Callable:
+        """Get a handler for messages bundled for a time, see map_timed()."""
+        def scheduled(addr: str, at: float, *args):
+            args += (None,) * (2 - len(args))
+            handler(addr, *args[:2], at=at)
+        return scheduled
+
+    def _run_record(self, record: bool, start_time: Optional[float] = None
+                    ) -> Tuple[bool, str]:
+        if not record:
             self._video_manager.stop_recording()
-            self._send_message("/oscVideo/status",
-                               (True, "Stopped Recording"))
+            return True, "Stopped Recording"
+        if not self._video_manager.start_recording(start_time):
+            return False, "Couldn't start recording"
+        if start_time is not None:
+            return True, "Scheduled Recording"
+        return True, "Started Recording"
+
+    def _collect_metrics(self):
+        """
+        Gather the pipeline metrics in the command worker, they ask the
+        camera processes for their counters and must not run while a
+        command is changing the cameras.
+        """
+        self.loop.run_in_executor(
+                self._commands, self._video_manager.pipeline_metrics
+                ).add_done_callback(self._send_metrics)
 
-    def listen(self):
+    def _send_metrics(self, future: Future):
         """
-        Initialize the server, start listening.
+        Send a `/oscVideo/metrics` message for each camera, then schedule
+        the next round.
+
+        The arguments are the camera name, the capture and written frame
+        rates, the frames waiting for the encoder and those of them in the
+        overflow file, the frames skipped and repeated so far, the seconds
+        of video waiting for the encoder and the MB per second written to
+        disk.
         """
-        dispatcher = Dispatcher()
         try:
-            self.server = ThreadingOSCUDPServer((self._address, self._port),
-                                                dispatcher)
-        except OSError as e:
-            self._logger.error(f"Can't start OSC interface: {e}")
-            return False
-
-        self._logger.info(
-                f"OSC Server listening on {self._address}:{self._port}")
-        self.client = SimpleUDPClient(self._remote_address, self._remote_port)
-
-        dispatcher.map("/oscVideo/prepareRecording",
-                       self._prepare_recording)
-        dispatcher.map("/oscVideo/record", self._record)
-        return True
+            metrics = future.result()
+        except Exception:
+            self._logger.exception("Could not gather metrics")
+            metrics = []
+        for camera in metrics:
+            self.send_message(self._remote, "/oscVideo/metrics", (
+                camera["camera"],
+                round(camera["capture_fps"], 2),
+                round(camera["written_fps"], 2),
+                camera["queue_depth"],
+                camera["spill_depth"],
+                camera["frames_skipped"],
+                camera["frames_repeated"],
+                round(camera["encoder_backlog"], 3),
+                round(camera["disk_write_rate"] / 2**20, 3)))
+        self.loop.call_later(self._metrics_interval, self._collect_metrics)
+
+    def listen(self) -> bool:
+        """
+        Initialize the server, start listening.
+        """
+        for address, handler in (
+                ("/oscVideo/prepareRecording", self._prepare_recording),
+                ("/oscVideo/record", self._record)):
+            self.dispatcher.map(address, handler)
+            self.dispatcher.map_timed(address, self._scheduled(handler))
+        return super().listen()
 
     def run(self):
-        self.server.serve_forever()
+        if self._metrics_interval > 0:
+            self.loop.call_soon(self._collect_metrics)
+        super().run()
+        self._commands.shutdown(wait=True)
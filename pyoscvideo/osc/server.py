@@ -0,0 +1,172 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+
+from typing import (Any, Callable, Dict, List, Optional, Sequence, Tuple,
+                    cast)
+
+from pythonosc import osc_packet
+from pythonosc.dispatcher import Dispatcher
+from pythonosc.osc_message_builder import OscMessageBuilder
+from pythonosc.osc_server import AsyncIOOSCUDPServer
+
+from PyQt5.QtCore import QThread
+
+import asyncio
+import logging
+import time
+
+
+class TimedDispatcher(Dispatcher):
+    """
+    Dispatcher passing the time of bundles timed in the future to the
+    handlers mapped with map_timed(), as `handler(address, time, *args)`
+    with the time in seconds since the epoch, instead of holding the
+    message back until then.
+
+    Other messages bundled for later are handled at their time by `loop`
+    if given, else the dispatcher waits for it like python-osc's does.
+    """
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        super().__init__()
+        self._loop = loop
+        self._timed_handlers: Dict[str, Callable] = {}
+
+    def map_timed(self, address: str, handler: Callable):
+        self._timed_handlers[address] = handler
+
+    @staticmethod
+    def _invoke(handlers: List, client_address: Tuple[str, int],
+                message: Any) -> List:
+        results = []
+        for handler in handlers:
+            result = handler.invoke(client_address, message)
+            if result is not None:
+                results.append(result)
+        return results
+
+    def call_handlers_for_packet(self, data: bytes,
+                                 client_address: Tuple[str, int]) -> List:
+        results: List = []
+        try:
+            packet = osc_packet.OscPacket(data)
+        except osc_packet.ParseError:
+            return results
+        for timed_msg in packet.messages:
+            message = timed_msg.message
+            now = time.time()
+            timed = self._timed_handlers.get(message.address)
+            if timed is not None and timed_msg.time > now:
+                timed(message.address, timed_msg.time, *message.params)
+                continue
+            handlers = list(self.handlers_for_address(message.address))
+            if not handlers:
+                continue
+            if timed_msg.time > now:
+                if self._loop is not None:
+                    self._loop.call_later(timed_msg.time - now, self._invoke,
+                                          handlers, client_address, message)
+                    continue
+                time.sleep(timed_msg.time - now)
+            results += self._invoke(handlers, client_address, message)
+        return results
+
+
+class OSCServerThread(QThread):
+    """
+    Thread running an asyncio event loop that receives OSC messages on
+    `address`:`port` and sends the replies.
+
+    Handlers mapped on the `dispatcher` run in the loop, they must not
+    block. Messages bundled for later are handled at their time by the
+    loop too, see TimedDispatcher. Anything that takes a while belongs in
+    a worker of its own, reporting back to the loop, e.g. with
+    call_soon().
+    """
+    def __init__(self, address: str, port: int):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + ".OSCServerThread")
+        self._address = address
+        self._port = port
+        self._loop = cast(asyncio.BaseEventLoop, asyncio.new_event_loop())
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self.dispatcher = TimedDispatcher(self._loop)
+
+    @property
+    def loop(self) -> asyncio.BaseEventLoop:
+        return self._loop
+
+    def listen(self) -> bool:
+        """
+        Open the port, returns False if it can't be opened. Messages are
+        received once the thread is started.
+        """
+        server = AsyncIOOSCUDPServer((self._address, self._port),
+                                     self.dispatcher, self._loop)
+        try:
+            transport, _ = self._loop.run_until_complete(
+                    server.create_serve_endpoint())
+        except OSError as e:
+            self._logger.error(f"Can't listen on {self._address}:"
+                               f"{self._port}: {e}")
+            return False
+        self._transport = cast(asyncio.DatagramTransport, transport)
+        self._logger.info(
+                f"OSC Server listening on {self._address}:{self._port}")
+        return True
+
+    def call_soon(self, callback: Callable, *args: Any):
+        """Call `callback` in the loop, from any thread."""
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def send_message(self, remote: Tuple[str, int], path: str,
+                     args: Sequence[Any]):
+        """
+        Send a message to `remote` from the port listened on. Can be called
+        from any thread, the message is sent by the loop.
+        """
+        builder = OscMessageBuilder(address=path)
+        for arg in args:
+            builder.add_arg(arg)
+        datagram = builder.build().dgram
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._sendto(datagram, remote)
+        else:
+            self.call_soon(self._sendto, datagram, remote)
+
+    def _sendto(self, datagram: bytes, remote: Tuple[str, int]):
+        if self._transport is not None:
+            self._transport.sendto(datagram, remote)
+
+    def stop(self):
+        """Stop the loop, from any thread."""
+        self.call_soon(self._loop.stop)
+
+    def run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        self._loop.run_until_complete(asyncio.sleep(0))
+        self._loop.close()
@@ -22,30 +22,77 @@ import sys
 import os.path
 import argparse
 import glob
+import re
 
 import vlc
 
 from threading import Thread, Timer
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QObject
+from PyQt5.QtCore import Qt, pyqtSignal, QObject
 from PyQt5.QtGui import QPalette, QColor
 from PyQt5.QtWidgets import (QMainWindow, QWidget, QFrame, QGridLayout,
                              QFileDialog, QApplication, QLabel,
                              QSizePolicy, QPushButton, QSlider)
 
-from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import BlockingOSCUDPServer
+from pyoscvideo.osc.server import OSCServerThread
+from pyoscvideo.video.segmented_writer import INDEX_EXTENSION, read_index
+
+
+# Proxy outputs recorded along with a camera, e.g. camera_0_360p.mov, see
+# proxy_filename() in pyoscvideo.video.camera
+PROXY_PATTERN = re.compile(r"_\d+p$")
+
+
+def folder_videos(folder_path):
+    """
+    Get the .mov videos in the specified folder, leaving out the proxy
+    outputs of the cameras.
+
+    Each video is given as the list of its segments, as pairs of the path
+    and the start time in milliseconds. Recordings split into segments are
+    chained following their index, see SegmentedWriter, the other videos
+    have a single segment.
+    """
+    videos = {}
+    segment_files = set()
+    for index_path in glob.glob(os.path.join(folder_path,
+                                             "*" + INDEX_EXTENSION)):
+        index = read_index(index_path)
+        if index is None:
+            continue
+        segments = sorted(index["segments"], key=lambda info: info["start"])
+        videos[index_path[:-len(INDEX_EXTENSION)]] = [
+            (os.path.join(folder_path, info["file"]),
+             int(info["start"] * 1000))
+            for info in segments]
+        segment_files.update(info["file"] for info in segments)
+        # not valid files when left by a crash
+        segment_files.update(index["unfinished"])
+
+    for video in glob.glob(os.path.join(folder_path, "*.mov")):
+        if os.path.basename(video) not in segment_files:
+            videos[os.path.splitext(video)[0]] = [(video, 0)]
+    return [segments for base, segments in sorted(videos.items())
+            if segments and not PROXY_PATTERN.search(base)]
 
 
 class VideoPlayer(QObject):
     """
     Represents the VLC mediaplayer for a video file and the QT Frame
     where to show this video.
+
+    A video split into `segments` (see folder_videos()) is played as one,
+    loading each segment when the previous one ends. Times are given from
+    the start of the first segment.
     """
     video_ended = pyqtSignal()
 
-    def __init__(self, vlc_instance, video_path):
+    def __init__(self, vlc_instance, video_path, segments=None):
         super().__init__()
         self._instance = vlc_instance
+        self._segments = segments or [(video_path, 0)]
+        self._segment = 0
+        self._last_length = None
+        self._is_playing = False
         self._video_path = video_path
         self._media = self._instance.media_new(video_path)
         self.mediaplayer = self._instance.media_player_new()
@@ -90,15 +137,61 @@ class VideoPlayer(QObject):
 
     def reload_media_cb(self):
         """
-        Releases old media file when it reaches the end and reloads the same
-        file.
+        Releases old media file when it reaches the end and loads the next
+        segment, or the first one again after the last.
         """
+        if self._segment + 1 < len(self._segments):
+            self._load_segment(self._segment + 1)
+            self.mediaplayer.play()
+        else:
+            self._load_segment(0)
+
+    def _load_segment(self, segment):
         self._media.release()
+        self._segment = segment
+        self._video_path = self._segments[segment][0]
         self._media = self._instance.media_new(self._video_path)
         self.mediaplayer.set_media(self._media)
 
     def get_length(self):
-        return self.mediaplayer.get_length()
+        """
+        Gets the length in milliseconds, up to the end of the last
+        segment.
+        """
+        start = self._segments[-1][1]
+        if self._segment == len(self._segments) - 1:
+            return start + self.mediaplayer.get_length()
+        if self._last_length is None:
+            media = self._instance.media_new(self._segments[-1][0])
+            media.parse()
+            self._last_length = max(0, media.get_duration())
+            media.release()
+        return start + self._last_length
+
+    def get_time(self):
+        return self._segments[self._segment][1] + self.mediaplayer.get_time()
+
+    def set_time(self, time):
+        """
+        Sets time as an integer in milliseconds, loading the segment it
+        falls in.
+        """
+        segment = max(i for i, (_, start) in enumerate(self._segments)
+                      if start <= time or i == 0)
+        if segment != self._segment:
+            self._load_segment(segment)
+            self.mediaplayer.play()
+            if not self._is_playing:
+                self.mediaplayer.set_pause(True)
+        self.mediaplayer.set_time(time - self._segments[segment][1])
+
+    def play(self):
+        self.mediaplayer.play()
+        self._is_playing = True
+
+    def pause(self):
+        self.mediaplayer.pause()
+        self._is_playing = False
 
 
 class Player(QMainWindow):
@@ -128,9 +221,14 @@ class Player(QMainWindow):
             self.osc_server.play_message.connect(self.play)
             self.osc_server.pause_message.connect(self.pause)
             self.osc_server.add_video_message.connect(self.add_video)
+            self.osc_server.add_folder_message.connect(self.add_folder)
             self.osc_server.clean_message.connect(self.clean)
             self.osc_server.set_time_message.connect(self.set_time)
-            self.osc_server.start()
+            if self.osc_server.listen():
+                self.osc_server.start()
+            else:
+                self.info.setText(f"Could not listen for OSC messages on "
+                                  f"{address}:{port}")
 
     @property
     def _max_length(self):
@@ -145,6 +243,9 @@ class Player(QMainWindow):
         """
         if self._position_tracker:
             self._position_tracker.cancel()
+        if self.use_osc and self.osc_server.isRunning():
+            self.osc_server.stop()
+            self.osc_server.wait()
         self.clean()
 
     def _create_ui(self):
@@ -191,7 +292,7 @@ class Player(QMainWindow):
 
     def _set_position_slider(self):
         if self.videos:
-            current_time = self.videos[0].mediaplayer.get_time()
+            current_time = self.videos[0].get_time()
             self.position_slider.setValue(
                     (current_time / (self._max_length))*10000)
         self._position_tracker = Timer(0.5, self._set_position_slider)
@@ -216,19 +317,21 @@ class Player(QMainWindow):
 
     def add_folder(self, folder_path):
         """
-        Loads all .mov videos from the specified folder.
+        Loads all .mov videos from the specified folder, see
+        folder_videos().
         """
-        for video in glob.glob(os.path.join(folder_path, "*.mov")):
-            self.add_video(video)
+        for segments in folder_videos(folder_path):
+            self.add_video(segments[0][0], segments)
 
-    def add_video(self, video_path):
+    def add_video(self, video_path, segments=None):
         """
-        Loads video file from video_path.
+        Loads video file from video_path, or the video split into
+        `segments`, see VideoPlayer.
         """
         if self.info:
             self.info.hide()
             self.info = None
-        player = VideoPlayer(self.instance, video_path)
+        player = VideoPlayer(self.instance, video_path, segments)
         self.gridlayout.addWidget(
                 player.frame,
                 self._skip_lines + len(self.videos) // 2, len(self.videos) % 2)
@@ -255,7 +358,7 @@ class Player(QMainWindow):
         Plays all videos.
         """
         for video in self.videos:
-            video.mediaplayer.play()
+            video.play()
         self._is_playing = True
 
     def pause(self):
@@ -263,7 +366,7 @@ class Player(QMainWindow):
         Pauses all videos.
         """
         for video in self.videos:
-            video.mediaplayer.pause()
+            video.pause()
         self._is_playing = False
 
     def set_time(self, time):
@@ -271,33 +374,37 @@ class Player(QMainWindow):
         Sets time as an integer in milliseconds.
         """
         for video in self.videos:
-            video.mediaplayer.set_time(time)
+            video.set_time(time)
 
 
-class OSCServer(QThread):
+class OSCServer(OSCServerThread):
     """
-    Thread worker for the OSC server
+    Thread worker for the OSC server, relays the messages received to the
+    player as signals.
     """
     add_video_message = pyqtSignal(str)
+    add_folder_message = pyqtSignal(str)
     play_message = pyqtSignal()
     pause_message = pyqtSignal()
     clean_message = pyqtSignal()
     set_time_message = pyqtSignal(int)
 
     def __init__(self, address="localhost", port=57221):
-        self.address = address
-        self.port = port
-        super().__init__()
+        super().__init__(address, port)
+        self.dispatcher.map("/oscVideo/setVideoPlay", self.play)
+        self.dispatcher.map("/oscVideo/setVideoPause", self.pause)
+        self.dispatcher.map("/oscVideo/setVideoPosition", self.set_time)
+        self.dispatcher.map("/oscVideo/loadFile", self.add_video)
+        self.dispatcher.map("/oscVideo/loadFolder", self.add_folder)
+        self.dispatcher.map("/oscVideo/clean", self.clean)
 
     def add_video(self, address, filepath):
         # Emits the add_video_message signal
         self.add_video_message.emit(filepath)
 
     def add_folder(self, address, folderpath):
-        # Emits the add_video_message signal for each file in video folder
-        videos = glob.glob(os.path.join(folderpath, "*.mov"))
-        for video in videos:
-            self.add_video_message.emit(video)
+        # Emits the add_folder_message signal
+        self.add_folder_message.emit(folderpath)
 
     def play(self, address):
         # Emits the play_message signal
@@ -315,21 +422,6 @@ class OSCServer(QThread):
         # Emits the clean_message signal
         self.clean_message.emit()
 
-    def run(self):
-        """
-        Initialize the OSC server and starts serving.
-        """
-        dispatcher = Dispatcher()
-        dispatcher.map("/oscVideo/setVideoPlay", self.play)
-        dispatcher.map("/oscVideo/setVideoPause", self.pause)
-        dispatcher.map("/oscVideo/setVideoPosition", self.set_time)
-        dispatcher.map("/oscVideo/loadFile", self.add_video)
-        dispatcher.map("/oscVideo/loadFolder", self.add_folder)
-        dispatcher.map("/oscVideo/clean", self.clean)
-
-        server = BlockingOSCUDPServer((self.address, self.port), dispatcher)
-        server.serve_forever()
-
 
 def main_player():
     """Start the Player application."""
@@ -18,20 +18,37 @@
 # *****************************************************************************
 
 import logging
-import queue
+import os
+import threading
 import time
 import numpy as np
 
-from typing import Callable, Optional, Dict, Any, Tuple
+from typing import Callable, Optional, Dict, Any, List, Tuple, Union
 
 from PyQt5.QtCore import QObject, QThread, pyqtSignal
 from PyQt5.QtGui import QImage
 from cv2.cv2 import VideoWriter_fourcc
 
+from pyoscvideo.video.camera_process import (
+    ProcessCameraReader,
+    ProcessVideoWriter)
 from pyoscvideo.video.camera_reader import CameraReader
+from pyoscvideo.video.capabilities import DeviceCapabilities
+from pyoscvideo.video.frame_ring import FrameRing
+from pyoscvideo.video.pre_roll import PreRollBuffer
 from pyoscvideo.video.video_writer import VideoWriter
 
 
+# Minimum size of the images decoded for the preview
+PREVIEW_SIZE = (480, 270)
+
+
+def proxy_filename(filename: str, name: str) -> str:
+    """Get the name of a proxy output, e.g. camera_0_360p.mov"""
+    base, extension = os.path.splitext(filename)
+    return f"{base}_{name}{extension}"
+
+
 class Camera(QObject):
     """
     Abstracts a video streamer from a camera.
@@ -43,24 +60,123 @@ class Camera(QObject):
     name: str
     recording_fps: int
     recording_info: Optional[Dict['str', Any]]
+    last_frame_timestamp: float
 
     def __init__(self, device_id: int, name: str,
                  resolution: Optional[Dict[str, int]] = None,
                  codec: str = "MJPG", recording_fps: int = 25,
-                 recording_resolution: Optional[Dict[str, int]] = None):
+                 recording_resolution: Optional[Dict[str, int]] = None,
+                 capture_format: Optional[str] = None,
+                 capture_backend: str = "opencv",
+                 source: Optional[str] = None,
+                 capture_process: bool = False,
+                 capabilities: Optional[DeviceCapabilities] = None,
+                 synchronized_capture: bool = False,
+                 variable_frame_rate: bool = False,
+                 pre_roll: float = 0.0, pre_roll_max_mb: int = 256,
+                 segment_duration: float = 0.0,
+                 encoder: str = "opencv",
+                 ffmpeg: Optional[Dict[str, Any]] = None,
+                 write_queue_mb: int = 512, spill_dir: str = "",
+                 resize_interpolation: str = "linear",
+                 resize_workers: int = 0,
+                 proxies: Optional[List[Dict[str, Any]]] = None):
         """
         Init the camera object, prepare the supporting camera reader,
         video writer and fps update threads.
+
+        The device is asked to capture in the `capture_format` (a fourcc,
+        e.g. "MJPG", independent of the recording `codec`), if given.
+
+        With `capture_process` set, capturing and recording run in a worker
+        process of their own, see camera_process. The `capabilities` of
+        the device, if known, are used to check the capture options.
+
+        With `synchronized_capture` set, frames are only captured together
+        with the other cameras in use, see SynchronizedCapture.
+
+        With `variable_frame_rate` set, recordings hold every captured
+        frame once with its capture time, instead of `recording_fps`.
+
+        With `pre_roll` set, recordings start with the frames captured up
+        to that many seconds before, using at most `pre_roll_max_mb` of
+        memory, see PreRollBuffer.
+
+        With `segment_duration` set, recordings are split into files of
+        that many seconds, see SegmentedWriter.
+
+        With `encoder` "ffmpeg", recordings are encoded by an ffmpeg
+        subprocess configured with the `ffmpeg` options, see FFmpegWriter.
+        Its `cameras` entry maps camera names to options overriding the
+        others for that camera.
+
+        Frames waiting to be encoded take at most `write_queue_mb` of
+        memory, the rest are spilled to a file in `spill_dir`, see
+        SpillingQueue.
+
+        Frames are resized to the recording resolution with the
+        `resize_interpolation` in a pool of `resize_workers` threads
+        shared by all cameras, see Resizer.
+
+        Each of the `proxies` is an extra output recorded along with the
+        main one from the same frames, e.g. a low resolution copy for
+        scrubbing. They are given as dicts with a `resolution` and
+        optionally their own `codec`, `recording_fps` and `name` (used
+        for the file name, see proxy_filename(), by default the height,
+        e.g. "360p").
         """
         super().__init__()
         self._logger = logging.getLogger(__name__ + f".Camera[{name}]")
         self._logger.info("Initializing")
 
         self._codec = codec
-        fourcc = VideoWriter_fourcc(*codec)
-        self._options = {
-            "CAP_PROP_FOURCC": fourcc,
-            }
+        self._capture_backend = capture_backend
+        self._source = source
+        self._capture_process = capture_process
+        self._capabilities = capabilities
+        if synchronized_capture and capture_process:
+            self._logger.warning(
+                    "Synchronized capture is not possible when capturing "
+                    "in a worker process, capturing free running")
+            synchronized_capture = False
+        self._synchronized_capture = synchronized_capture
+        self._variable_frame_rate = variable_frame_rate
+        if pre_roll and capture_process:
+            self._logger.warning(
+                    "Pre-roll is not possible when capturing in a worker "
+                    "process, recordings start when triggered")
+            pre_roll = 0.0
+        self._pre_roll_seconds = pre_roll
+        self._pre_roll_max_bytes = pre_roll_max_mb * 1024 * 1024
+        self._pre_roll: Optional[PreRollBuffer] = None
+        # taken by the running recording, its thread may still be ending
+        self._taken_pre_roll: Optional[PreRollBuffer] = None
+        self._segment_duration = segment_duration
+        self._encoder = encoder
+        self._ffmpeg_options = dict(ffmpeg or {})
+        overrides = self._ffmpeg_options.pop("cameras", None) or {}
+        self._ffmpeg_options.update(overrides.get(name) or {})
+        self._write_queue_bytes = write_queue_mb * 1024 * 1024
+        self._spill_dir = spill_dir
+        self._resize_interpolation = resize_interpolation
+        self._resize_workers = resize_workers
+        if proxies and capture_process:
+            self._logger.warning(
+                    "Proxy outputs are not possible when capturing in a "
+                    "worker process, recording the main output only")
+            proxies = None
+        self._proxies = [{
+            "resolution": (proxy["resolution"]["width"],
+                           proxy["resolution"]["height"]),
+            "codec": proxy.get("codec", codec),
+            "recording_fps": proxy.get("recording_fps", recording_fps),
+            "name": proxy.get("name", f"{proxy['resolution']['height']}p"),
+            } for proxy in proxies or []]
+        self._proxy_writers: List[VideoWriter] = []
+        self._options: Dict[str, int] = {}
+        if capture_format:
+            self._options["CAP_PROP_FOURCC"] = VideoWriter_fourcc(
+                    *capture_format)
 
         self._resolution = None
         if resolution:
@@ -92,8 +208,11 @@ class Camera(QObject):
         self.is_recording = False
         self.recording_fps = recording_fps
         self.recording_info = {}
+        self.last_frame_timestamp = 0.0
 
         self._image_update_thread = None
+        self._open_lock = threading.Lock()
+        self._source_opened = False
         self._init_reader_and_writer()
         self._fps_update_thread: Optional[UpdateFps] = None
 
@@ -102,7 +221,16 @@ class Camera(QObject):
         Initializes the CameraReader, which is responsible for managing
         a thread for reading frames from the camera.
         """
-        self._camera_reader = CameraReader(self._read_queue, self._options)
+        if self._capture_process:
+            self._camera_reader = ProcessCameraReader(
+                    self._frame_ring, self._options, self._capture_backend,
+                    self._source, self._capabilities,
+                    preview_size=PREVIEW_SIZE)
+        else:
+            self._camera_reader = CameraReader(
+                    self._frame_ring, self._options, self._capture_backend,
+                    self._source, self._capabilities,
+                    free_running=not self._synchronized_capture)
 
     def _init_writer(self):
         """
@@ -112,10 +240,20 @@ class Camera(QObject):
         if self._recording_resolution is None:
             self._recording_resolution = self._camera_reader.frame_size
 
-        self._writer = VideoWriter(self._write_queue,
-                                   self._codec,
-                                   self.recording_fps,
-                                   self._recording_resolution)
+        if self._capture_process:
+            self._writer = ProcessVideoWriter(self._camera_reader.process,
+                                              self._codec,
+                                              self.recording_fps,
+                                              self._recording_resolution)
+        else:
+            self._writer = VideoWriter(self._frame_ring,
+                                       self._codec,
+                                       self.recording_fps,
+                                       self._recording_resolution)
+        self._proxy_writers = [
+                VideoWriter(self._frame_ring, proxy["codec"],
+                            proxy["recording_fps"], proxy["resolution"])
+                for proxy in self._proxies]
 
     def check_frame_size(self) -> Tuple[bool, Tuple[int, int]]:
         """
@@ -129,6 +267,40 @@ class Camera(QObject):
         return (self._camera_reader.frame_size == self._resolution,
                 self._camera_reader.frame_size)
 
+    @property
+    def frame_pool_statistics(self) -> Dict[str, Any]:
+        """
+        Get the occupancy of the pool of image buffers used for capturing,
+        see FramePool.statistics.
+        """
+        return self._camera_reader.frame_pool_statistics
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Get the live counters of the capture and the recording: the frames
+        read since capturing started and, while recording, those of the
+        main output (see VideoWriter.metrics).
+        """
+        metrics: Dict[str, Any] = {
+            "frames_read": (self._camera_reader.frames_read
+                            if self.is_capturing else 0)}
+        writer = self._writer
+        if self.is_recording and writer is not None:
+            metrics.update(writer.metrics)
+        return metrics
+
+    @property
+    def synchronized_reader(self) -> Optional[CameraReader]:
+        """
+        Get the reader to be driven by a SynchronizedCapture, None if the
+        camera is not capturing or captures free running.
+        """
+        if self._synchronized_capture and self.is_capturing:
+            assert isinstance(self._camera_reader, CameraReader)
+            return self._camera_reader
+        return None
+
     @property
     def fail_msg(self):
         if self._camera_reader:
@@ -144,22 +316,59 @@ class Camera(QObject):
         self.is_capturing = False
         self._logger.error(f"Could not start capturing: {self.fail_msg}")
 
+    @property
+    def open_timings(self) -> Dict[str, float]:
+        """
+        Get the time in seconds taken by each phase of opening the source,
+        see CameraReader.open_camera().
+        """
+        return self._camera_reader.open_timings
+
+    def open_source(self) -> bool:
+        """
+        Open the source and start reading frames from it.
+
+        This is the slow part of start_capturing(), which calls it if
+        needed. It does not touch the Qt threads of the camera, so it can
+        be called from any thread, e.g. to open several cameras at once.
+        """
+        with self._open_lock:
+            if not self._source_opened:
+                self._source_opened = (
+                        self._camera_reader.set_camera(self.device_id) and
+                        self._camera_reader.ready)
+            return self._source_opened
+
+    def close_source(self):
+        """
+        Close a source opened with open_source() which ended up not being
+        used for capturing.
+        """
+        with self._open_lock:
+            if self.is_capturing or not self._source_opened:
+                return
+            self._logger.info("Closing unused source")
+            self._camera_reader.stop_buffering()
+            self._camera_reader.release()
+            self._init_reader_and_writer()
+
     def start_capturing(self) -> bool:
         """
         Start capturing frames from the defined source.
 
-        Creates CameraReader Object and sets the source and the state
+        Opens the source, if not opened with open_source() yet, and starts
+        the threads updating the image and the frame rate.
         """
         self._logger.info("Start capturing")
 
         if self.is_capturing:
             return True
 
-        if (self._camera_reader.set_camera(self.device_id) and
-                self._camera_reader.ready):
+        if self.open_source():
             self._logger.info("Capturing started")
             self._start_image_update_thread()
             self._start_fps_update_thread()
+            self._start_pre_roll()
             self.is_capturing = True
             return True
 
@@ -185,12 +394,13 @@ class Camera(QObject):
         """
         Initializes both camera reader and video writer.
         """
-        self._camera_reader: Optional[CameraReader] = None
-        self._read_queue: queue.LifoQueue = queue.LifoQueue()
+        self._camera_reader: Optional[
+                Union[CameraReader, ProcessCameraReader]] = None
+        self._frame_ring = FrameRing()
+        self._source_opened = False
         self._init_reader()
 
         self._writer = None
-        self._write_queue: queue.LifoQueue = queue.LifoQueue()
         self._init_writer()
 
     def prepare_recording(self, filename: str) -> bool:
@@ -198,7 +408,8 @@ class Camera(QObject):
         Prepare the recording.
 
         If not capturing yet, starts the capturing, and tries to create a file
-        with the set file extension.
+        with the set file extension. The writers are armed, so that
+        start_recording() only has to trigger them.
         """
         self._logger.info("Preparing recording: %s", filename)
 
@@ -206,13 +417,48 @@ class Camera(QObject):
             if not self.start_capturing():
                 return False
 
-        if not self._writer.prepare_writing(filename):
-            return False
-
-        self._camera_reader.add_queue(self._write_queue)
+        outputs = [(self._writer, filename, self._codec,
+                    self._recording_resolution)]
+        outputs += [(writer, proxy_filename(filename, proxy["name"]),
+                     proxy["codec"], proxy["resolution"])
+                    for writer, proxy in zip(self._proxy_writers,
+                                             self._proxies)]
+        passthrough = [self._can_passthrough(codec, resolution)
+                       for _, _, codec, resolution in outputs]
+        # the outputs encoding the frames decode them once, for the
+        # largest of them
+        decode_size = max((resolution for (_, _, _, resolution), stored
+                           in zip(outputs, passthrough)
+                           if not stored and resolution is not None),
+                          key=lambda size: size[0] * size[1], default=None)
+        for (writer, output_filename, codec, resolution), stored in zip(
+                outputs, passthrough):
+            writer.passthrough = stored
+            writer.variable_frame_rate = self._variable_frame_rate
+            writer.segment_duration = self._segment_duration
+            writer.encoder = self._encoder
+            writer.ffmpeg = self._ffmpeg_options
+            writer.max_queue_bytes = self._write_queue_bytes
+            writer.spill_dir = self._spill_dir
+            writer.resize_interpolation = self._resize_interpolation
+            writer.resize_workers = self._resize_workers
+            writer.decode_size = decode_size
+            if not writer.prepare_writing(output_filename):
+                return False
 
         return True
 
+    def _can_passthrough(self, codec: str,
+                         resolution: Optional[Tuple[int, int]]) -> bool:
+        """
+        Check if the compressed frames can be stored as captured, without
+        decoding and encoding them again, in an output with `codec` and
+        `resolution`.
+        """
+        return (codec == "MJPG" and self._encoder == "opencv" and
+                self._camera_reader.provides_packets and
+                self._camera_reader.frame_size == resolution)
+
     def _start_image_update_thread(self):
         """
         Start the capturing of frames.
@@ -222,12 +468,12 @@ class Camera(QObject):
         if self._image_update_thread:
             self._image_update_thread.stop()
 
-        self._image_update_thread = UpdateImage(self._read_queue)
+        self._image_update_thread = UpdateImage(self._frame_ring)
         # TODO:
         # There is an strage bug here, if we use the self.on_new_frame
         # as callback it won't be called, but with a lambda it works
         self._image_update_thread.new_frame.connect(
-                lambda: self.on_new_frame())
+                lambda timestamp: self.on_new_frame(timestamp))
         self._image_update_thread.start()
 
     def add_update_fps_label_cb(self, callback: Callable[[float], None]):
@@ -270,12 +516,48 @@ class Camera(QObject):
         self._fps_update_thread = UpdateFps(self)
         self._fps_update_thread.start()
 
-    def start_recording(self):
+    def _start_pre_roll(self):
+        """Start keeping the last frames for the next recording."""
+        self._wait_taken_pre_roll()
+        if self._pre_roll_seconds > 0 and self._pre_roll is None:
+            self._pre_roll = PreRollBuffer(self._frame_ring,
+                                           self._pre_roll_seconds,
+                                           self._pre_roll_max_bytes)
+            self._pre_roll.start()
+
+    def _stop_pre_roll(self):
+        self._wait_taken_pre_roll()
+        if self._pre_roll is not None:
+            self._pre_roll.stop()
+            self._pre_roll = None
+
+    def _wait_taken_pre_roll(self):
+        if self._taken_pre_roll is not None:
+            self._taken_pre_roll.wait()
+            self._taken_pre_roll = None
+
+    def start_recording(self, start_time: Optional[float] = None):
         """Start the recording.
+
+        The recording starts with the frames kept by the pre-roll buffer,
+        if any, or with the frame captured closest to `start_time` (on the
+        time.monotonic() clock) if given.
         """
-        if self._camera_reader.ready and self._writer.ready:
+        if (self._camera_reader.ready and self._writer.ready and
+                all(writer.ready for writer in self._proxy_writers)):
             self.recording_info = {}
-            self._writer.start_writing()
+            pre_roll = None
+            if self._pre_roll is not None:
+                pre_roll = self._pre_roll.take()
+                self._taken_pre_roll = self._pre_roll
+                self._pre_roll = None
+            for writer in self._proxy_writers:
+                # each output holds its own references to the frames
+                writer.start_writing(
+                    None if pre_roll is None else
+                    ([frame.retain() for frame in pre_roll[0]], pre_roll[1]),
+                    start_time)
+            self._writer.start_writing(pre_roll, start_time)
             self.is_recording = True
             self._logger.info("Started recording")
             return True
@@ -285,54 +567,96 @@ class Camera(QObject):
             "Could not start recording, camera reader or writer not ready")
         return False
 
-    def stop_recording(self):
+    def stop_recording(self, rearm=True):
         """Stop the recording and print out statistics.
 
+        Without `rearm` the writer and pre-roll for the next recording are
+        not set up yet, rearm() has to be called from the thread owning
+        the camera, as it starts threads.
+
         TODO: add return values
         """
         if self.is_recording:
-            frames_written, recording_time, frames_repeated = (
-                    self._writer.stop_writing()
-                )
-            self._camera_reader.remove_queue(self._write_queue)
+            # all outputs end with the frame captured last by now
+            last_timestamp = None
+            if self._proxy_writers:
+                latest = self._frame_ring.latest()
+                if latest is not None:
+                    last_timestamp = latest.timestamp
+                    latest.release()
+            for writer in self._proxy_writers:
+                writer.request_stop(last_timestamp)
+            statistics = self._writer.stop_writing(last_timestamp)
+            proxies = [dict(writer.stop_writing(last_timestamp),
+                            name=proxy["name"],
+                            resolution=proxy["resolution"])
+                       for writer, proxy in zip(self._proxy_writers,
+                                                self._proxies)]
             self.is_recording = False
+            frames_written = statistics["frames"]
+            recording_time = statistics["time"]
             self._logger.info("Stopped recording")
             self._logger.info(
                 f"Recording Time: {recording_time:.1f}s")
             self._logger.info(f"{int(frames_written)} frames written")
+            avg = 0.0
             if recording_time > 0:
                 avg = frames_written / recording_time
                 self._logger.info(f"Average frame rate: {avg:.2f}")
-            self.recording_info["time"] = recording_time
+            if statistics.get("start_latency") is not None:
+                self._logger.info(
+                    f"Trigger to first frame: "
+                    f"{statistics['start_latency'] * 1000:.1f}ms")
+            if statistics.get("start_error") is not None:
+                self._logger.info(
+                    f"First frame captured "
+                    f"{statistics['start_error'] * 1000:+.1f}ms from the "
+                    f"scheduled start")
+            if statistics.get("frames_dropped"):
+                self._logger.warning(
+                    f"{statistics['frames_dropped']} frames lost in capture")
+            self.recording_info.update(statistics)
             self.recording_info["fps"] = avg
             self.recording_info["resolution"] = self._recording_resolution
-            self.recording_info["frames"] = frames_written
-            self.recording_info["frames_repeated"] = frames_repeated
-            # Re-init the writer
-            # TODO: review this because it doesn't seem correct to re-init
-            # it here
-            self._writer = None
-            self._init_writer()
+            self.recording_info["frame_pool"] = self.frame_pool_statistics
+            self.recording_info["proxies"] = proxies
+            if rearm:
+                self.rearm()
         else:
             self._logger.warning("Not recording")
 
-    def on_new_frame(self):
+    def rearm(self):
+        """Set up the writer and pre-roll for the next recording."""
+        # Re-init the writer
+        # TODO: review this because it doesn't seem correct to re-init
+        # it here
+        self._writer = None
+        self._init_writer()
+        self._start_pre_roll()
+
+    def on_new_frame(self, timestamp: float):
         """
-        Called when a new frame is captured by the camera reader.
+        Called when a new frame is captured by the camera reader, with its
+        capture timestamp.
         """
         self.frame_counter += 1
+        self.last_frame_timestamp = timestamp
 
     def cleanup(self):
         """
         Perform necessary action to guarantee a clean exit of the app.
         """
+        self._stop_pre_roll()
         self._camera_reader.stop_buffering()
         self._camera_reader.release()
 
         self._writer.release()
+        for writer in self._proxy_writers:
+            writer.release()
 
-        self._fps_update_thread.stop()
-        self._fps_update_thread.wait()
+        if self._fps_update_thread:
+            self._fps_update_thread.stop()
+            self._fps_update_thread.wait()
 
         if self._image_update_thread:
             self._image_update_thread.stop()
@@ -369,16 +693,25 @@ class UpdateFps(QThread):
 
 class UpdateImage(QThread):
     """ Thread for reading frames from the source and updating the image
+
+    `latency` holds the time between the capture of the last shown frame
+    and its conversion for display, in seconds.
+
+    Compressed frames are decoded at a reduced scale, just large enough
+    for `preview_size`.
     """
-    new_frame = pyqtSignal()
+    new_frame = pyqtSignal(float)
     change_pixmap = pyqtSignal(QImage)
 
-    def __init__(self, frame_queue):
+    def __init__(self, frame_ring: FrameRing,
+                 preview_size: Tuple[int, int] = PREVIEW_SIZE):
         """Init the UpdateImage Thread."""
         super().__init__()
         self._logger = logging.getLogger(__name__ + ".UpdateImage")
-        self._queue = frame_queue
+        self._cursor = frame_ring.cursor()
+        self._preview_size = preview_size
         self._quit = False
+        self.latency = 0.0
 
     def stop(self):
         self._quit = True
@@ -387,23 +720,23 @@ class UpdateImage(QThread):
         """Run the worker."""
         self._logger.info("Started image update thread")
 
-        forward_frames = 0
         while not self._quit:
-            try:
-                frame = self._queue.get(timeout=0.2)
-            except queue.Empty:
+            # always gets the most recent frame, older ones are skipped
+            frame = self._cursor.get(timeout=0.2)
+            if frame is None:
                 self._logger.warning("Timed out waiting for a frame")
                 continue
             self._logger.debug("emit image")
-            image = self.cv2qt(frame)
+            decoded = frame.decoded(self._preview_size)
+            if decoded is None:
+                frame.release()
+                continue
+            image = self.cv2qt(decoded)
+            # the QImage is a copy, the buffer can be reused
+            frame.release()
+            self.latency = time.monotonic() - frame.timestamp
             self.change_pixmap.emit(image)
-            self.new_frame.emit()
-            while not self._queue.empty():
-                # discard other frames if any
-                try:
-                    self._queue.get_nowait()
-                except queue.Empty:
-                    continue
+            self.new_frame.emit(frame.timestamp)
 
     @staticmethod
     def cv2qt(frame):
@@ -0,0 +1,554 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+"""
+Process per camera execution mode.
+
+The capture (ReadThread) and the recording (WriteThread and
+QueuedWriterThread) of a camera run in a worker process, so the decoding,
+resizing and encoding of several cameras is not serialized by the GIL of
+the main process, which is left with the GUI and the OSC interface.
+
+ProcessCameraReader and ProcessVideoWriter stand in for CameraReader and
+VideoWriter in the main process and forward the calls to the worker
+through a pipe. The frames for the preview are copied by the worker into a
+SharedFrameRing and copied back from it into the FrameRing of the Camera,
+so the rest of the application can't tell the difference.
+"""
+
+import logging
+import logging.handlers
+import multiprocessing
+import threading
+import time
+import numpy as np
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from PyQt5.QtCore import QThread
+
+from pyoscvideo.video.camera_reader import CameraReader
+from pyoscvideo.video.capabilities import DeviceCapabilities
+from pyoscvideo.video.frame import Frame, reduced_size
+from pyoscvideo.video.frame_pool import FramePool
+from pyoscvideo.video.frame_ring import FrameRing
+from pyoscvideo.video.shared_frame_ring import SharedFrameRing
+from pyoscvideo.video.video_writer import VideoWriter
+from pyoscvideo.video.write_queue import DEFAULT_MAX_BYTES
+
+
+# Seconds to wait for the worker to answer a command, opening a camera
+# can take a while
+CALL_TIMEOUT = 20.0
+
+
+class _LogForwarder(logging.Handler):
+    """Hand log records of the worker to the logger they were sent to."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+class CameraProcess:
+    """
+    Handle of a camera worker process.
+
+    Commands are sent with call() and run in order by the worker, which
+    sends back their result tagged with the number of the command, so the
+    late answer to a command that timed out is not taken for the answer to
+    the next one. Log messages of the worker go through a queue
+    to the logging configuration of the main process.
+    """
+
+    def __init__(self, options: Dict[str, Any], backend: str,
+                 source: Optional[str],
+                 capabilities: Optional[DeviceCapabilities] = None):
+        self._logger = logging.getLogger(__name__ + ".CameraProcess")
+        # the main process runs Qt, which must not be forked
+        context = multiprocessing.get_context("spawn")
+        self._connection, worker_connection = context.Pipe()
+        self._log_queue = context.Queue()
+        self._log_listener = logging.handlers.QueueListener(
+                self._log_queue, _LogForwarder())
+        self.frame_ready = context.Condition()
+        self._process = context.Process(
+                target=_run_worker,
+                args=(worker_connection, self._log_queue,
+                      logging.getLogger().getEffectiveLevel(),
+                      self.frame_ready, options, backend, source,
+                      capabilities),
+                daemon=True)
+        self._lock = threading.Lock()
+        self._call_number = 0
+
+    @property
+    def is_alive(self) -> bool:
+        return self._process.is_alive()
+
+    def start(self) -> None:
+        self._log_listener.start()
+        self._process.start()
+        self._logger.info(f"Started worker process {self._process.pid}")
+
+    def call(self, command: str, *args, default: Any = None) -> Any:
+        """
+        Run a command in the worker and return its result, or `default` if
+        the worker is gone or the command failed.
+        """
+        with self._lock:
+            if not self.is_alive:
+                self._logger.warning(f"Worker not running, can't {command}")
+                return default
+            self._call_number += 1
+            deadline = time.monotonic() + CALL_TIMEOUT
+            try:
+                self._connection.send((self._call_number, command, args))
+                while True:
+                    if not self._connection.poll(
+                            max(0.0, deadline - time.monotonic())):
+                        self._logger.error(
+                                f"Worker did not answer {command}")
+                        return default
+                    number, success, result = self._connection.recv()
+                    if number == self._call_number:
+                        break
+                    self._logger.warning(
+                            f"Dropping late answer to command {number}")
+            except (OSError, EOFError) as err:
+                self._logger.error(f"Lost connection to the worker: {err}")
+                return default
+        if not success:
+            self._logger.error(f"Worker failed to {command}: {result}")
+            return default
+        return result
+
+    def stop(self) -> None:
+        """Ask the worker to quit, killing it if it does not."""
+        if self.is_alive:
+            self.call("quit")
+            self._process.join(5)
+            if self._process.is_alive():
+                self._logger.warning("Worker did not quit, terminating")
+                self._process.terminate()
+                self._process.join()
+        if self._process.pid is not None:
+            self._log_listener.stop()
+        self._connection.close()
+
+
+class ProcessCameraReader:
+    """
+    Stand-in for CameraReader capturing in a worker process.
+
+    The worker publishes the captured frames in a SharedFrameRing, a
+    ReceiveThread copies them into the local FrameRing for the preview.
+    If `preview_size` is given, the frames are only shared at the size
+    needed for a preview at least that large, which spares the worker
+    full size decodes.
+    """
+    fail_msg: str
+
+    def __init__(self, frame_ring: FrameRing, options: Dict[str, Any],
+                 backend: str = "opencv", source: Optional[str] = None,
+                 capabilities: Optional[DeviceCapabilities] = None,
+                 preview_size: Optional[Tuple[int, int]] = None):
+        self._logger = logging.getLogger(__name__ + ".ProcessCameraReader")
+        self._frame_ring = frame_ring
+        self._preview_size = preview_size
+        self._frame_pool = FramePool()
+        self.process = CameraProcess(options, backend, source, capabilities)
+        self._shared_ring: Optional[SharedFrameRing] = None
+        self._receive_thread: Optional[ReceiveThread] = None
+        self._info: Dict[str, Any] = {}
+        self.fail_msg = ""
+        self.frame_size: Optional[Tuple[int, int]] = None
+        self.open_timings: Dict[str, float] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self.process.is_alive and self._info.get("success", False)
+
+    @property
+    def provides_packets(self) -> bool:
+        return self.ready and self._info["provides_packets"]
+
+    @property
+    def frame_rate(self) -> float:
+        return self._info.get("frame_rate", 0.0)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self._info.get("size", (0, 0))
+
+    @property
+    def frames_read(self) -> int:
+        """Get the number of frames read by the worker's reader."""
+        return self.process.call("frames_read", default=0)
+
+    @property
+    def frame_pool_statistics(self) -> Dict[str, Any]:
+        """Get the statistics of the pool of the worker's reader."""
+        return self.process.call(
+                "frame_pool_statistics",
+                default={"allocated": 0, "in_use": 0, "free": 0, "reused": 0})
+
+    def set_camera(self, device_id: int) -> bool:
+        """
+        Start the worker and open the camera in it. The time taken to start
+        the worker is added to the `open_timings` of the worker's reader.
+        """
+        if self.process.is_alive:
+            self._logger.warning("Worker already running")
+            return self.ready
+        start_time = time.monotonic()
+        self.process.start()
+        self._info = self.process.call(
+                "open", device_id,
+                default={"success": False, "fail_msg": "worker failed"})
+        self.fail_msg = self._info["fail_msg"]
+        timings = self._info.get("open_timings", {})
+        self.open_timings = {"start_worker": (time.monotonic() - start_time -
+                                              sum(timings.values()))}
+        self.open_timings.update(timings)
+        if not self._info["success"]:
+            return False
+
+        self.frame_size = self._info["frame_size"]
+        width, height = self.frame_size
+        if self._preview_size is not None:
+            width, height = reduced_size(self.frame_size,
+                                         self._preview_size)
+        self._shared_ring = SharedFrameRing((height, width, 3))
+        if not self.process.call("share", self._shared_ring.name,
+                                 self._shared_ring.shape,
+                                 self._shared_ring.slots, default=False):
+            self._logger.warning("No preview, could not share frames")
+            return True
+        self._receive_thread = ReceiveThread(
+                self.process, self._shared_ring, self._frame_ring,
+                self._frame_pool)
+        self._receive_thread.start()
+        return True
+
+    def stop_buffering(self) -> int:
+        """Stop the capture in the worker, returns the frames read."""
+        if not self.process.is_alive:
+            return 0
+        if self._receive_thread is not None:
+            self._receive_thread.stop = True
+            self._receive_thread.wait()
+            self._receive_thread = None
+        return self.process.call("stop_buffering", default=0)
+
+    def release(self):
+        """Stop the worker and remove the shared frames."""
+        self.process.stop()
+        self._info = {}
+        if self._shared_ring is not None:
+            self._shared_ring.close()
+            self._shared_ring = None
+
+
+class ProcessVideoWriter:
+    """Stand-in for VideoWriter recording in a worker process."""
+    passthrough: bool
+    variable_frame_rate: bool
+    segment_duration: float
+    encoder: str
+    ffmpeg: Dict[str, Any]
+    max_queue_bytes: int
+    spill_dir: str
+    resize_interpolation: str
+    resize_workers: int
+
+    def __init__(self, process: CameraProcess, fourcc: str,
+                 frame_rate: int, size: Tuple[int, int]):
+        self._logger = logging.getLogger(__name__ + ".ProcessVideoWriter")
+        self._process = process
+        self._fourcc = fourcc
+        self._fps = frame_rate
+        self._size = size
+        self._prepared = False
+        self._writing = False
+        self.passthrough = False
+        self.variable_frame_rate = False
+        self.segment_duration = 0.0
+        self.encoder = "opencv"
+        self.ffmpeg = {}
+        self.max_queue_bytes = DEFAULT_MAX_BYTES
+        self.spill_dir = ""
+        self.resize_interpolation = "linear"
+        self.resize_workers = 0
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self._size
+
+    @size.setter
+    def size(self, value: Tuple[int, int]) -> None:
+        if self._writing:
+            self._logger.warning("Cannot set size during writing")
+        else:
+            self._size = value
+
+    @property
+    def ready(self) -> bool:
+        return self._prepared and self._process.is_alive
+
+    def prepare_writing(self, filename: str) -> bool:
+        if self._writing:
+            self._logger.info("Already writing")
+            return False
+        self._prepared = self._process.call(
+                "prepare_writing", self._fourcc, self._fps, self._size,
+                self.passthrough, self.variable_frame_rate,
+                self.segment_duration, self.encoder, self.ffmpeg,
+                self.max_queue_bytes, self.spill_dir,
+                self.resize_interpolation, self.resize_workers, filename,
+                default=False)
+        return self._prepared
+
+    def start_writing(self, pre_roll: Optional[Tuple[List[Frame], int]] = None,
+                      start_time: Optional[float] = None) -> bool:
+        """
+        Start writing in the worker, frames kept in this process for a
+        `pre_roll` can't be written there. Both processes share the
+        time.monotonic() clock of a `start_time`.
+        """
+        if pre_roll is not None:
+            for frame in pre_roll[0]:
+                frame.release()
+        if not self.ready:
+            self._logger.warning("Not ready for writing")
+            return False
+        self._writing = self._process.call("start_writing", start_time,
+                                           default=False)
+        return self._writing
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """Get the live counters of the recording in the worker."""
+        if not self._writing:
+            return {}
+        return self._process.call("writer_metrics", default={})
+
+    def stop_writing(self, last_timestamp: Optional[float] = None
+                     ) -> Dict[str, Any]:
+        if not self._writing:
+            self._logger.warning("Not writing, nothing to stop")
+        self._writing = False
+        return self._process.call(
+                "stop_writing", last_timestamp,
+                default={"frames": 0, "time": 0.0, "frames_repeated": 0})
+
+    def release(self):
+        if self._writing:
+            self.stop_writing()
+
+
+class ReceiveThread(QThread):
+    """
+    Thread copying the frames published by a worker from the
+    SharedFrameRing into a local FrameRing.
+
+    Only the most recent frame is copied each time, frames published in
+    the meantime are skipped like any consumer of a FrameRing would.
+    """
+    stop: bool
+
+    def __init__(self, process: CameraProcess, shared_ring: SharedFrameRing,
+                 frame_ring: FrameRing, frame_pool: FramePool):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + ".ReceiveThread")
+        self._process = process
+        self._shared_ring = shared_ring
+        self._frame_ring = frame_ring
+        self._frame_pool = frame_pool
+        self.stop = False
+
+    def run(self):
+        self._logger.info("Started receiving frames")
+        position = 0
+        while not self.stop:
+            with self._process.frame_ready:
+                if not self._process.frame_ready.wait_for(
+                        lambda: self._shared_ring.count > position, 0.2):
+                    continue
+            buffer = self._frame_pool.acquire()
+            image = buffer
+            if image is None:
+                image = np.empty(self._shared_ring.shape, dtype=np.uint8)
+            result = self._shared_ring.read_latest(image)
+            if result is None:
+                self._frame_pool.give_back(buffer)
+                continue
+            position, timestamp, sequence = result
+            self._frame_ring.put(self._frame_pool.wrap(
+                    buffer, image, timestamp, sequence))
+        self._logger.info("Finished receiving frames")
+
+
+class _Worker:
+    """
+    Runs in the worker process, executing the commands of the main
+    process on a CameraReader and VideoWriter of its own.
+    """
+
+    def __init__(self, connection, frame_ready, options: Dict[str, Any],
+                 backend: str, source: Optional[str],
+                 capabilities: Optional[DeviceCapabilities]):
+        self._logger = logging.getLogger(__name__ + ".Worker")
+        self._connection = connection
+        self._frame_ready = frame_ready
+        self._frame_ring = FrameRing()
+        self._reader = CameraReader(self._frame_ring, options, backend,
+                                    source, capabilities)
+        self._writer: Optional[VideoWriter] = None
+        self._shared_ring: Optional[SharedFrameRing] = None
+        self._publish_thread: Optional[threading.Thread] = None
+        self._publishing = False
+
+    def run(self):
+        while True:
+            try:
+                number, command, args = self._connection.recv()
+            except EOFError:
+                self._logger.warning("Main process is gone")
+                break
+            try:
+                result = getattr(self, "_" + command)(*args)
+                self._connection.send((number, True, result))
+            except Exception as err:  # pylint: disable=broad-except
+                self._logger.exception(f"Command {command} failed")
+                self._connection.send((number, False, str(err)))
+            if command == "quit":
+                break
+
+    def _open(self, device_id: int) -> Dict[str, Any]:
+        success = self._reader.set_camera(device_id) and self._reader.ready
+        info: Dict[str, Any] = {"success": success,
+                                "fail_msg": self._reader.fail_msg,
+                                "open_timings": self._reader.open_timings}
+        if success:
+            info.update({
+                "frame_size": self._reader.frame_size,
+                "frame_rate": self._reader.frame_rate,
+                "size": self._reader.size,
+                "provides_packets": self._reader.provides_packets,
+            })
+        return info
+
+    def _share(self, name: str, shape: Tuple[int, int, int],
+               slots: int) -> bool:
+        self._shared_ring = SharedFrameRing(shape, slots, name)
+        self._publishing = True
+        self._publish_thread = threading.Thread(target=self._publish,
+                                                daemon=True)
+        self._publish_thread.start()
+        return True
+
+    def _publish(self):
+        """Copy the captured frames to the main process."""
+        assert self._shared_ring is not None
+        cursor = self._frame_ring.cursor()
+        warned = False
+        while self._publishing:
+            frame = cursor.get(timeout=0.2)
+            if frame is None:
+                continue
+            published = self._shared_ring.put(frame)
+            frame.release()
+            if published:
+                with self._frame_ready:
+                    self._frame_ready.notify_all()
+            elif not warned:
+                self._logger.warning("Could not decode frame for preview")
+                warned = True
+
+    def _stop_publishing(self):
+        self._publishing = False
+        if self._publish_thread is not None:
+            self._publish_thread.join()
+            self._publish_thread = None
+        if self._shared_ring is not None:
+            self._shared_ring.close()
+            self._shared_ring = None
+
+    def _stop_buffering(self) -> int:
+        self._stop_publishing()
+        return self._reader.stop_buffering()
+
+    def _frame_pool_statistics(self) -> Dict[str, Any]:
+        return self._reader.frame_pool_statistics
+
+    def _frames_read(self) -> int:
+        return self._reader.frames_read
+
+    def _writer_metrics(self) -> Dict[str, Any]:
+        return {} if self._writer is None else self._writer.metrics
+
+    def _prepare_writing(self, fourcc: str, fps: int, size: Tuple[int, int],
+                         passthrough: bool, variable_frame_rate: bool,
+                         segment_duration: float, encoder: str,
+                         ffmpeg: Dict[str, Any], max_queue_bytes: int,
+                         spill_dir: str, resize_interpolation: str,
+                         resize_workers: int, filename: str) -> bool:
+        self._writer = VideoWriter(self._frame_ring, fourcc, fps,
+                                   (size[0], size[1]))
+        self._writer.passthrough = passthrough
+        self._writer.variable_frame_rate = variable_frame_rate
+        self._writer.segment_duration = segment_duration
+        self._writer.encoder = encoder
+        self._writer.ffmpeg = ffmpeg
+        self._writer.max_queue_bytes = max_queue_bytes
+        self._writer.spill_dir = spill_dir
+        self._writer.resize_interpolation = resize_interpolation
+        self._writer.resize_workers = resize_workers
+        return self._writer.prepare_writing(filename)
+
+    def _start_writing(self, start_time: Optional[float]) -> bool:
+        return (self._writer is not None and
+                self._writer.start_writing(start_time=start_time))
+
+    def _stop_writing(self, last_timestamp: Optional[float]
+                      ) -> Dict[str, Any]:
+        if self._writer is None:
+            return {"frames": 0, "time": 0.0, "frames_repeated": 0}
+        statistics = self._writer.stop_writing(last_timestamp)
+        self._writer = None
+        return statistics
+
+    def _quit(self):
+        if self._writer is not None:
+            self._writer.release()
+        self._stop_publishing()
+        self._reader.stop_buffering()
+        self._reader.release()
+
+
+def _run_worker(connection, log_queue, log_level: int, frame_ready,
+                options: Dict[str, Any], backend: str,
+                source: Optional[str],
+                capabilities: Optional[DeviceCapabilities]):
+    """Entry point of the worker process."""
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(log_level)
+    _Worker(connection, frame_ready, options, backend, source,
+            capabilities).run()
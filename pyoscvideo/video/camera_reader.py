@@ -20,11 +20,11 @@
 # pylint: disable=trailing-whitespace
 
 import logging
-import queue
+import time
 import numpy as np
 import cv2
 
-from typing import Any, Dict, List, Tuple, Optional
+from typing import Any, Dict, Tuple, Optional, Union
 
 from PyQt5.QtCore import QThread
 from cv2.cv2 import (
@@ -33,34 +33,94 @@ from cv2.cv2 import (
     CAP_PROP_FRAME_WIDTH,
     VideoCapture)
 
+import pyoscvideo.helpers.v4l2 as v4l2
+
 from pyoscvideo.helpers.helpers import get_cv_cap_property_id
+from pyoscvideo.video.capabilities import (
+    DeviceCapabilities, fourcc_to_str, str_to_fourcc)
+from pyoscvideo.video.frame import Frame
+from pyoscvideo.video.frame_pool import FramePool
+from pyoscvideo.video.frame_ring import FrameRing
+from pyoscvideo.video.synthetic_capture import SyntheticCapture
+from pyoscvideo.video.v4l2_capture import V4L2Capture
+
+
+# Backends not needing a camera, see SyntheticCapture
+VIRTUAL_BACKENDS = ("synthetic", "file")
+
+
+def frame_time(stream: Union[VideoCapture, V4L2Capture, SyntheticCapture],
+               frames_read: int) -> Tuple[float, int]:
+    """
+    Get the capture timestamp and sequence number of the last frame read
+    from `stream`, falling back to the monotonic clock and the number of
+    frames read when the stream does not provide them.
+    """
+    if isinstance(stream, V4L2Capture) and stream.timestamp_monotonic:
+        return stream.timestamp, stream.sequence
+    if isinstance(stream, SyntheticCapture):
+        return stream.timestamp, stream.sequence
+    return time.monotonic(), frames_read
+
+
+def _int_or_none(value: Any) -> Optional[int]:
+    return None if value is None else int(value)
 
 
 class CameraReader:
     """
     Buffered reading from a Camera using VideoCapture and pushing frames
-    to queue(s) to be consumed.
+    to a FrameRing to be consumed.
 
     The OpenCV caputre can be configured using the `options` argument, see
     set_camera_options().
+
+    The `backend` argument selects how frames are captured: "opencv" uses
+    cv2.VideoCapture, "v4l2" drives the device directly through mmap'd
+    V4L2 buffers (Linux only, see V4L2Capture). "synthetic" generates a
+    test pattern and "file" plays the video file given as `source`, both
+    without needing a camera.
+
+    When the `capabilities` of the device are known, unsupported options
+    are rejected before opening it and no probe frame is read.
+
+    Unless `free_running`, no ReadThread is started: the frames are
+    grabbed and retrieved by a SynchronizedCapture together with the ones
+    of the other cameras, see grab() and retrieve().
     """
-    stream: Optional[VideoCapture]
+    stream: Optional[Union[VideoCapture, V4L2Capture, SyntheticCapture]]
     fail_msg: str
 
-    def __init__(self, frame_queue: queue.LifoQueue, options: Dict[str, Any]):
-        """Init the CameraReader."""
+    def __init__(self, frame_ring: FrameRing, options: Dict[str, Any],
+                 backend: str = "opencv", source: Optional[str] = None,
+                 capabilities: Optional[DeviceCapabilities] = None,
+                 free_running: bool = True):
+        """
+        Init the CameraReader.
+
+        With the `capabilities` of the device the options are checked
+        before opening it, see open_camera().
+        """
         self._logger = logging.getLogger(__name__ + ".CameraReader")
         self._logger.info("Initializing")
         self._options = options
-        self._queues = [frame_queue]
-        self._num_clients = 0
+        self._backend = backend
+        self._source = source
+        self._capabilities = capabilities
+        self.free_running = free_running
+        self._frame_ring = frame_ring
+        self._frame_pool = FramePool()
         self._read_thread = None
+        self._frames_grabbed = 0
+        self._frames_retrieved = 0
+        self._grabbed_time: Tuple[float, int] = (0.0, 0)
         self._reading_finished = True
         self._buffering = False
         self._ready = False
         self.stream = None
         self.fail_msg = ""
         self.frame_size: Optional[Tuple[int, int]] = None
+        self.open_timings: Dict[str, float] = {}
 
     @property
     def ready(self) -> bool:
@@ -71,6 +131,24 @@ class CameraReader:
             return True
         return False
 
+    @property
+    def frame_pool(self) -> FramePool:
+        """Get the pool of image buffers the frames are read into."""
+        return self._frame_pool
+
+    @property
+    def frame_pool_statistics(self) -> Dict[str, Any]:
+        return self._frame_pool.statistics
+
+    @property
+    def provides_packets(self) -> bool:
+        """
+        Check if the stream delivers the compressed MJPEG data along with
+        the decoded frames.
+        """
+        return (self.ready and isinstance(self.stream, V4L2Capture) and
+                self.stream.pixel_format == v4l2.V4L2_PIX_FMT_MJPEG)
+
     @property
     def width(self) -> int:
         """Get the width."""
@@ -115,6 +193,13 @@ class CameraReader:
         self._logger.warning("setting size not implemented")
         raise NotImplementedError
 
+    @property
+    def frames_read(self) -> int:
+        """Get the number of frames read since buffering started."""
+        if self._read_thread is not None:
+            return self._read_thread.frames_read
+        return self._frames_retrieved
+
     @property
     def frame_rate(self) -> float:
         """Get the frame rate."""
@@ -141,21 +226,55 @@ class CameraReader:
     def open_camera(self, device_id: int) -> bool:
         """
         Open the camera with the given ID.
+
+        The time taken by each phase (opening the device, setting the
+        options and reading the first frame) is kept in `open_timings`, in
+        seconds.
         """
         self.fail_msg = ""
+        self.open_timings = {}
+        if self._capabilities is not None:
+            error = self._validate_options()
+            if error:
+                self._logger.error(f"Invalid camera options: {error}")
+                self.fail_msg = error
+                return False
+
+        start_time = time.monotonic()
         try:
-            self.stream = VideoCapture(device_id)
-        except RuntimeError as err:
+            self.stream = self._create_stream(device_id)
+        except (OSError, RuntimeError) as err:
             print(f"Could not open Camera with ID {device_id}: {err}")
             self.fail_msg = str(err)
             return False
+        opened_time = time.monotonic()
+        self.open_timings["open"] = opened_time - start_time
 
         self.set_camera_options(self._options)
-
-        # check size
-        success, frame = self.stream.read()
+        options_time = time.monotonic()
+        self.open_timings["set_options"] = options_time - opened_time
+
+        if self._capabilities is not None:
+            # the device supports the options, no need to read a frame to
+            # find out the size it captures in
+            success = True
+            frame_size = (int(self.stream.get(CAP_PROP_FRAME_WIDTH)),
+                          int(self.stream.get(CAP_PROP_FRAME_HEIGHT)))
+        else:
+            # check size
+            success, frame = self.stream.read()
+            self.open_timings["first_frame"] = (time.monotonic() -
+                                                options_time)
+            if success and frame is not None:
+                frame_size = (frame.shape[1], frame.shape[0])
+            else:
+                success = False
+        self._logger.info(
+                "Open timings: " + ", ".join(
+                    f"{phase} {seconds:.3f}s"
+                    for phase, seconds in self.open_timings.items()))
         if success:
-            self.frame_size = (frame.shape[1], frame.shape[0])
+            self.frame_size = frame_size
             config_size = (
                     self._options.get("CAP_PROP_FRAME_WIDTH", self.size[0]),
                     self._options.get("CAP_PROP_FRAME_HEIGHT", self.size[1]))
@@ -174,6 +293,57 @@ class CameraReader:
         self._logger.warning("Camera not ready, can't open.")
         return False
 
+    def _validate_options(self) -> Optional[str]:
+        """
+        Check the format, size and frame rate in the options against the
+        capabilities of the device, returns why they are not supported or
+        None if they are.
+
+        A format the device does not support is replaced by one it does,
+        with a warning.
+        """
+        assert self._capabilities is not None
+        options = {k.strip(): v for k, v in self._options.items()}
+        fourcc = options.get("CAP_PROP_FOURCC")
+        width = options.get("CAP_PROP_FRAME_WIDTH")
+        height = options.get("CAP_PROP_FRAME_HEIGHT")
+        fps = options.get("CAP_PROP_FPS")
+        if fourcc is not None and self._capabilities.validate(
+                fourcc, width, height, fps) is not None:
+            # capture in another format rather than not at all
+            fallback = self._capabilities.supported_format(width, height, fps)
+            if fallback is not None:
+                self._logger.warning(
+                        f"Can't capture in {fourcc_to_str(fourcc)} with "
+                        f"the configured options, capturing in {fallback}")
+                self._options = {
+                    k: v for k, v in self._options.items()
+                    if k.strip() != "CAP_PROP_FOURCC"}
+                self._options["CAP_PROP_FOURCC"] = str_to_fourcc(fallback)
+                return None
+            fourcc = None
+        return self._capabilities.validate(fourcc, width, height, fps)
+
+    def _create_stream(self, device_id: int
+                       ) -> Union[VideoCapture, V4L2Capture, SyntheticCapture]:
+        """
+        Create the capture stream for the configured backend.
+        """
+        if self._backend == "v4l2":
+            return V4L2Capture(f"/dev/video{device_id}")
+        if self._backend == "synthetic":
+            return SyntheticCapture()
+        if self._backend == "file":
+            stream = SyntheticCapture(self._source)
+            if not stream.isOpened():
+                raise OSError(f"Can't play file {self._source}")
+            return stream
+        if self._backend != "opencv":
+            self._logger.warning(
+                    f"Unknown capture backend '{self._backend}', "
+                    f"using opencv")
+        return VideoCapture(device_id)
+
     def set_camera_options(self, options: Dict[str, Any]) -> None:
         """Set the camera options.
 
@@ -210,6 +380,16 @@ class CameraReader:
 
         self._logger.info("Setting camera options")
         options = {k.strip(): v for k, v in options.items()}
+        if isinstance(self.stream, V4L2Capture):
+            # the format is set at once, see V4L2Capture.set_format()
+            keys = ("CAP_PROP_FRAME_WIDTH", "CAP_PROP_FRAME_HEIGHT",
+                    "CAP_PROP_FOURCC")
+            if any(key in options for key in keys):
+                width, height, fourcc = (_int_or_none(options.pop(key, None))
+                                         for key in keys)
+                success = self.stream.set_format(width, height, fourcc)
+                self._logger.info("[format %s, %s, %s]: success %s",
+                                  width, height, fourcc, success)
         for key, value in options.items():
             success = self.stream.set(get_cv_cap_property_id(key), value)
             self._logger.info("[%s, %s]: success %s", key, value, success)
@@ -218,12 +398,18 @@ class CameraReader:
         """
         Start the buffering of frames.
 
-        Spawns a ReadThread Instance
+        Spawns a ReadThread Instance, unless not free running.
         """
         self._logger.info("Start buffering")
         self._reading_finished = False
         self._buffering = True
-        self._read_thread = ReadThread(self._queues, self.stream)
+        self._frames_grabbed = 0
+        self._frames_retrieved = 0
+        if not self.free_running:
+            return
+        self._read_thread = ReadThread(self._frame_ring, self.stream,
+                                       self._frame_pool,
+                                       self.provides_packets)
         self._read_thread.start()
 
     def stop_buffering(self) -> int:
@@ -243,26 +429,56 @@ class CameraReader:
             self._logger.info(self._read_thread.isRunning())
 
             return self._read_thread.frames_read
-        return 0
-
-    def release(self):
-        """Release the camera."""
-        if self.stream:
-            self.stream.release()
+        return self._frames_retrieved
 
-    def add_queue(self, frame_queue: queue.LifoQueue) -> None:
-        """Add a queue to the camera reader processed queues.
-
-        When not needed anymore, the queue should be removed. See
-        remove_queue(frame_queue)
+    def grab(self) -> Optional[float]:
+        """
+        Grab a frame without retrieving it, for capturing in sync with
+        other cameras. Returns its capture timestamp, or None if no frame
+        could be grabbed.
         """
-        self._queues.append(frame_queue)
+        assert self.stream is not None
+        if not self._buffering or not self.stream.grab():
+            return None
+        self._frames_grabbed += 1
+        self._grabbed_time = frame_time(self.stream, self._frames_grabbed)
+        return self._grabbed_time[0]
 
-    def remove_queue(self, frame_queue: queue.LifoQueue) -> None:
+    def retrieve(self, capture_index: int) -> bool:
         """
-        Remove the given frame_queue from the list of processed queues.
+        Retrieve the frame grabbed last and put it in the frame ring,
+        tagged with the `capture_index` of the set it was grabbed in.
+
+        Frames grabbed but never retrieved were left out on purpose, they
+        are taken out of the sequence numbers so they are not counted as
+        lost.
         """
-        self._queues.remove(frame_queue)
+        assert self.stream is not None
+        self._frames_retrieved += 1
+        timestamp, sequence = self._grabbed_time
+        sequence -= self._frames_grabbed - self._frames_retrieved
+        if self.provides_packets:
+            # the buffer goes back to the driver on the next grab
+            assert isinstance(self.stream, V4L2Capture)
+            packet = self.stream.retrieve_buffer()
+            if packet is None:
+                return False
+            frame = Frame(None, timestamp, sequence, packet.tobytes())
+        else:
+            buffer = self._frame_pool.acquire()
+            success, image = self.stream.retrieve(buffer)
+            if not success or image is None:
+                self._frame_pool.give_back(buffer)
+                return False
+            frame = self._frame_pool.wrap(buffer, image, timestamp, sequence)
+        frame.capture_index = capture_index
+        self._frame_ring.put(frame)
+        return True
+
+    def release(self):
+        """Release the camera."""
+        if self.stream:
+            self.stream.release()
 
 
 class ReadThread(QThread):
@@ -270,17 +486,32 @@ class ReadThread(QThread):
     Thread for reading frames from the stream.
 
     Will consume frames from a VideoCapture stream and push it to
-    multiple queues to be consumed by other threads.
+    a FrameRing to be consumed by other threads.
+
+    Frames are decoded into buffers recycled through a FramePool, so no
+    new image is allocated per frame once the consumers keep up.
+
+    If `with_packets` is set, only the compressed data of each frame is
+    read from the stream. It is not decoded here but by the consumers
+    needing the image, at the scale they need it (see Frame.decoded()).
+
+    Each frame is stamped with its capture time and sequence number, taken
+    from the V4L2 buffer when the stream provides them and from the
+    monotonic clock and a running count otherwise.
     """
 
     stop: bool
 
-    def __init__(self, queues: List[queue.LifoQueue], stream: VideoCapture):
+    def __init__(self, frame_ring: FrameRing,
+                 stream: Union[VideoCapture, V4L2Capture, SyntheticCapture],
+                 frame_pool: FramePool, with_packets: bool = False):
         super().__init__()
         self._logger = logging.getLogger(__name__ + ".ReadThread")
         self._logger.info('Initializing ReadThread')
-        self._queues = queues
+        self._frame_ring = frame_ring
         self._stream = stream
+        self._frame_pool = frame_pool
+        self._with_packets = with_packets
         self._frames_read = 0
         self.stop = False
 
@@ -298,17 +529,33 @@ class ReadThread(QThread):
         while not self.stop:
             # self._logger.debug("loop")
             # success = True
-            success, frame = self._stream.read()
-            if success:
+            if self._with_packets:
+                self._read_packet()
+                continue
+            buffer = self._frame_pool.acquire()
+            success, image = self._stream.read(buffer)
+            if success and image is not None:
                 self._frames_read += 1
+                timestamp, sequence = frame_time(self._stream,
+                                                 self._frames_read)
                 # self._logger.debug("read frame %s", self._frames_read)
-                self._write_frame_to_queues(frame)
+                self._frame_ring.put(self._frame_pool.wrap(
+                        buffer, image, timestamp, sequence))
             else:
+                self._frame_pool.give_back(buffer)
                 self._logger.debug("could not read frame")
             # time.sleep(1 / self.fps)
             # continue
         self._logger.info('Finished reading')
 
-    def _write_frame_to_queues(self, frame: np.array):
-        for i_queue in self._queues:
-            i_queue.put(frame)
+    def _read_packet(self):
+        """Read a frame without decoding it."""
+        if not self._stream.grab():
+            self._logger.debug("could not read frame")
+            return
+        self._frames_read += 1
+        timestamp, sequence = frame_time(self._stream, self._frames_read)
+        # the buffer goes back to the driver on the next grab, so we need
+        # our own copy of it
+        packet = self._stream.retrieve_buffer().tobytes()
+        self._frame_ring.put(Frame(None, timestamp, sequence, packet))
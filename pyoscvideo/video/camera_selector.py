@@ -18,6 +18,7 @@
 # *****************************************************************************
 
 import logging
+import os
 import platform
 import subprocess
 import sys
@@ -27,11 +28,13 @@ from typing import Any, Dict, Type, Optional
 from PyQt5.QtCore import QObject, pyqtSignal
 
 from pyoscvideo.video.camera import Camera
+from pyoscvideo.video.camera_reader import VIRTUAL_BACKENDS
 
 if platform.system() == "Linux":
     from pyudev import Context, Device, Monitor, MonitorObserver
     import pyoscvideo.helpers.v4l2 as v4l2
     import fcntl
+    from pyoscvideo.video.capabilities import CapabilityCache
 else:
     # To keep type hint happy on other OSs
     Device = Monitor = MonitorObserver = Context = None
@@ -56,21 +59,26 @@ class BaseCameraSelector(QObject):
         super().__init__()
         self._logger = logging.getLogger(__name__+".CameraSelector")
 
-        self.camera_options = camera_options
+        # options of the selector itself, the rest is passed to the cameras
+        self.camera_options = dict(camera_options)
+        self._source_files = self.camera_options.pop("source_files", [])
+        self._synthetic_cameras = self.camera_options.pop(
+                "synthetic_cameras", 1)
         self.cameras = {}
 
         self.find_cameras()
 
-    def add_camera(self, device_id: int, name: str):
+    def add_camera(self, device_id: int, name: str, **options):
         """
-        Adds a camera to the list of known cameras.
+        Adds a camera to the list of known cameras, `options` override the
+        camera options.
         """
         self._logger.info(f"New camera added: {name} - {device_id}")
 
         self.cameras[device_id] = Camera(
                 device_id,
                 name,
-                **self.camera_options)
+                **dict(self.camera_options, **options))
 
         self.camera_added.emit(self.cameras[device_id])
 
@@ -114,11 +122,16 @@ class OSXCameraSelector(BaseCameraSelector):
 class LinuxCameraSelector(BaseCameraSelector):
     """
     Specialized camera selector for Linux operating system. Uses udev.
+
+    The formats, sizes and frame rates supported by each camera are
+    enumerated the first time it is seen and cached on disk, see
+    CapabilityCache.
     """
     def __init__(self, *args, **kwargs):
         # Sets up udev context so we can find cameras
         self._udev_ctx = Context()
         self._udev_observer = None
+        self._capability_cache = CapabilityCache()
 
         super().__init__(*args, **kwargs)
 
@@ -153,11 +166,27 @@ class LinuxCameraSelector(BaseCameraSelector):
             fcntl.ioctl(fd, v4l2.VIDIOC_QUERYCAP, cp)  # type: ignore
         return cp.device_caps & v4l2.V4L2_CAP_VIDEO_CAPTURE
 
+    @staticmethod
+    def _device_identity(device: Device) -> Optional[str]:
+        """
+        Get the USB vendor, product and serial number of {device}, None if
+        it has no vendor (e.g. a virtual device).
+        """
+        properties = device.properties
+        vendor = properties.get("ID_VENDOR_ID")
+        if not vendor:
+            return None
+        return ":".join([vendor, properties.get("ID_MODEL_ID", ""),
+                         properties.get("ID_SERIAL_SHORT", "")])
+
     def _add_camera(self, device: Device):
         self._logger.info(f"Device added: {device}")
+        capabilities = self._capability_cache.load(
+                self._device_identity(device), device.device_node)
         self.add_camera(
                 int(device.sys_number),
-                device.attributes.get("name").decode(sys.stdout.encoding))
+                device.attributes.get("name").decode(sys.stdout.encoding),
+                capabilities=capabilities)
 
     def _remove_camera(self, device: Device):
         self._logger.info(f"Device removed: {device}")
@@ -173,8 +202,35 @@ class LinuxCameraSelector(BaseCameraSelector):
                 self._add_camera(device)
 
 
+class VirtualCameraSelector(BaseCameraSelector):
+    """
+    Camera selector for the capture backends not needing a camera: one
+    camera per file in `source_files` for the "file" backend or
+    `synthetic_cameras` cameras for the "synthetic" one.
+    """
+    def find_cameras(self):
+        if self.camera_options.get("capture_backend") == "file":
+            for device_id, path in enumerate(self._source_files):
+                self.add_camera(device_id, os.path.basename(path),
+                                source=path)
+        else:
+            for device_id in range(self._synthetic_cameras):
+                self.add_camera(device_id, f"Synthetic {device_id}")
+
+
 CameraSelector: Type[BaseCameraSelector]
 if platform.system() == "Linux":
     CameraSelector = LinuxCameraSelector
 elif platform.system() == "Darwin":
     CameraSelector = OSXCameraSelector
+
+
+def create_camera_selector(camera_options: Dict[str, Any]
+                           ) -> BaseCameraSelector:
+    """
+    Create the camera selector for the operating system, or the virtual one
+    if the capture backend does not use cameras.
+    """
+    if camera_options.get("capture_backend") in VIRTUAL_BACKENDS:
+        return VirtualCameraSelector(camera_options)
+    return CameraSelector(camera_options)
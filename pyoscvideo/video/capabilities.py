@@ -0,0 +1,294 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+"""
+Supported formats, frame sizes and frame rates of V4L2 devices.
+
+The capabilities are enumerated with the VIDIOC_ENUM_FMT,
+VIDIOC_ENUM_FRAMESIZES and VIDIOC_ENUM_FRAMEINTERVALS ioctls and cached on
+disk keyed by the identity of the device (USB vendor, product and serial
+number), so they are only enumerated the first time a camera is seen.
+"""
+
+import errno
+import json
+import logging
+import os
+import struct
+import threading
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import pyoscvideo.helpers.v4l2 as v4l2
+
+from pyoscvideo.helpers.helpers import get_conf_dir
+from pyoscvideo.video.v4l2_capture import V4L2Device
+
+
+CACHE_FILENAME = "camera_capabilities.json"
+# Bump when the format of the cached capabilities changes
+CACHE_VERSION = 1
+
+_logger = logging.getLogger(__name__)
+
+
+def fourcc_to_str(fourcc: int) -> str:
+    return struct.pack("<I", int(fourcc)).decode("ascii", "replace")
+
+
+def str_to_fourcc(name: str) -> int:
+    return struct.unpack("<I", name.encode("ascii"))[0]
+
+
+def _fps(interval: v4l2.v4l2_fract) -> float:
+    if not interval.numerator:
+        return 0.0
+    return round(interval.denominator / interval.numerator, 3)
+
+
+class DeviceCapabilities:
+    """
+    The formats a device can capture in.
+
+    `formats` maps fourcc codes (e.g. "MJPG") to a dict with the
+    `description` of the format and its frame `sizes`. Each size is a
+    dict with either `width` and `height` and the supported frame rates as
+    a `fps` list (or a `fps_range`, [min, max], for continuous intervals),
+    or the `min_width`, `max_width`, `step_width`, ... of a stepwise range.
+    """
+    formats: Dict[str, Dict[str, Any]]
+
+    def __init__(self, formats: Dict[str, Dict[str, Any]]):
+        self.formats = formats
+
+    def validate(self, fourcc: Optional[int] = None,
+                 width: Optional[int] = None, height: Optional[int] = None,
+                 fps: Optional[float] = None) -> Optional[str]:
+        """
+        Check if the device can capture with the given settings, the ones
+        not given are not checked. Returns None if it can, or why not.
+        """
+        formats = self.formats
+        if fourcc is not None:
+            name = fourcc_to_str(fourcc)
+            if name not in self.formats:
+                return (f"Format {name} not supported, supported formats: "
+                        f"{', '.join(self.formats)}")
+            formats = {name: self.formats[name]}
+        if width is None or height is None:
+            return None
+
+        sizes = [size for fmt in formats.values() for size in fmt["sizes"]
+                 if self._size_matches(size, width, height)]
+        if not sizes:
+            supported = sorted({
+                (size["width"], size["height"]) if "width" in size else
+                (size["min_width"], size["min_height"],
+                 size["max_width"], size["max_height"])
+                for fmt in formats.values() for size in fmt["sizes"]})
+            supported_sizes = ", ".join(self._size_str(size)
+                                        for size in supported)
+            return (f"Size {width}x{height} not supported, supported "
+                    f"sizes: {supported_sizes}")
+        if fps is None or not fps:
+            return None
+
+        for size in sizes:
+            if "fps_range" in size:
+                if size["fps_range"][0] <= fps <= size["fps_range"][1]:
+                    return None
+            elif "fps" not in size or any(abs(rate - fps) < 0.01
+                                          for rate in size["fps"]):
+                return None
+        supported_rates = sorted({rate for size in sizes
+                                  for rate in size.get("fps", [])})
+        return (f"{fps} fps not supported at {width}x{height}, supported "
+                f"rates: {', '.join(str(rate) for rate in supported_rates)}")
+
+    def supported_format(self, width: Optional[int] = None,
+                         height: Optional[int] = None,
+                         fps: Optional[float] = None) -> Optional[str]:
+        """
+        Find a format the device can capture in with the given settings,
+        returns its fourcc name or None if there is none.
+        """
+        for name in self.formats:
+            if self.validate(str_to_fourcc(name), width, height, fps) is None:
+                return name
+        return None
+
+    @staticmethod
+    def _size_str(size: Tuple[int, ...]) -> str:
+        if len(size) == 2:
+            return f"{size[0]}x{size[1]}"
+        return f"{size[0]}x{size[1]} to {size[2]}x{size[3]}"
+
+    @staticmethod
+    def _size_matches(size: Dict[str, Any], width: int, height: int) -> bool:
+        if "width" in size:
+            return size["width"] == width and size["height"] == height
+        return (size["min_width"] <= width <= size["max_width"] and
+                size["min_height"] <= height <= size["max_height"] and
+                (width - size["min_width"]) % size["step_width"] == 0 and
+                (height - size["min_height"]) % size["step_height"] == 0)
+
+
+def _enumerate(device, request: int, struct_type, **fields) -> List[Any]:
+    """Run an enumeration ioctl with increasing indexes until EINVAL."""
+    results: List[Any] = []
+    index = 0
+    while True:
+        item = struct_type()
+        item.index = index
+        for name, value in fields.items():
+            setattr(item, name, value)
+        try:
+            device.ioctl(request, item)
+        except OSError as err:
+            if err.errno != errno.EINVAL:
+                raise
+            return results
+        results.append(item)
+        index += 1
+
+
+def _enumerate_intervals(device, pixel_format: int, width: int,
+                         height: int) -> Dict[str, Any]:
+    intervals = _enumerate(device, v4l2.VIDIOC_ENUM_FRAMEINTERVALS,
+                           v4l2.v4l2_frmivalenum, pixel_format=pixel_format,
+                           width=width, height=height)
+    if not intervals:
+        return {}
+    if intervals[0].type == v4l2.V4L2_FRMIVAL_TYPE_DISCRETE:
+        return {"fps": [_fps(ival.discrete) for ival in intervals]}
+    stepwise = intervals[0].stepwise
+    # the longest interval is the lowest frame rate
+    return {"fps_range": [_fps(stepwise.max), _fps(stepwise.min)]}
+
+
+def enumerate_capabilities(device) -> DeviceCapabilities:
+    """
+    Enumerate the capabilities of a device implementing the V4L2Device
+    protocol.
+    """
+    formats: Dict[str, Dict[str, Any]] = {}
+    for fmtdesc in _enumerate(device, v4l2.VIDIOC_ENUM_FMT,
+                              v4l2.v4l2_fmtdesc,
+                              type=v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE):
+        pixel_format = fmtdesc.pixelformat
+        sizes: List[Dict[str, Any]] = []
+        for frmsize in _enumerate(device, v4l2.VIDIOC_ENUM_FRAMESIZES,
+                                  v4l2.v4l2_frmsizeenum,
+                                  pixel_format=pixel_format):
+            if frmsize.type == v4l2.V4L2_FRMSIZE_TYPE_DISCRETE:
+                width = frmsize.discrete.width
+                height = frmsize.discrete.height
+                size: Dict[str, Any] = {"width": width, "height": height}
+                size.update(_enumerate_intervals(device, pixel_format,
+                                                 width, height))
+                sizes.append(size)
+            else:
+                stepwise = frmsize.stepwise
+                sizes.append({
+                    field[0]: getattr(stepwise, field[0]) for field in
+                    v4l2.v4l2_frmsize_stepwise._fields_})
+                break
+        formats[fourcc_to_str(pixel_format)] = {
+            "description": fmtdesc.description.decode(errors="replace"),
+            "sizes": sizes,
+        }
+    return DeviceCapabilities(formats)
+
+
+class CapabilityCache:
+    """
+    Capabilities of the devices seen so far, stored as JSON in the
+    configuration directory.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self._path = path or os.path.join(get_conf_dir(), CACHE_FILENAME)
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, Any]] = None
+
+    def _load(self) -> Dict[str, Any]:
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self._path) as cache_file:
+                    data = json.load(cache_file)
+                if data.get("version") == CACHE_VERSION:
+                    self._entries = data["devices"]
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError) as err:
+                _logger.warning(f"Ignoring capability cache: {err}")
+        return self._entries
+
+    def get(self, key: str) -> Optional[DeviceCapabilities]:
+        with self._lock:
+            formats = self._load().get(key)
+        if formats is None:
+            return None
+        return DeviceCapabilities(formats)
+
+    def put(self, key: str, capabilities: DeviceCapabilities) -> None:
+        with self._lock:
+            entries = self._load()
+            entries[key] = capabilities.formats
+            try:
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+                tmp_path = self._path + ".tmp"
+                with open(tmp_path, "w") as cache_file:
+                    json.dump({"version": CACHE_VERSION, "devices": entries},
+                              cache_file, indent=1)
+                os.replace(tmp_path, self._path)
+            except OSError as err:
+                _logger.warning(f"Could not write capability cache: {err}")
+
+    def load(self, key: Optional[str], device_path: str
+             ) -> Optional[DeviceCapabilities]:
+        """
+        Get the capabilities of a device from the cache, enumerating and
+        caching them if not known yet. Devices without an identity (key
+        None) are enumerated every time.
+        """
+        capabilities = self.get(key) if key is not None else None
+        if capabilities is not None:
+            return capabilities
+
+        try:
+            device = V4L2Device(device_path)
+        except OSError as err:
+            _logger.warning(f"Could not open {device_path}: {err}")
+            return None
+        try:
+            capabilities = enumerate_capabilities(device)
+        except OSError as err:
+            _logger.warning(
+                    f"Could not enumerate capabilities of {device_path}: "
+                    f"{err}")
+            return None
+        finally:
+            device.close()
+        _logger.info(f"Enumerated capabilities of {device_path}: "
+                     f"{', '.join(capabilities.formats)}")
+        if key is not None:
+            self.put(key, capabilities)
+        return capabilities
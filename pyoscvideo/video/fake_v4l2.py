@@ -0,0 +1,180 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+"""
+In-memory V4L2 device, to run V4L2Capture without a camera, see
+tests/test_v4l2_capture.py.
+"""
+
+import collections
+import errno
+import mmap
+import time
+import numpy as np
+import cv2
+
+from typing import Any, Callable, Deque, Dict, List
+
+import pyoscvideo.helpers.v4l2 as v4l2
+
+
+class FakeV4L2Device:
+    """
+    Stand-in for a V4L2Device, implementing the ioctls used by
+    V4L2Capture on anonymous memory maps.
+
+    Any size and pixel format is accepted as asked for. A buffer is filled
+    with the next frame when it is dequeued: a JPEG image for MJPEG, bytes
+    of the same value for other formats, the value being the frame number
+    modulo 256. The ioctl requests are recorded in `requests` and the
+    indexes of the buffers held by the driver in `queued`, so the use of
+    the device can be checked.
+    """
+    requests: List[int]
+    queued: Deque[int]
+    streaming: bool
+    closed: bool
+
+    def __init__(self, width: int = 640, height: int = 480,
+                 pixelformat: int = v4l2.V4L2_PIX_FMT_MJPEG,
+                 fps: float = 30.0):
+        self._pix = v4l2.v4l2_pix_format()
+        self._fps = fps
+        self._buffers: List[mmap.mmap] = []
+        self._sequence = 0
+        self._apply_format(width, height, pixelformat)
+        self._handlers: Dict[int, Callable[[Any], None]] = {
+            v4l2.VIDIOC_QUERYCAP: self._querycap,
+            v4l2.VIDIOC_G_FMT: self._g_fmt,
+            v4l2.VIDIOC_S_FMT: self._s_fmt,
+            v4l2.VIDIOC_G_PARM: self._g_parm,
+            v4l2.VIDIOC_S_PARM: self._s_parm,
+            v4l2.VIDIOC_REQBUFS: self._reqbufs,
+            v4l2.VIDIOC_QUERYBUF: self._querybuf,
+            v4l2.VIDIOC_QBUF: self._qbuf,
+            v4l2.VIDIOC_DQBUF: self._dqbuf,
+            v4l2.VIDIOC_STREAMON: self._streamon,
+            v4l2.VIDIOC_STREAMOFF: self._streamoff,
+        }
+        self.requests = []
+        self.queued = collections.deque()
+        self.streaming = False
+        self.closed = False
+
+    def ioctl(self, request: int, arg: Any) -> None:
+        self.requests.append(request)
+        handler = self._handlers.get(request)
+        if handler is None:
+            raise OSError(errno.ENOTTY, "Inappropriate ioctl for device")
+        handler(arg)
+
+    def mmap(self, length: int, offset: int) -> mmap.mmap:
+        return self._buffers[offset // self._pix.sizeimage]
+
+    def wait(self, timeout: float) -> bool:
+        return self.streaming and bool(self.queued)
+
+    def close(self) -> None:
+        self.closed = True
+
+    def _apply_format(self, width: int, height: int,
+                      pixelformat: int) -> None:
+        self._pix.width = width
+        self._pix.height = height
+        self._pix.pixelformat = pixelformat
+        self._pix.field = v4l2.V4L2_FIELD_NONE
+        self._pix.bytesperline = (0 if pixelformat == v4l2.V4L2_PIX_FMT_MJPEG
+                                  else width * 2)
+        self._pix.sizeimage = width * height * 2
+
+    def _querycap(self, cap: v4l2.v4l2_capability) -> None:
+        cap.driver = b"fake"
+        cap.capabilities = cap.device_caps = (v4l2.V4L2_CAP_VIDEO_CAPTURE |
+                                              v4l2.V4L2_CAP_STREAMING)
+
+    def _g_fmt(self, fmt: v4l2.v4l2_format) -> None:
+        fmt.fmt.pix = self._pix
+
+    def _s_fmt(self, fmt: v4l2.v4l2_format) -> None:
+        if self._buffers:
+            raise OSError(errno.EBUSY, "Device or resource busy")
+        self._apply_format(fmt.fmt.pix.width, fmt.fmt.pix.height,
+                           fmt.fmt.pix.pixelformat)
+        fmt.fmt.pix = self._pix
+
+    def _g_parm(self, parm: v4l2.v4l2_streamparm) -> None:
+        parm.parm.capture.timeperframe.numerator = 1000
+        parm.parm.capture.timeperframe.denominator = int(self._fps * 1000)
+
+    def _s_parm(self, parm: v4l2.v4l2_streamparm) -> None:
+        timeperframe = parm.parm.capture.timeperframe
+        if timeperframe.numerator:
+            self._fps = timeperframe.denominator / timeperframe.numerator
+        self._g_parm(parm)
+
+    def _reqbufs(self, req: v4l2.v4l2_requestbuffers) -> None:
+        if self.streaming:
+            raise OSError(errno.EBUSY, "Device or resource busy")
+        self._buffers = [mmap.mmap(-1, self._pix.sizeimage)
+                         for _ in range(req.count)]
+
+    def _querybuf(self, buf: v4l2.v4l2_buffer) -> None:
+        self._check_index(buf)
+        buf.length = self._pix.sizeimage
+        buf.m.offset = buf.index * self._pix.sizeimage
+
+    def _qbuf(self, buf: v4l2.v4l2_buffer) -> None:
+        self._check_index(buf)
+        if buf.index in self.queued:
+            raise OSError(errno.EINVAL, f"Buffer {buf.index} already queued")
+        self.queued.append(buf.index)
+
+    def _dqbuf(self, buf: v4l2.v4l2_buffer) -> None:
+        if not self.streaming or not self.queued:
+            raise OSError(errno.EAGAIN, "Resource temporarily unavailable")
+        buf.index = self.queued.popleft()
+        data = self._next_frame()
+        self._buffers[buf.index][:len(data)] = data
+        buf.bytesused = len(data)
+        buf.sequence = self._sequence
+        now = time.monotonic()
+        buf.timestamp.secs = int(now)
+        buf.timestamp.usecs = int((now % 1) * 1e6)
+        buf.flags = v4l2.V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC
+        self._sequence += 1
+
+    def _streamon(self, buf_type: Any) -> None:
+        self.streaming = True
+
+    def _streamoff(self, buf_type: Any) -> None:
+        self.streaming = False
+        self.queued.clear()
+
+    def _check_index(self, buf: v4l2.v4l2_buffer) -> None:
+        if buf.index >= len(self._buffers):
+            raise OSError(errno.EINVAL, f"No buffer {buf.index}")
+
+    def _next_frame(self) -> bytes:
+        """Get the content of the next frame."""
+        value = self._sequence % 256
+        if self._pix.pixelformat == v4l2.V4L2_PIX_FMT_MJPEG:
+            image = np.full((self._pix.height, self._pix.width, 3), value,
+                            dtype=np.uint8)
+            return cv2.imencode(".jpg", image)[1].tobytes()
+        return bytes([value]) * self._pix.sizeimage
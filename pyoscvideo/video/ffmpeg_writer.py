@@ -0,0 +1,219 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import collections
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import numpy as np
+
+from typing import IO, Deque, Dict, List, Optional, Tuple
+
+
+# Pixel format of the encoded video for the codecs needing one other than
+# the BGR of the raw frames to be widely playable
+_PIXEL_FORMATS = {
+    "libx264": "yuv420p",
+    "libx265": "yuv420p",
+    "mjpeg": "yuvj420p",
+}
+
+# Seconds to wait for ffmpeg to finish the file after the last frame
+RELEASE_TIMEOUT = 30.0
+
+# Number of lines of ffmpeg's error output kept for the failure message
+_ERROR_LINES = 20
+
+# Seconds to wait for ffmpeg to encode the frame of a muxing check
+CHECK_TIMEOUT = 10.0
+
+# Results of check_muxing() by binary, encoder and file extension
+_muxing_checks: Dict[Tuple[str, str, str], Optional[str]] = {}
+_muxing_lock = threading.Lock()
+
+
+def check_muxing(codec: str, extension: str,
+                 binary: str = "ffmpeg") -> Optional[str]:
+    """
+    Check if ffmpeg can store the output of the `codec` encoder in a file
+    with the given extension (e.g. FFV1 can't go in an MP4 file), by
+    encoding a blank frame into a temporary file. Returns None if it can,
+    or why not.
+
+    Which pairs work depends on the version of ffmpeg, so it is asked
+    rather than told, once per pair.
+    """
+    key = (binary, codec, extension.lower())
+    with _muxing_lock:
+        if key not in _muxing_checks:
+            _muxing_checks[key] = _run_muxing_check(*key)
+        return _muxing_checks[key]
+
+
+def _run_muxing_check(binary: str, codec: str, extension: str
+                      ) -> Optional[str]:
+    fd, path = tempfile.mkstemp(suffix=extension)
+    os.close(fd)
+    try:
+        result = subprocess.run(
+                [binary, "-hide_banner", "-loglevel", "error", "-y",
+                 "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", "64x64",
+                 "-i", "pipe:0", "-c:v", codec, path],
+                input=bytes(64 * 64 * 3), capture_output=True,
+                timeout=CHECK_TIMEOUT)
+    except OSError as err:
+        return f"Could not start {binary}: {err}"
+    except subprocess.TimeoutExpired:
+        # slow to start, not a reason to refuse it
+        return None
+    finally:
+        os.remove(path)
+    if result.returncode == 0:
+        return None
+    errors = result.stderr.decode(errors="replace").strip().splitlines()
+    return errors[0] if errors else f"ffmpeg failed ({result.returncode})"
+
+
+class FFmpegWriter:
+    """
+    Writer encoding in an ffmpeg subprocess.
+
+    The raw BGR images are streamed to ffmpeg through a pipe, so encoding
+    happens outside of our process, on as many cores as the encoder uses.
+    Mimics the subset of the cv2.VideoWriter interface used by the writer
+    threads (write, isOpened and release).
+
+    `codec` is the name of the ffmpeg encoder, e.g. "libx264" (use with
+    `preset` "ultrafast" for a cheap compact output), "ffv1" (lossless,
+    for archival) or "mjpeg". `threads` is the number of encoder threads,
+    0 letting ffmpeg decide, and `options` any further output options,
+    e.g. ["-crf", "18"].
+
+    The error output of ffmpeg is read by a thread of its own, so a chatty
+    encoder can't fill the pipe and stall, and logged as it comes.
+
+    Encoders ffmpeg can't store in a file of the given extension are
+    refused, see check_muxing(), the writer is then not opened.
+    """
+
+    def __init__(self, filename: str, fps: float, size: Tuple[int, int],
+                 codec: str = "libx264", preset: Optional[str] = None,
+                 threads: int = 0, pix_fmt: Optional[str] = None,
+                 options: Optional[List[str]] = None,
+                 binary: str = "ffmpeg"):
+        self._logger = logging.getLogger(__name__ + ".FFmpegWriter")
+        self._filename = filename
+        self._size = size
+        self._frame_bytes = size[0] * size[1] * 3
+
+        command = [binary, "-hide_banner", "-loglevel", "error", "-y",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24",
+                   "-s", f"{size[0]}x{size[1]}", "-r", str(fps),
+                   "-i", "pipe:0", "-c:v", codec]
+        if preset:
+            command += ["-preset", preset]
+        if threads:
+            command += ["-threads", str(threads)]
+        pix_fmt = pix_fmt or _PIXEL_FORMATS.get(codec)
+        if pix_fmt:
+            command += ["-pix_fmt", pix_fmt]
+        command += list(options or []) + [filename]
+
+        self._process: Optional[subprocess.Popen] = None
+        self._errors: Deque[str] = collections.deque(maxlen=_ERROR_LINES)
+        self._error_thread: Optional[threading.Thread] = None
+        error = check_muxing(codec, os.path.splitext(filename)[1], binary)
+        if error is not None:
+            self._logger.error(f"Can't write {codec} to {filename}: {error}")
+            return
+        try:
+            self._process = subprocess.Popen(
+                    command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as err:
+            self._logger.error(f"Could not start {binary}: {err}")
+            return
+        self._error_thread = threading.Thread(
+                target=self._read_errors, args=(self._process.stderr,),
+                daemon=True)
+        self._error_thread.start()
+        self._logger.info(f"Encoding with: {' '.join(command)}")
+
+    def _read_errors(self, stream: IO[bytes]) -> None:
+        """Log the error output of ffmpeg until it exits."""
+        for line in iter(stream.readline, b""):
+            text = line.decode(errors="replace").strip()
+            if text:
+                self._errors.append(text)
+                self._logger.warning(f"ffmpeg: {text}")
+        stream.close()
+
+    def isOpened(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def write(self, image: np.ndarray) -> None:
+        """Send a BGR image of the configured size to the encoder."""
+        if self._process is None:
+            return
+        data = np.ascontiguousarray(image)
+        if data.nbytes != self._frame_bytes:
+            self._logger.warning(
+                    f"Dropping image of shape {image.shape}, expected "
+                    f"{self._size}")
+            return
+        try:
+            # the GIL is released while blocked on the pipe
+            assert self._process.stdin is not None
+            self._process.stdin.write(data.data)
+        except (BrokenPipeError, ValueError):
+            self._logger.error("ffmpeg exited, can't write frames")
+            self._finish()
+
+    def _finish(self) -> int:
+        """Close the pipe and wait for ffmpeg, returns its exit code."""
+        assert self._process is not None
+        process = self._process
+        self._process = None
+        assert process.stdin is not None
+        try:
+            # ends the input of ffmpeg
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            process.wait(timeout=RELEASE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self._logger.error("ffmpeg did not finish, killing it")
+            process.kill()
+            process.wait()
+        if self._error_thread is not None:
+            self._error_thread.join()
+        if process.returncode:
+            errors = " ".join(self._errors)
+            self._logger.error(
+                    f"ffmpeg failed ({process.returncode}): {errors}")
+        return process.returncode
+
+    def release(self) -> None:
+        """Wait for ffmpeg to finish the file."""
+        if self._process is None:
+            return
+        if self._finish() == 0:
+            self._logger.info(f"Finished {self._filename}")
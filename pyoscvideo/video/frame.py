@@ -0,0 +1,177 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import struct
+import numpy as np
+import cv2
+
+from typing import Any, Optional, Tuple
+
+
+# Scales at which libjpeg can decode natively, largest reduction first
+_REDUCED_MODES = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                  (4, cv2.IMREAD_REDUCED_COLOR_4),
+                  (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# Start of frame markers, they hold the size of the image
+_SOF_MARKERS = frozenset((0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+                          0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf))
+
+
+def jpeg_size(packet: bytes) -> Optional[Tuple[int, int]]:
+    """Get the (width, height) of a JPEG image from its headers."""
+    offset = 2
+    while offset + 9 <= len(packet):
+        if packet[offset] != 0xff:
+            return None
+        marker = packet[offset + 1]
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", packet, offset + 5)
+            return width, height
+        length, = struct.unpack_from(">H", packet, offset + 2)
+        offset += 2 + length
+    return None
+
+
+def _reduced_scale(size: Tuple[int, int], min_size: Tuple[int, int]
+                   ) -> Tuple[int, int]:
+    """
+    Get the largest scale reduction of `size` that is still at least
+    `min_size` large, and the imread mode decoding at it.
+    """
+    for scale, reduced_mode in _REDUCED_MODES:
+        if (size[0] // scale >= min_size[0] and
+                size[1] // scale >= min_size[1]):
+            return scale, reduced_mode
+    return 1, cv2.IMREAD_COLOR
+
+
+def reduced_size(size: Tuple[int, int],
+                 min_size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Get the size a JPEG image of `size` is decoded at by decode_jpeg()
+    for `min_size`.
+    """
+    scale, _ = _reduced_scale(size, min_size)
+    # libjpeg rounds the scaled size up
+    return -(-size[0] // scale), -(-size[1] // scale)
+
+
+def decode_jpeg(packet: bytes,
+                min_size: Optional[Tuple[int, int]] = None
+                ) -> Optional[np.ndarray]:
+    """
+    Decode a JPEG image to BGR, returns None if it is corrupt.
+
+    If `min_size` is given the image is decoded at the smallest scale
+    supported by the decoder (1/2, 1/4 or 1/8) that is still at least that
+    large, which is a lot cheaper than decoding at full size and resizing.
+    """
+    mode = cv2.IMREAD_COLOR
+    if min_size is not None:
+        size = jpeg_size(packet)
+        if size is not None:
+            _, mode = _reduced_scale(size, min_size)
+    return cv2.imdecode(np.frombuffer(packet, dtype=np.uint8), mode)
+
+
+class Frame:
+    """
+    A frame captured by the CameraReader.
+
+    Holds the decoded image and, when the capture backend delivers
+    compressed data (MJPEG from the v4l2 backend), the original compressed
+    packet so it can be stored without being encoded again.
+
+    Frames can be created with just the packet, the image is then decoded
+    on demand: at full size the first time `image` is used, or at a
+    reduced scale for consumers needing less with decoded().
+
+    `timestamp` is the capture time in seconds on the time.monotonic()
+    clock, taken from the driver when available. `sequence` is the frame
+    number given by the driver, or a running count of frames read; gaps
+    in it mean frames were lost before reaching us. Frames captured by a
+    SynchronizedCapture also carry the `capture_index` of the set of
+    frames grabbed together from all cameras.
+
+    Frames read into buffers of a FramePool are reference counted: every
+    holder calls release() when done with it so the image buffer can be
+    reused. For frames not coming from a pool retain()/release() do
+    nothing.
+    """
+    __slots__ = ("_image", "_reduced", "packet", "timestamp", "sequence",
+                 "capture_index", "pool", "refs")
+
+    packet: Optional[bytes]
+    timestamp: float
+    sequence: int
+    capture_index: Optional[int]
+    pool: Optional[Any]
+    refs: int
+
+    def __init__(self, image: Optional[np.ndarray], timestamp: float,
+                 sequence: int, packet: Optional[bytes] = None):
+        self._image = image
+        self._reduced: Optional[np.ndarray] = None
+        self.packet = packet
+        self.timestamp = timestamp
+        self.sequence = sequence
+        self.capture_index = None
+        self.pool = None
+        self.refs = 1
+
+    @property
+    def image(self) -> Optional[np.ndarray]:
+        """
+        Get the full size image, None if the packet could not be decoded.
+        """
+        if self._image is None and self.packet is not None:
+            self._image = decode_jpeg(self.packet)
+        return self._image
+
+    def decoded(self, min_size: Tuple[int, int]) -> Optional[np.ndarray]:
+        """
+        Get an image at least `min_size` large, but possibly smaller than
+        the full one, see decode_jpeg().
+
+        The largest image decoded this way is kept, outputs of a recording
+        asking for the same or a smaller size share it (see Resizer).
+        """
+        if self._image is not None or self.packet is None:
+            return self._image
+        reduced = self._reduced
+        if (reduced is not None and reduced.shape[1] >= min_size[0] and
+                reduced.shape[0] >= min_size[1]):
+            return reduced
+        image = decode_jpeg(self.packet, min_size)
+        if image is not None and (reduced is None or
+                                  image.shape[0] > reduced.shape[0]):
+            self._reduced = image
+        return image
+
+    def retain(self) -> 'Frame':
+        """Take a new reference to the frame."""
+        if self.pool is not None:
+            self.pool.retain(self)
+        return self
+
+    def release(self) -> None:
+        """Drop a reference, the image must not be used afterwards."""
+        if self.pool is not None:
+            self.pool.release(self)
@@ -0,0 +1,133 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import threading
+import numpy as np
+
+from typing import Any, Dict, List, Optional
+
+from pyoscvideo.video.frame import Frame
+
+
+# Number of idle buffers kept around, anything above is left to the GC
+DEFAULT_MAX_FREE = 4
+
+
+class FramePool:
+    """
+    Pool of image buffers recycled by the ReadThread.
+
+    The ReadThread decodes every frame into a buffer taken from the pool
+    (see VideoCapture.read(image=...)) instead of allocating a new array.
+    The frames created with `wrap()` are reference counted: the FrameRing
+    holds one reference while the frame is in one of its slots and each
+    consumer holds one from RingCursor.get() until it calls
+    Frame.release(). Once the last reference is gone the buffer goes back
+    to the pool.
+    """
+
+    def __init__(self, max_free: int = DEFAULT_MAX_FREE):
+        self._max_free = max_free
+        self._free: List[np.ndarray] = []
+        self._lock = threading.Lock()
+        self._allocated = 0
+        self._in_use = 0
+        self._reused = 0
+
+    def acquire(self) -> Optional[np.ndarray]:
+        """
+        Get an idle buffer, or None if there is none and the reader should
+        allocate a new one.
+        """
+        with self._lock:
+            if not self._free:
+                return None
+            self._in_use += 1
+            return self._free.pop()
+
+    def give_back(self, buffer: Optional[np.ndarray]) -> None:
+        """Return a buffer taken with acquire() but not used for a frame."""
+        if buffer is not None:
+            with self._lock:
+                self._in_use -= 1
+                self._recycle(buffer)
+
+    def wrap(self, buffer: Optional[np.ndarray], image: np.ndarray,
+             timestamp: float, sequence: int,
+             packet: Optional[bytes] = None) -> Frame:
+        """
+        Create a frame for an image read into `buffer`.
+
+        If the stream did not use the buffer (e.g. the frame size changed)
+        it is given back, and `image` is taken over by the pool when it
+        owns its memory. Frames holding views over memory we don't own are
+        not reference counted.
+        """
+        with self._lock:
+            if image is not buffer:
+                if buffer is not None:
+                    self._in_use -= 1
+                    self._recycle(buffer)
+                if not image.flags.owndata:
+                    return Frame(image, timestamp, sequence, packet)
+                self._allocated += 1
+                self._in_use += 1
+            else:
+                self._reused += 1
+        frame = Frame(image, timestamp, sequence, packet)
+        frame.pool = self
+        return frame
+
+    def retain(self, frame: Frame) -> None:
+        with self._lock:
+            frame.refs += 1
+
+    def release(self, frame: Frame) -> None:
+        with self._lock:
+            frame.refs -= 1
+            if frame.refs > 0:
+                return
+            self._in_use -= 1
+            if frame.image is not None:
+                self._recycle(frame.image)
+        frame.pool = None
+
+    def _recycle(self, buffer: np.ndarray) -> None:
+        # buffers of a different size than the current ones are useless
+        if self._free and self._free[0].shape != buffer.shape:
+            self._allocated -= len(self._free)
+            self._free = []
+        if len(self._free) < self._max_free:
+            self._free.append(buffer)
+        else:
+            self._allocated -= 1
+
+    @property
+    def statistics(self) -> Dict[str, Any]:
+        """
+        Get the pool occupancy: buffers allocated, in use by frames, idle,
+        and the number of reads served with a recycled buffer.
+        """
+        with self._lock:
+            return {
+                "allocated": self._allocated,
+                "in_use": self._in_use,
+                "free": len(self._free),
+                "reused": self._reused,
+            }
@@ -0,0 +1,188 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import threading
+
+from typing import List, Optional, Tuple
+
+from pyoscvideo.video.frame import Frame
+
+
+DEFAULT_CAPACITY = 8
+
+
+class FrameRing:
+    """
+    Fixed capacity ring of frame slots, written by a single producer (the
+    ReadThread) and read by any number of consumers.
+
+    Each consumer reads through its own RingCursor. Old frames are
+    overwritten by new ones, so memory is bounded by the capacity no
+    matter how far behind a consumer falls.
+
+    The ring takes over the reference of the frames put in it and drops it
+    when they are overwritten. Frames handed out by latest(), snapshot(),
+    frames_since() and the RingCursor are retained for the caller, who has
+    to release them when done.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self._capacity = capacity
+        self._slots: List[Optional[Frame]] = [None] * capacity
+        self._count = 0
+        self._condition = threading.Condition()
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def count(self) -> int:
+        """Get the total number of frames put in the ring."""
+        return self._count
+
+    def put(self, frame: Frame) -> None:
+        """Store a new frame, overwriting the oldest one."""
+        with self._condition:
+            index = self._count % self._capacity
+            old = self._slots[index]
+            self._slots[index] = frame
+            self._count += 1
+            self._condition.notify_all()
+        if old is not None:
+            old.release()
+
+    def latest(self) -> Optional[Frame]:
+        """Get the most recent frame, if any."""
+        return self.snapshot()[1]
+
+    def snapshot(self) -> Tuple[int, Optional[Frame]]:
+        """Get the frame count and the most recent frame atomically."""
+        with self._condition:
+            if self._count == 0:
+                return 0, None
+            frame = self._slots[(self._count - 1) % self._capacity]
+            if frame is not None:
+                # retain while the slot can't be overwritten
+                frame.retain()
+            return self._count, frame
+
+    def frames_since(self, position: int) -> Tuple[int, List[Frame]]:
+        """
+        Get the frame count and the frames put after `position` which are
+        still in the ring, oldest first.
+        """
+        with self._condition:
+            start = max(position, self._count - self._capacity)
+            frames = [self._slots[index % self._capacity]
+                      for index in range(start, self._count)]
+            retained = [frame.retain() for frame in frames
+                        if frame is not None]
+            return self._count, retained
+
+    def cursor(self, include_latest: bool = False,
+               position: Optional[int] = None) -> 'RingCursor':
+        """
+        Create a cursor for a new consumer.
+
+        The cursor will only return frames put after its creation unless
+        `include_latest` is set, in which case the most recent frame is
+        returned first, or a `position` is given to continue from, e.g.
+        the position of another cursor.
+        """
+        if position is None:
+            position = self._count
+            if include_latest and position > 0:
+                position -= 1
+        return RingCursor(self, position)
+
+    def wait(self, position: int, timeout: Optional[float]) -> bool:
+        """
+        Wait until there is a frame after `position`, returns False on
+        timeout.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._count > position,
+                                            timeout)
+
+    def clear(self) -> None:
+        """Drop all the frames held by the ring."""
+        with self._condition:
+            frames = self._slots
+            self._slots = [None] * self._capacity
+        for frame in frames:
+            if frame is not None:
+                frame.release()
+
+
+class RingCursor:
+    """
+    Read position of a consumer in a FrameRing.
+
+    get() always returns the most recent frame, the frames in between are
+    counted as skipped. get_new() returns all the frames since the last
+    call instead, only those already overwritten are skipped.
+    """
+    frames_skipped: int
+    position: int
+
+    def __init__(self, ring: FrameRing, position: int):
+        self._ring = ring
+        self.position = position
+        self.frames_skipped = 0
+
+    @property
+    def pending(self) -> int:
+        """Number of frames put in the ring since the last get()."""
+        return self._ring.count - self.position
+
+    def _wait(self, timeout: Optional[float]) -> bool:
+        if self.pending > 0:
+            return True
+        if timeout is not None and timeout <= 0:
+            return False
+        return self._ring.wait(self.position, timeout)
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Frame]:
+        """
+        Get the most recent frame, waiting up to `timeout` seconds for one
+        if there is no new frame. Returns None on timeout.
+
+        The frame is retained, call release() on it once done.
+        """
+        if not self._wait(timeout):
+            return None
+        count, frame = self._ring.snapshot()
+        self.frames_skipped += count - self.position - 1
+        self.position = count
+        return frame
+
+    def get_new(self, timeout: Optional[float] = None) -> List[Frame]:
+        """
+        Get the frames put in the ring since the last call, oldest first,
+        waiting up to `timeout` seconds if there is none yet.
+
+        The frames are retained, call release() on each once done.
+        """
+        if not self._wait(timeout):
+            return []
+        count, frames = self._ring.frames_since(self.position)
+        self.frames_skipped += count - self.position - len(frames)
+        self.position = count
+        return frames
@@ -21,14 +21,88 @@
 
 import logging
 import queue
+import threading
 import time
 import os
 
-from typing import Dict, Any, Type
+from concurrent.futures import ThreadPoolExecutor
+from typing import (Callable, Dict, Any, Iterable, List, Optional, Tuple,
+                    Type)
 from PyQt5.QtCore import QObject, pyqtSignal
 
+from pyoscvideo.helpers.helpers import monotonic_to_wall_time
 from pyoscvideo.video.camera import Camera
-from pyoscvideo.video.camera_selector import CameraSelector, BaseCameraSelector
+from pyoscvideo.video.camera_selector import (
+    BaseCameraSelector,
+    create_camera_selector)
+from pyoscvideo.video.synchronized_capture import SynchronizedCapture
+
+
+def open_cameras(cameras: Iterable[Camera]) -> Dict[Camera, bool]:
+    """
+    Open the sources of the cameras concurrently, returns whether each
+    camera could be opened.
+
+    Opening a USB camera and reading its first frame can take a second or
+    two, opening them one after the other makes the start up time grow
+    with the number of cameras.
+    """
+    cameras = list(cameras)
+    if not cameras:
+        return {}
+    logger = logging.getLogger(__name__)
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(cameras)) as executor:
+        results = dict(zip(cameras,
+                           executor.map(lambda c: c.open_source(), cameras)))
+    logger.info(f"Opened {len(cameras)} cameras in "
+                f"{time.monotonic() - start_time:.3f}s")
+    for camera in cameras:
+        timings = ", ".join(f"{phase} {seconds:.3f}s"
+                            for phase, seconds in camera.open_timings.items())
+        logger.info(f"{camera.name}: {timings}")
+    return results
+
+
+def run_on_cameras(cameras: Iterable[Camera],
+                   action: Callable[[Camera], Any]) -> Dict[Camera, Any]:
+    """
+    Call `action` for all cameras concurrently, returns the result for
+    each camera.
+
+    The calls are held back by a barrier until there is a thread ready for
+    every camera, so they are made at the same moment instead of one after
+    the other. Stopping the recordings then takes as long as the slowest
+    camera needs to finish writing, rather than the sum of all of them.
+    """
+    cameras = list(cameras)
+    if not cameras:
+        return {}
+    barrier = threading.Barrier(len(cameras))
+
+    def run(camera: Camera) -> Any:
+        barrier.wait()
+        return action(camera)
+
+    with ThreadPoolExecutor(max_workers=len(cameras)) as executor:
+        return dict(zip(cameras, executor.map(run, cameras)))
+
+
+def recording_skew(recording_infos: List[Dict[str, Any]]
+                   ) -> Dict[str, float]:
+    """
+    Get the spread between the cameras of the times their recordings were
+    triggered, and of the capture times of their first and last frames.
+    """
+    skew = {}
+    for name, key in (("trigger_skew", "trigger_time"),
+                      ("first_frame_skew", "first_timestamp"),
+                      ("last_frame_skew", "last_timestamp")):
+        times = [info[key] for info in recording_infos
+                 if info.get(key) is not None]
+        if len(times) > 1:
+            skew[name] = max(times) - min(times)
+    return skew
 
 
 def _generate_filename():
@@ -43,6 +117,9 @@ class VideoManager(QObject):
     of the software and dealing with multiple cameras.
 
     Most methods will pass on the call for each camera in use.
+
+    Cameras configured with `synchronized_capture` capture in lockstep,
+    driven by a single SynchronizedCapture for all those in use.
     """
     is_recording_changed = pyqtSignal(bool)
     is_capturing_changed = pyqtSignal(bool)
@@ -61,8 +138,11 @@ class VideoManager(QObject):
         self._is_capturing = False
         self._status_msg = ''
         self._recording_dir = None
+        self._synchronized_capture: Optional[SynchronizedCapture] = None
+        self._recording_skew: Dict[str, float] = {}
+        self._last_metrics: Dict[Camera, Tuple[Dict[str, Any], float]] = {}
 
-        self.camera_selector = CameraSelector(camera_options)
+        self.camera_selector = create_camera_selector(camera_options)
 
     @property
     def is_capturing(self):
@@ -107,6 +187,8 @@ class VideoManager(QObject):
             camera_count = self._cameras.get(camera, 0)
             self._cameras[camera] = camera_count + 1
             self._logger.info(f"Using camera {camera.name}.")
+            if camera_count == 0:
+                self._restart_synchronized_capture()
             success, resolution = camera.check_frame_size()
             if not success:
                 self.status_msg = (
@@ -134,8 +216,10 @@ class VideoManager(QObject):
         if camera_count <= 1:
             self._logger.info(
                 f"Camera {camera.name} is not used anymore, stop capturing.")
+            self._stop_synchronized_capture()
             camera.stop_capturing()
             del self._cameras[camera]
+            self._restart_synchronized_capture()
             if not self._cameras:
                 self.is_capturing = False
             return
@@ -148,13 +232,36 @@ class VideoManager(QObject):
 
     def start_capturing(self) -> bool:
         """
-        Starts capturing for each of the tracked cameras.
+        Starts capturing for each of the tracked cameras, opening them
+        concurrently.
         """
+        open_cameras(self._cameras)
         for camera in self._cameras:
             if not camera.start_capturing():
                 return False
+        self._restart_synchronized_capture()
         return True
 
+    def _restart_synchronized_capture(self):
+        """
+        Start capturing in lockstep from the cameras in use configured for
+        synchronized capture.
+        """
+        self._stop_synchronized_capture()
+        cameras = [camera for camera in self._cameras
+                   if camera.synchronized_reader is not None]
+        if not cameras:
+            return
+        self._synchronized_capture = SynchronizedCapture(
+                [camera.synchronized_reader for camera in cameras])
+        self._synchronized_capture.start()
+
+    def _stop_synchronized_capture(self):
+        if self._synchronized_capture is not None:
+            self._synchronized_capture.stop = True
+            self._synchronized_capture.wait()
+            self._synchronized_capture = None
+
     def prepare_recording(self, filename) -> bool:
         """
         Prepares the recording.
@@ -217,27 +324,92 @@ class VideoManager(QObject):
             self.stop_recording()
             self.new_recording(filename)
 
-    def start_recording(self) -> bool:
+    def start_recording(self, start_time: Optional[float] = None) -> bool:
         """Starts recording.
 
+        The cameras are started at the same moment, see run_on_cameras().
+        With a `start_time` (on the time.monotonic() clock) every camera
+        starts with the frame captured closest to it, no matter when they
+        are started.
+
         TODO: add return values
         """
-        for camera in self._cameras:
-            if not camera.start_recording():
-                return False
+        if self._synchronized_capture is not None:
+            # the statistics are written for the recording only
+            self._synchronized_capture.reset_statistics()
+        results = run_on_cameras(
+                self._cameras, lambda camera: camera.start_recording(
+                    start_time))
+        if not all(results.values()):
+            return False
         self.is_recording = True
         return True
 
     def stop_recording(self):
-        """Stop the recording and print out statistics.
+        """Stop the recording of all cameras at the same moment and print
+        out statistics.
 
         TODO: add return values
         """
+        # only the stop is concurrent, the threads for the next recording
+        # are started from this thread
+        run_on_cameras(self._cameras,
+                       lambda camera: camera.stop_recording(rearm=False))
         for camera in self._cameras:
-            camera.stop_recording()
+            camera.rearm()
+        self._recording_skew = recording_skew(
+                [camera.recording_info for camera in self._cameras])
+        for name, seconds in self._recording_skew.items():
+            self._logger.info(f"{name}: {seconds * 1000:.2f}ms")
         self._write_recording_statistics()
         self.is_recording = False
 
+    def pipeline_metrics(self) -> List[Dict[str, Any]]:
+        """
+        Get the health of the pipeline of each camera in use: the capture
+        and encoder frame rates and the disk write rate in bytes per second
+        since the previous call, the frames waiting for the encoder (in
+        total, in the overflow file and in seconds of video) and the frames
+        skipped and repeated in the recording so far.
+
+        Not thread-safe, meant to be called periodically by a single
+        thread, which must not run other commands concurrently (see
+        OSCInterface._collect_metrics()).
+        """
+        now = time.monotonic()
+        metrics = []
+        cameras = list(self._cameras)
+        for camera in list(self._last_metrics):
+            if camera not in cameras:
+                # no longer in use, start over if it is used again
+                del self._last_metrics[camera]
+        for camera in cameras:
+            counters = camera.metrics
+            previous, previous_time = self._last_metrics.get(
+                    camera, ({}, now))
+            self._last_metrics[camera] = (counters, now)
+
+            def rate(key: str) -> float:
+                if now <= previous_time or key not in previous:
+                    return 0.0
+                return max(0, counters.get(key, 0) -
+                           previous[key]) / (now - previous_time)
+
+            queue_depth = counters.get("queue_depth", 0)
+            metrics.append({
+                "camera": camera.name,
+                "capture_fps": rate("frames_read"),
+                "written_fps": rate("frames_encoded"),
+                "queue_depth": queue_depth,
+                "spill_depth": counters.get("spill_depth", 0),
+                "frames_skipped": counters.get("frames_skipped", 0),
+                "frames_repeated": counters.get("frames_repeated", 0),
+                "encoder_backlog": (queue_depth / camera.recording_fps
+                                    if camera.recording_fps else 0.0),
+                "disk_write_rate": rate("bytes_written"),
+            })
+        return metrics
+
     def _write_recording_statistics(self):
         path = os.path.join(self._recording_dir, "statistics.txt")
         with open(path, "w") as stats_file:
@@ -250,12 +422,79 @@ class VideoManager(QObject):
                     f"\tRecording time: {camera_stats['time']:.1f}s\n",
                     f"\tTotal frames: {camera_stats['frames']}\n",
                     f"\tRepeated frames: {camera_stats['frames_repeated']}\n",
-                    "\n"])
+                    f"\tSkipped frames: "
+                    f"{camera_stats.get('frames_skipped', 0)}\n",
+                    f"\tFrames lost in capture: "
+                    f"{camera_stats.get('frames_dropped', 0)}\n"])
+                latency = camera_stats.get('start_latency')
+                if latency is not None:
+                    stats_file.write(
+                        f"\tTrigger to first frame: {latency * 1000:.1f}ms\n")
+                error = camera_stats.get('start_error')
+                if error is not None:
+                    stats_file.write(
+                        f"\tScheduled start error: {error * 1000:+.1f}ms\n")
+                first = camera_stats.get('first_timestamp')
+                last = camera_stats.get('last_timestamp')
+                trigger = camera_stats.get('trigger_time')
+                if first is not None and trigger is not None:
+                    stats_file.write(
+                        f"\tFirst frame captured "
+                        f"{(first - trigger) * 1000:+.1f}ms from the "
+                        f"trigger\n")
+                if first is not None and last is not None:
+                    stats_file.writelines([
+                        f"\tFirst frame captured at: "
+                        f"{monotonic_to_wall_time(first):.6f}\n",
+                        f"\tLast frame captured at: "
+                        f"{monotonic_to_wall_time(last):.6f}\n"])
+                if 'queue_max_depth' in camera_stats:
+                    stats_file.writelines([
+                        f"\tMost frames waiting for the encoder: "
+                        f"{camera_stats['queue_max_depth']}\n",
+                        f"\tMost frames in the overflow file: "
+                        f"{camera_stats['spill_max_depth']}\n",
+                        f"\tFrames spilled: {camera_stats['frames_spilled']} "
+                        f"({camera_stats['bytes_spilled'] / 2**20:.1f}MB)\n",
+                        f"\tTime blocked on a full queue: "
+                        f"{camera_stats['queue_blocked_time']:.1f}s\n"])
+                for proxy in camera_stats.get('proxies', []):
+                    stats_file.write(
+                        f"\tProxy {proxy['name']} {proxy['resolution']}: "
+                        f"{proxy['frames']} frames, "
+                        f"{proxy['frames_repeated']} repeated\n")
+                pool = camera_stats.get('frame_pool')
+                if pool:
+                    stats_file.write(
+                        f"\tFrame buffers: {pool.get('allocated', 0)} "
+                        f"allocated, {pool.get('reused', 0)} reads into "
+                        f"recycled buffers\n")
+                stats_file.write("\n")
+            if self._recording_skew:
+                stats_file.write("Skew between cameras:\n")
+                for name, label in (("trigger_skew", "Trigger"),
+                                    ("first_frame_skew", "First frame"),
+                                    ("last_frame_skew", "Last frame")):
+                    if name in self._recording_skew:
+                        stats_file.write(
+                            f"\t{label}: "
+                            f"{self._recording_skew[name] * 1000:.2f}ms\n")
+                stats_file.write("\n")
+            if self._synchronized_capture is not None:
+                sync_stats = self._synchronized_capture.statistics
+                stats_file.writelines([
+                    "Synchronized capture:\n",
+                    f"\tFrame sets: {sync_stats['sets']}\n",
+                    f"\tSets missing a camera: "
+                    f"{sync_stats['sets_incomplete']}\n",
+                    f"\tMean skew: {sync_stats['mean_skew'] * 1000:.2f}ms\n",
+                    f"\tMax skew: {sync_stats['max_skew'] * 1000:.2f}ms\n"])
 
     def cleanup(self):
         """Perform necessary action to guarantee a clean exit of the app."""
         if self.is_recording:
             self.stop_recording()
 
+        self._stop_synchronized_capture()
         for camera in self._cameras:
             camera.cleanup()
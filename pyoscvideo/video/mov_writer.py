@@ -0,0 +1,237 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import logging
+import struct
+import cv2
+
+from array import array
+from typing import Any, List, Optional, Tuple
+
+
+# Media timescale, fine enough to represent any frame rate we might use
+TIMESCALE = 90000
+MOVIE_TIMESCALE = 1000
+
+_MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def _atom(kind: bytes, *payload: bytes) -> bytes:
+    body = b"".join(payload)
+    return struct.pack(">I", len(body) + 8) + kind + body
+
+
+def _full_atom(kind: bytes, flags: int, *payload: bytes) -> bytes:
+    return _atom(kind, struct.pack(">I", flags), *payload)
+
+
+def _pascal_string(value: str, length: Optional[int] = None) -> bytes:
+    encoded = value.encode()
+    data = bytes([len(encoded)]) + encoded
+    if length is not None:
+        data = data.ljust(length, b"\x00")
+    return data
+
+
+class MovWriter:
+    """
+    Minimal QuickTime (.mov) muxer for Motion JPEG samples.
+
+    Stores already compressed JPEG images in the container as they are,
+    without decoding or re-encoding them. Mimics the subset of the
+    cv2.VideoWriter interface used by the writer threads (write, isOpened
+    and release).
+
+    The sample table is kept in memory and the movie header is written on
+    release(), just like cv2.VideoWriter does.
+
+    Samples written with write_at() last until the next one, so the movie
+    keeps the real timing of a variable frame rate capture.
+    """
+
+    def __init__(self, filename: str, fps: float, size: Tuple[int, int]):
+        self._logger = logging.getLogger(__name__ + ".MovWriter")
+        self._filename = filename
+        self._size = size
+        self._frame_duration = int(round(TIMESCALE / fps))
+
+        self._sizes = array("I")
+        self._offsets = array("Q")
+        self._durations = array("I")
+        self._last_timestamp: Optional[float] = None
+
+        self._file: Optional[Any] = None
+        try:
+            self._file = open(filename, "wb")
+        except OSError as err:
+            self._logger.error(f"Could not open {filename}: {err}")
+            return
+
+        self._file.write(_atom(b"ftyp", b"qt  ", struct.pack(">I", 0x200),
+                               b"qt  "))
+        # 64 bit mdat header, its size is filled in on release()
+        self._mdat_offset = self._file.tell()
+        self._file.write(struct.pack(">I4sQ", 1, b"mdat", 0))
+
+    def isOpened(self) -> bool:
+        return self._file is not None
+
+    @property
+    def frames_written(self) -> int:
+        return len(self._sizes)
+
+    def write(self, packet: Any, duration: Optional[int] = None) -> None:
+        """
+        Append a JPEG image (bytes or a uint8 numpy array) to the movie.
+        Decoded images (arrays of more than one dimension) are encoded to
+        JPEG first.
+
+        `duration` is given in TIMESCALE units and defaults to the duration
+        of one frame at the configured frame rate.
+        """
+        if self._file is None:
+            return
+        if getattr(packet, "ndim", 1) > 1:
+            success, packet = cv2.imencode(".jpg", packet)
+            if not success:
+                self._logger.warning("Could not encode frame")
+                return
+        self._offsets.append(self._file.tell())
+        self._file.write(packet)
+        self._sizes.append(memoryview(packet).nbytes)
+        self._durations.append(
+                self._frame_duration if duration is None else duration)
+
+    def repeat(self) -> bool:
+        """
+        Show the last image written with write() for one more frame. The
+        new sample points to the data already in the file, nothing is
+        encoded or stored again. Returns False if there is no such image.
+        """
+        if (self._file is None or not self._sizes or
+                len(self._durations) < len(self._sizes)):
+            return False
+        self._offsets.append(self._offsets[-1])
+        self._sizes.append(self._sizes[-1])
+        self._durations.append(self._frame_duration)
+        return True
+
+    def write_at(self, packet: Any, timestamp: float) -> None:
+        """
+        Append an image captured at `timestamp` seconds, see write(). It
+        is shown until the image written next.
+        """
+        frames = len(self._sizes)
+        self.write(packet, 0)
+        if len(self._sizes) == frames:
+            return
+        # the duration of an image is known once the next one comes
+        self._durations.pop()
+        if self._last_timestamp is not None:
+            self._durations.append(max(1, int(round(
+                    (timestamp - self._last_timestamp) * TIMESCALE))))
+        self._last_timestamp = timestamp
+
+    def release(self) -> None:
+        """Finalize the movie, writing the sample tables."""
+        if self._file is None:
+            return
+        if len(self._durations) < len(self._sizes):
+            # the last image written with write_at()
+            self._durations.append(self._frame_duration)
+        end = self._file.tell()
+        self._file.seek(self._mdat_offset + 8)
+        self._file.write(struct.pack(">Q", end - self._mdat_offset))
+        self._file.seek(end)
+        self._file.write(self._moov())
+        self._file.close()
+        self._file = None
+        self._logger.info(
+                f"Wrote {len(self._sizes)} frames to {self._filename}")
+
+    def _moov(self) -> bytes:
+        media_duration = sum(self._durations)
+        movie_duration = media_duration * MOVIE_TIMESCALE // TIMESCALE
+        width, height = self._size
+
+        mvhd = _full_atom(
+                b"mvhd", 0,
+                struct.pack(">IIIIIH10x", 0, 0, MOVIE_TIMESCALE,
+                            movie_duration, 0x10000, 0x100),
+                _MATRIX,
+                struct.pack(">7I", 0, 0, 0, 0, 0, 0, 2))
+        tkhd = _full_atom(
+                b"tkhd", 0xf,
+                struct.pack(">IIIIIQHHHH", 0, 0, 1, 0, movie_duration,
+                            0, 0, 0, 0, 0),
+                _MATRIX,
+                struct.pack(">II", width << 16, height << 16))
+        mdhd = _full_atom(
+                b"mdhd", 0,
+                struct.pack(">IIIIHH", 0, 0, TIMESCALE, media_duration, 0, 0))
+        hdlr = _full_atom(b"hdlr", 0, b"mhlrvide", bytes(12),
+                          _pascal_string("VideoHandler"))
+        minf = _atom(
+                b"minf",
+                _full_atom(b"vmhd", 1, struct.pack(">HHHH", 0x40, 0, 0, 0)),
+                _full_atom(b"hdlr", 0, b"dhlralis", bytes(12),
+                           _pascal_string("DataHandler")),
+                _atom(b"dinf", _full_atom(
+                    b"dref", 0, struct.pack(">I", 1),
+                    _full_atom(b"alis", 1))),
+                self._stbl())
+        trak = _atom(b"trak", tkhd, _atom(b"mdia", mdhd, hdlr, minf))
+        return _atom(b"moov", mvhd, trak)
+
+    def _stbl(self) -> bytes:
+        width, height = self._size
+        sample_entry = _atom(
+                b"jpeg",
+                bytes(6), struct.pack(">H", 1),
+                struct.pack(">HHIII", 0, 0, 0, 0, 0x200),
+                struct.pack(">HHIIIH", width, height, 72 << 16, 72 << 16,
+                            0, 1),
+                _pascal_string("Photo - JPEG", 32),
+                struct.pack(">Hh", 24, -1))
+        stsd = _full_atom(b"stsd", 0, struct.pack(">I", 1), sample_entry)
+
+        # run length encoded sample durations
+        runs: List[List[int]] = []
+        for duration in self._durations:
+            if runs and runs[-1][1] == duration:
+                runs[-1][0] += 1
+            else:
+                runs.append([1, duration])
+        stts = _full_atom(
+                b"stts", 0, struct.pack(">I", len(runs)),
+                b"".join(struct.pack(">II", *run) for run in runs))
+
+        # one sample per chunk
+        stsc = _full_atom(b"stsc", 0, struct.pack(">IIII", 1, 1, 1, 1))
+
+        sizes = array("I", self._sizes)
+        offsets = array("Q", self._offsets)
+        if struct.pack("=I", 1) != struct.pack(">I", 1):
+            sizes.byteswap()
+            offsets.byteswap()
+        stsz = _full_atom(b"stsz", 0, struct.pack(">II", 0, len(sizes)),
+                          sizes.tobytes())
+        co64 = _full_atom(b"co64", 0, struct.pack(">I", len(offsets)),
+                          offsets.tobytes())
+        return _atom(b"stbl", stsd, stts, stsc, stsz, co64)
@@ -0,0 +1,268 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+"""
+Pacing of captured frames into a constant frame rate output.
+
+The output is a sequence of slots, one every 1 / fps seconds starting at
+the capture time of the first frame. Each slot gets the frame captured
+closest to its time, so frames are repeated when the camera is slower than
+the output and skipped when it is faster. Deadlines are absolute times on
+the time.monotonic_ns() clock the capture timestamps are on, so an
+oversleep delays a single decision but never shifts the following slots.
+
+Running this module simulates the pacing on a VirtualClock, checking its
+accuracy for a given capture and output frame rate faster than real time:
+
+    python -m pyoscvideo.video.pacing --capture-fps 30 --recording-fps 25
+"""
+
+import argparse
+import random
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from pyoscvideo.video.frame import Frame
+
+
+def _ns(seconds: float) -> int:
+    return round(seconds * 1e9)
+
+
+class MonotonicClock:
+    """The clock of the capture timestamps, in nanoseconds."""
+
+    @staticmethod
+    def now_ns() -> int:
+        return time.monotonic_ns()
+
+
+class VirtualClock:
+    """Clock only advancing when told to, for simulating the pacing."""
+
+    def __init__(self, start_ns: int = 0):
+        self._now_ns = start_ns
+
+    def now_ns(self) -> int:
+        return self._now_ns
+
+    def advance_to(self, time_ns: int) -> None:
+        self._now_ns = max(self._now_ns, time_ns)
+
+
+# Gets the frames captured since the last call, waiting up to the given
+# timeout in seconds for one, see RingCursor.get_new()
+FrameSource = Callable[[float], List[Frame]]
+
+
+class FramePacer:
+    """
+    Chooses the frame for each slot of a constant frame rate output.
+
+    The decision for a slot is taken as soon as a frame captured at or
+    after its time arrives, any later frame can only be further from it.
+    If none arrives, it is taken one frame duration after the slot time
+    with the frames at hand.
+
+    The frames taken from the source are held as candidates until a frame
+    captured after them is chosen, the ones never chosen are counted in
+    `frames_skipped`. Slots getting the same frame as the previous one are
+    counted in `frames_repeated`.
+    """
+    frames_repeated: int
+    frames_skipped: int
+
+    def __init__(self, fps: float,
+                 clock: Union[MonotonicClock, VirtualClock, None] = None):
+        self._duration_ns = _ns(1. / fps)
+        self._clock = clock or MonotonicClock()
+        self._candidates: List[Frame] = []
+        self._first_ns = 0
+        self._slot = 0
+        self._last: Optional[Frame] = None
+        self.frames_repeated = 0
+        self.frames_skipped = 0
+
+    @property
+    def slot_ns(self) -> int:
+        """Get the time of the current slot."""
+        return self._first_ns + self._slot * self._duration_ns
+
+    def start(self, frames: List[Frame], backlog: bool = False) -> Frame:
+        """
+        Start the output with the most recent of `frames` in its first
+        slot, the others are skipped.
+
+        With `backlog` the output starts with the oldest frame instead and
+        the others are candidates for the following slots, which are then
+        decided without waiting.
+        """
+        if backlog:
+            first = frames[0]
+            self._candidates = list(frames)
+        else:
+            *older, first = frames
+            for frame in older:
+                frame.release()
+            self.frames_skipped += len(older)
+            self._candidates = [first]
+        self._first_ns = _ns(first.timestamp)
+        self._slot = 0
+        self._last = first
+        return first
+
+    def next_slot_after(self, timestamp: float) -> bool:
+        """Check if the next slot is later than `timestamp`."""
+        return self.slot_ns + self._duration_ns > _ns(timestamp)
+
+    def next_frame(self, source: FrameSource) -> Frame:
+        """
+        Wait for the decision on the next slot and get its frame. It is
+        the same frame as before when repeated.
+        """
+        assert self._last is not None, "start() not called"
+        self._slot += 1
+        slot_ns = self.slot_ns
+        deadline_ns = slot_ns + self._duration_ns
+        while _ns(self._candidates[-1].timestamp) < slot_ns:
+            remaining_ns = deadline_ns - self._clock.now_ns()
+            if remaining_ns <= 0:
+                # late, decide with the frames captured by now
+                self._candidates.extend(source(0))
+                break
+            self._candidates.extend(source(remaining_ns / 1e9))
+
+        chosen = min(range(len(self._candidates)),
+                     key=lambda i: abs(_ns(self._candidates[i].timestamp) -
+                                       slot_ns))
+        for frame in self._candidates[:chosen]:
+            if frame is not self._last:
+                self.frames_skipped += 1
+            frame.release()
+        del self._candidates[:chosen]
+        frame = self._candidates[0]
+        if frame is self._last:
+            self.frames_repeated += 1
+        self._last = frame
+        return frame
+
+    def clear(self) -> None:
+        """Drop the candidate frames."""
+        for frame in self._candidates:
+            frame.release()
+        self._candidates = []
+
+
+class SimulatedSource:
+    """
+    Frames captured at `capture_fps`, with gaussian `jitter` and delivered
+    `latency` seconds after their capture, on a VirtualClock.
+    """
+
+    def __init__(self, clock: VirtualClock, capture_fps: float,
+                 duration: float, jitter: float = 0.0,
+                 latency: float = 0.005, seed: int = 0):
+        rng = random.Random(seed)
+        self._clock = clock
+        timestamps = sorted(
+                index / capture_fps + rng.gauss(0, jitter) if jitter else
+                index / capture_fps
+                for index in range(int(duration * capture_fps)))
+        self._pending: List[Tuple[int, Frame]] = [
+                (_ns(timestamp + latency), Frame(None, timestamp, index))
+                for index, timestamp in enumerate(timestamps)]
+        self.end_ns = _ns(timestamps[-1]) if timestamps else 0
+
+    def get_new(self, timeout: float) -> List[Frame]:
+        """Advance the clock until a frame arrives or `timeout` passes."""
+        deadline_ns = self._clock.now_ns() + _ns(timeout)
+        if self._pending and self._pending[0][0] <= deadline_ns:
+            self._clock.advance_to(self._pending[0][0])
+        else:
+            self._clock.advance_to(deadline_ns)
+        arrived = [frame for arrival_ns, frame in self._pending
+                   if arrival_ns <= self._clock.now_ns()]
+        del self._pending[:len(arrived)]
+        return arrived
+
+
+def simulate(capture_fps: float, recording_fps: float,
+             duration: float = 60.0, jitter: float = 0.0,
+             latency: float = 0.005, seed: int = 0) -> Dict[str, Any]:
+    """
+    Run a FramePacer on simulated frames, see SimulatedSource.
+
+    Returns the number of slots, frames repeated and skipped, and the
+    mean and maximum error between the time of the slots and the capture
+    time of their frames and delay of the decisions, in seconds.
+    """
+    clock = VirtualClock()
+    source = SimulatedSource(clock, capture_fps, duration, jitter, latency,
+                             seed)
+    pacer = FramePacer(recording_fps, clock)
+    frames = source.get_new(1.0)
+    assert frames, "no frames to pace"
+    pacer.start(frames)
+    errors: List[float] = []
+    delays: List[float] = []
+    # the slots after the last capture would only repeat it
+    while pacer.slot_ns + _ns(1. / recording_fps) <= source.end_ns:
+        frame = pacer.next_frame(source.get_new)
+        errors.append(abs(frame.timestamp - pacer.slot_ns / 1e9))
+        delays.append((clock.now_ns() - pacer.slot_ns) / 1e9)
+    pacer.clear()
+    return {
+        "slots": len(errors) + 1,
+        "frames_repeated": pacer.frames_repeated,
+        "frames_skipped": pacer.frames_skipped,
+        "mean_error": sum(errors) / len(errors),
+        "max_error": max(errors),
+        "mean_delay": sum(delays) / len(delays),
+        "max_delay": max(delays),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Simulate the frame pacing faster than real time")
+    parser.add_argument("--capture-fps", type=float, default=30.0)
+    parser.add_argument("--recording-fps", type=float, default=25.0)
+    parser.add_argument("--duration", type=float, default=60.0,
+                        help="Seconds of capture to simulate")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Standard deviation of the capture times")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="Delay between capture and delivery")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    start_time = time.monotonic()
+    results = simulate(args.capture_fps, args.recording_fps, args.duration,
+                       args.jitter, args.latency, args.seed)
+    elapsed = time.monotonic() - start_time
+    print(f"Simulated {args.duration:.0f}s in {elapsed:.3f}s")
+    for key, value in results.items():
+        if isinstance(value, float):
+            print(f"{key}: {value * 1000:.3f}ms")
+        else:
+            print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import collections
+import logging
+import threading
+
+from typing import Deque, List, Tuple
+
+from PyQt5.QtCore import QThread
+
+from pyoscvideo.video.frame import Frame
+from pyoscvideo.video.frame_ring import FrameRing
+
+
+# Memory the frames of a pre-roll buffer may take at most
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def frame_bytes(frame: Frame) -> int:
+    """Get the memory taken by a frame, its packet if it has one."""
+    if frame.packet is not None:
+        return len(frame.packet)
+    image = frame.image
+    return image.nbytes if image is not None else 0
+
+
+class PreRollBuffer(QThread):
+    """
+    Thread keeping the frames of the last `seconds` of capture, so a
+    recording can start with the moments before it was triggered.
+
+    Frames are dropped once older than `seconds` or when the buffer would
+    take more than `max_bytes`. Frames delivered as compressed packets are
+    kept as such, which takes a fraction of the memory of decoded images.
+
+    take() stops the thread and hands the frames over to the writer along
+    with the position in the ring to continue reading from, so no frame is
+    lost or written twice in between. It doesn't wait for the thread to
+    finish, to not hold up the start of the recording.
+    """
+
+    def __init__(self, frame_ring: FrameRing, seconds: float,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + ".PreRollBuffer")
+        self._frame_ring = frame_ring
+        self._cursor = frame_ring.cursor()
+        self._seconds = seconds
+        self._max_bytes = max_bytes
+        self._frames: Deque[Tuple[Frame, int]] = collections.deque()
+        self._bytes = 0
+        # held while taking frames from the ring, see take()
+        self._lock = threading.RLock()
+        self._stop = False
+
+    @property
+    def duration(self) -> float:
+        """Get the time between the oldest and newest frame held."""
+        with self._lock:
+            if not self._frames:
+                return 0.0
+            return self._frames[-1][0].timestamp - self._frames[0][0].timestamp
+
+    def _add(self, frames: List[Frame]):
+        with self._lock:
+            for frame in frames:
+                size = frame_bytes(frame)
+                self._frames.append((frame, size))
+                self._bytes += size
+            if not self._frames:
+                return
+            oldest = self._frames[-1][0].timestamp - self._seconds
+            while self._frames and (self._frames[0][0].timestamp < oldest or
+                                    self._bytes > self._max_bytes):
+                frame, size = self._frames.popleft()
+                self._bytes -= size
+                frame.release()
+
+    def run(self):
+        self._logger.info(f"Keeping the last {self._seconds}s of frames")
+        while not self._stop:
+            self._frame_ring.wait(self._cursor.position, 0.1)
+            with self._lock:
+                if self._stop:
+                    break
+                self._add(self._cursor.get_new(timeout=0))
+
+    def take(self) -> Tuple[List[Frame], int]:
+        """
+        Stop buffering and get the frames held, oldest first, and the
+        position in the ring of the frames following them. The caller
+        takes over the references to the frames.
+
+        The thread ends by itself shortly after, wait() for it before
+        dropping the buffer.
+        """
+        with self._lock:
+            self._stop = True
+            # the frames put since the thread last looked
+            self._add(self._cursor.get_new(timeout=0))
+            frames = [frame for frame, _ in self._frames]
+            self._frames.clear()
+            self._bytes = 0
+            position = self._cursor.position
+        self._logger.info(f"Handing over {len(frames)} frames")
+        return frames, position
+
+    def stop(self):
+        """Stop buffering and drop the frames held."""
+        for frame in self.take()[0]:
+            frame.release()
+        self.wait()
@@ -0,0 +1,176 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import logging
+import os
+import threading
+import cv2
+import numpy as np
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from pyoscvideo.video.frame import Frame
+
+
+INTERPOLATIONS = {
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "cubic": cv2.INTER_CUBIC,
+    "area": cv2.INTER_AREA,
+}
+
+# Number of destination buffers allocated up front
+DEFAULT_BUFFERS = 4
+
+_shared_executor: Optional[ThreadPoolExecutor] = None
+_shared_lock = threading.Lock()
+
+
+def shared_executor(workers: int = 0) -> ThreadPoolExecutor:
+    """
+    Get the thread pool resizing the frames of all cameras, created with
+    `workers` threads (0 for one per CPU, up to 8) on first use. OpenCV
+    releases the GIL while decoding and resizing, so they run in parallel.
+    """
+    global _shared_executor
+    with _shared_lock:
+        if _shared_executor is None:
+            workers = workers or min(8, os.cpu_count() or 1)
+            logging.getLogger(__name__).info(
+                    f"Starting {workers} resize workers")
+            _shared_executor = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix="resize")
+        return _shared_executor
+
+
+class ResizeJob:
+    """
+    Image of a frame being decoded and resized for recording, see
+    Resizer.submit(). result() waits for it, returning None if the frame
+    could not be decoded. Has the `nbytes` of the final image, like an
+    array, for the write queue accounting.
+    """
+
+    def __init__(self, future: Future, nbytes: int):
+        self._future = future
+        self.nbytes = nbytes
+
+    def result(self) -> Optional[np.ndarray]:
+        return self._future.result()
+
+
+class Resizer:
+    """
+    Decodes and resizes the frames of one recording to `size` in the
+    shared pool, off the pacing loop of the WriteThread.
+
+    The images are written into destination buffers recycled with
+    give_back() once written, instead of allocating a new array for every
+    frame. Images already in the recording size are not copied: the frame
+    is kept until its image is given back.
+
+    Compressed frames are decoded for `decode_size`, by default `size`.
+    Outputs of a camera in several sizes all decode for the largest one,
+    so each frame is decoded once and the smaller outputs are scaled down
+    from that image (see Frame.decoded()).
+    """
+
+    def __init__(self, size: Tuple[int, int], interpolation: str = "linear",
+                 workers: int = 0, buffers: int = DEFAULT_BUFFERS,
+                 decode_size: Optional[Tuple[int, int]] = None):
+        self._logger = logging.getLogger(__name__ + ".Resizer")
+        self._size = size
+        self._decode_size = decode_size or size
+        if interpolation not in INTERPOLATIONS:
+            self._logger.warning(
+                    f"Unknown interpolation {interpolation}, using linear")
+            interpolation = "linear"
+        self._interpolation = INTERPOLATIONS[interpolation]
+        self._executor = shared_executor(workers)
+        self._shape = (size[1], size[0], 3)
+        self._max_free = buffers
+        self._free: List[np.ndarray] = [
+                np.empty(self._shape, np.uint8) for _ in range(buffers)]
+        # frames whose images were handed out as they are, by image id
+        self._held: Dict[int, List[Frame]] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, frame: Frame) -> ResizeJob:
+        """
+        Start resizing the image of a frame, the job holds a reference to
+        the frame until done.
+        """
+        frame.retain()
+        future = self._executor.submit(self._resize, frame)
+        return ResizeJob(future, int(np.prod(self._shape)))
+
+    def _resize(self, frame: Frame) -> Optional[np.ndarray]:
+        try:
+            image = frame.decoded(self._decode_size)
+            if image is None:
+                return None
+            if image.shape == self._shape:
+                with self._lock:
+                    self._held.setdefault(id(image), []).append(
+                            frame.retain())
+                return image
+            buffer = self._acquire()
+            cv2.resize(image, self._size, dst=buffer,
+                       interpolation=self._interpolation)
+            return buffer
+        finally:
+            frame.release()
+
+    def warm_up(self) -> None:
+        """
+        Resize a blank image in the pool, so its threads are running and
+        OpenCV is initialized before the first frame comes.
+        """
+        source = np.zeros((self._decode_size[1], self._decode_size[0], 3),
+                          np.uint8)
+        self._executor.submit(
+                cv2.resize, source, self._size,
+                interpolation=self._interpolation).result()
+
+    def _acquire(self) -> np.ndarray:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return np.empty(self._shape, np.uint8)
+
+    def give_back(self, image: np.ndarray) -> None:
+        """
+        Recycle the image of a job once written, or release the frame it
+        belongs to. Arrays that are not ours (e.g. read back from the
+        overflow file) are ignored.
+        """
+        if image.shape != self._shape:
+            return
+        with self._lock:
+            frames = self._held.get(id(image))
+            if not frames:
+                if (image.flags.writeable and
+                        len(self._free) < self._max_free):
+                    self._free.append(image)
+                return
+            frame = frames.pop()
+            if not frames:
+                del self._held[id(image)]
+        frame.release()
@@ -0,0 +1,215 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import glob
+import json
+import logging
+import os
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+
+def segment_filename(filename: str, index: int) -> str:
+    """Get the name of a segment, e.g. camera_0_003.mov for camera_0.mov"""
+    base, extension = os.path.splitext(filename)
+    return f"{base}_{index:03d}{extension}"
+
+
+INDEX_EXTENSION = ".segments.json"
+
+
+def index_filename(filename: str) -> str:
+    """Get the name of the index of the segments of a recording."""
+    return os.path.splitext(filename)[0] + INDEX_EXTENSION
+
+
+def read_index(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Read the index of the segments of a recording, see SegmentedWriter,
+    returns None if it can't be read.
+    """
+    try:
+        with open(path) as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+
+class SegmentedWriter:
+    """
+    Writer splitting a recording into files of `segment_duration` seconds.
+
+    Each segment is written by a writer of its own, created by
+    `open_writer` with the name of the segment (see segment_filename()).
+    The writer of the next segment is opened ahead of time and finished
+    segments are released in a helper thread, so switching to the next
+    segment doesn't hold up writing.
+
+    Segments are complete files as soon as they are finished, so a crash
+    only loses the segment being written. The index file (see
+    index_filename()) lists the finished segments and is updated after
+    each one. It also lists the files of the segments not finished yet,
+    the one being written and the one opened ahead, as `unfinished`: a
+    crash leaves them without a valid header, the index tells them apart
+    from orphans.
+
+    Images written with write() count as one frame at `fps`, the ones
+    written with write_at() are split by their capture time.
+    """
+
+    def __init__(self, filename: str, open_writer: Callable[[str], Any],
+                 fps: float, segment_duration: float):
+        self._logger = logging.getLogger(__name__ + ".SegmentedWriter")
+        self._filename = filename
+        self._open_writer = open_writer
+        self._fps = fps
+        self._segment_duration = segment_duration
+        self._segment_frames = max(1, int(round(segment_duration * fps)))
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._segments: List[Dict[str, Any]] = []
+        self._unfinished: List[str] = []
+
+        self._index = 0
+        self._current = open_writer(segment_filename(filename, 0))
+        self._unfinished.append(
+                os.path.basename(segment_filename(filename, 0)))
+        self._next: Optional[Future] = self._executor.submit(
+                self._open_ahead, segment_filename(filename, 1))
+        self._frames = 0
+        self._total_frames = 0
+        self._first_timestamp: Optional[float] = None
+        self._segment_timestamp: Optional[float] = None
+
+    def isOpened(self) -> bool:
+        return self._current is not None and self._current.isOpened()
+
+    def write(self, image: Any) -> None:
+        if self._frames >= self._segment_frames:
+            self._rotate()
+        self._current.write(image)
+        self._frames += 1
+
+    def repeat(self) -> bool:
+        """
+        Repeat the last image in the current segment if its writer can
+        (see MovWriter.repeat()), returns False if it has to be written
+        again instead, e.g. to start the next segment.
+        """
+        repeat = getattr(self._current, "repeat", None)
+        if (repeat is None or self._frames >= self._segment_frames or
+                not repeat()):
+            return False
+        self._frames += 1
+        return True
+
+    def write_at(self, image: Any, timestamp: float) -> None:
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+        if self._segment_timestamp is None:
+            self._segment_timestamp = timestamp
+        elif timestamp - self._segment_timestamp >= self._segment_duration:
+            self._rotate()
+            self._segment_timestamp = timestamp
+        self._current.write_at(image, timestamp)
+        self._frames += 1
+
+    def _segment_info(self) -> Dict[str, Any]:
+        if self._segment_timestamp is not None:
+            assert self._first_timestamp is not None
+            start = self._segment_timestamp - self._first_timestamp
+        else:
+            start = self._total_frames / self._fps
+        return {
+            "file": os.path.basename(
+                    segment_filename(self._filename, self._index)),
+            "frames": self._frames,
+            "start": round(start, 6),
+        }
+
+    def _rotate(self):
+        """Switch to the writer opened ahead for the next segment."""
+        assert self._next is not None
+        self._executor.submit(self._finish, self._current,
+                              self._segment_info())
+        self._current = self._next.result()
+        self._index += 1
+        self._total_frames += self._frames
+        self._frames = 0
+        self._next = self._executor.submit(
+                self._open_ahead,
+                segment_filename(self._filename, self._index + 1))
+        self._logger.info(
+                f"Writing {segment_filename(self._filename, self._index)}")
+
+    def _open_ahead(self, filename: str) -> Any:
+        """Open the writer of a segment and add it to the index."""
+        writer = self._open_writer(filename)
+        self._unfinished.append(os.path.basename(filename))
+        self._write_index(complete=False)
+        return writer
+
+    def _finish(self, writer: Any, info: Dict[str, Any]):
+        """Release the writer of a segment and add it to the index."""
+        writer.release()
+        self._unfinished.remove(info["file"])
+        self._segments.append(info)
+        self._write_index(complete=False)
+
+    def _write_index(self, complete: bool):
+        path = index_filename(self._filename)
+        try:
+            with open(path + ".tmp", "w") as index_file:
+                json.dump({"segment_duration": self._segment_duration,
+                           "complete": complete,
+                           "segments": self._segments,
+                           "unfinished": self._unfinished},
+                          index_file, indent=1)
+            os.replace(path + ".tmp", path)
+        except OSError as err:
+            self._logger.error(f"Could not write segment index: {err}")
+
+    def _discard(self, writer: Any, filename: str):
+        """Release an unused writer and remove its files."""
+        writer.release()
+        for path in glob.glob(glob.escape(filename) + "*"):
+            os.remove(path)
+        self._unfinished.remove(os.path.basename(filename))
+
+    def release(self) -> None:
+        """Finish the last segment and write the complete index."""
+        if self._current is None:
+            return
+        assert self._next is not None
+        if self._frames:
+            self._executor.submit(self._finish, self._current,
+                                  self._segment_info())
+        else:
+            self._executor.submit(
+                    self._discard, self._current,
+                    segment_filename(self._filename, self._index))
+        self._executor.submit(
+                self._discard, self._next.result(),
+                segment_filename(self._filename, self._index + 1))
+        self._executor.shutdown(wait=True)
+        self._current = None
+        self._next = None
+        self._write_index(complete=True)
+        self._logger.info(
+                f"Wrote {len(self._segments)} segments of {self._filename}")
@@ -0,0 +1,146 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import numpy as np
+import cv2
+
+from multiprocessing import shared_memory
+from typing import Optional, Tuple
+
+from pyoscvideo.video.frame import Frame
+
+
+DEFAULT_SLOTS = 4
+
+# Per slot header, `version` is odd while the slot is being written
+_SLOT_HEADER = np.dtype([("version", "<u8"), ("sequence", "<i8"),
+                         ("timestamp", "<f8")])
+_RING_HEADER_SIZE = 64
+
+
+class SharedFrameRing:
+    """
+    Ring of frame slots in shared memory, used to hand frames from a
+    camera worker process to the main process without pickling them.
+
+    The ring is created by the main process with the frame shape, which
+    can't change afterwards, and attached by the worker with the name of
+    the shared memory block. There is a single writer, the worker, which
+    publishes frames with put(). Readers copy the most recent frame out of
+    the ring with read_latest(); each slot is guarded by a version counter
+    (a seqlock), so a frame overwritten while being copied is detected and
+    the copy retried instead of returning a torn image.
+
+    The ring is meant for the preview, so its shape is usually smaller
+    than the captured frames: compressed frames are decoded at a reduced
+    scale (see Frame.decoded()) and images of another shape are resized
+    into the slot.
+    """
+
+    def __init__(self, shape: Tuple[int, int, int],
+                 slots: int = DEFAULT_SLOTS, name: Optional[str] = None):
+        """
+        Create a new ring, or attach to the existing one called `name`.
+        """
+        self.shape = shape
+        self.slots = slots
+        frame_size = int(np.prod(shape))
+        headers_size = _SLOT_HEADER.itemsize * slots
+        size = _RING_HEADER_SIZE + headers_size + frame_size * slots
+        if name is None:
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+            self._owner = True
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+            self._owner = False
+
+        buf = self._memory.buf
+        self._count: np.ndarray = np.ndarray((1,), dtype="<u8", buffer=buf)
+        self._headers: np.ndarray = np.ndarray(
+                (slots,), dtype=_SLOT_HEADER, buffer=buf,
+                offset=_RING_HEADER_SIZE)
+        self._frames: np.ndarray = np.ndarray(
+                (slots,) + tuple(shape), dtype=np.uint8, buffer=buf,
+                offset=_RING_HEADER_SIZE + headers_size)
+        if self._owner:
+            self._count[0] = 0
+            self._headers[:] = 0
+
+    @property
+    def name(self) -> str:
+        return self._memory.name
+
+    @property
+    def count(self) -> int:
+        """Get the total number of frames put in the ring."""
+        return int(self._count[0])
+
+    def put(self, frame: Frame) -> bool:
+        """
+        Copy a frame into the next slot, returns False if it can't be
+        decoded.
+        """
+        height, width = self.shape[:2]
+        image = frame.decoded((width, height))
+        if image is None:
+            return False
+        count = int(self._count[0])
+        index = count % self.slots
+        header = self._headers[index:index + 1]
+        header["version"] += 1
+        if image.shape == self.shape:
+            self._frames[index] = image
+        else:
+            cv2.resize(image, (width, height), dst=self._frames[index],
+                       interpolation=cv2.INTER_AREA)
+        header["sequence"] = frame.sequence
+        header["timestamp"] = frame.timestamp
+        header["version"] += 1
+        self._count[0] = count + 1
+        return True
+
+    def read_latest(self, image: np.ndarray, retries: int = 3
+                    ) -> Optional[Tuple[int, float, int]]:
+        """
+        Copy the most recent frame into `image`, returns the ring count,
+        timestamp and sequence of the frame, or None if there is no frame
+        or it kept being overwritten while copying.
+        """
+        for _ in range(retries):
+            count = int(self._count[0])
+            if count == 0:
+                return None
+            index = (count - 1) % self.slots
+            version = int(self._headers[index]["version"])
+            if version % 2:
+                continue
+            np.copyto(image, self._frames[index])
+            header = self._headers[index].copy()
+            if header["version"] == version:
+                return (count, float(header["timestamp"]),
+                        int(header["sequence"]))
+        return None
+
+    def close(self):
+        """Detach from the ring, removing it if we created it."""
+        # the views must go before the memory can be closed
+        del self._count, self._headers, self._frames
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
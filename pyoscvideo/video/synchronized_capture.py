@@ -0,0 +1,124 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from PyQt5.QtCore import QThread
+
+from pyoscvideo.video.camera_reader import CameraReader
+
+
+# Seconds to wait before grabbing again when no camera gave a frame
+GRAB_RETRY_INTERVAL = 0.01
+
+
+class SynchronizedCapture(QThread):
+    """
+    Thread capturing from several cameras in lockstep.
+
+    Instead of each camera free running in a ReadThread of its own, a
+    frame is grabbed from every camera at the same instant and then the
+    frames are retrieved in parallel. All the frames of a set are tagged
+    with the same `capture_index`, so frames of different cameras can be
+    matched. The skew of a set is the time between the first and the last
+    capture timestamp of its frames.
+
+    Every set is retrieved, the writers choose the frames for the slots of
+    their outputs, see FramePacer.
+
+    The readers must not be free running, see CameraReader.
+    """
+
+    stop: bool
+
+    def __init__(self, readers: List[CameraReader]):
+        super().__init__()
+        self._logger = logging.getLogger(__name__ + ".SynchronizedCapture")
+        self._readers = readers
+        self._capture_index = 0
+        self._statistics_lock = threading.Lock()
+        self._sets = 0
+        self._incomplete_sets = 0
+        self._total_skew = 0.0
+        self._max_skew = 0.0
+        self.stop = False
+
+    @property
+    def statistics(self) -> Dict[str, Any]:
+        """
+        Get the number of sets captured and of those missing the frame of
+        some camera, and the mean and maximum skew of the sets in seconds,
+        since the start or the last reset_statistics().
+        """
+        with self._statistics_lock:
+            sets = self._sets
+            return {
+                "sets": sets,
+                "sets_incomplete": self._incomplete_sets,
+                "mean_skew": self._total_skew / sets if sets else 0.0,
+                "max_skew": self._max_skew,
+            }
+
+    def reset_statistics(self) -> None:
+        """Start counting the statistics anew, e.g. for a recording."""
+        with self._statistics_lock:
+            self._sets = 0
+            self._incomplete_sets = 0
+            self._total_skew = 0.0
+            self._max_skew = 0.0
+
+    def run(self):
+        """Grab and retrieve sets of frames until stopped."""
+        self._logger.info(
+                f"Started synchronized capture of {len(self._readers)} "
+                f"cameras")
+        with ThreadPoolExecutor(max_workers=len(self._readers)) as executor:
+            while not self.stop:
+                timestamps = list(executor.map(
+                        lambda reader: reader.grab(), self._readers))
+                grabbed = [(reader, timestamp) for reader, timestamp
+                           in zip(self._readers, timestamps)
+                           if timestamp is not None]
+                if not grabbed:
+                    self._logger.debug("could not grab any frame")
+                    # e.g. not buffering, wait instead of spinning
+                    time.sleep(GRAB_RETRY_INTERVAL)
+                    continue
+
+                capture_index = self._capture_index
+                list(executor.map(
+                        lambda reader: reader.retrieve(capture_index),
+                        [reader for reader, _ in grabbed]))
+                self._capture_index += 1
+
+                capture_times = [timestamp for _, timestamp in grabbed]
+                skew = max(capture_times) - min(capture_times)
+                with self._statistics_lock:
+                    self._sets += 1
+                    if len(grabbed) < len(self._readers):
+                        self._incomplete_sets += 1
+                    self._total_skew += skew
+                    self._max_skew = max(self._max_skew, skew)
+        self._logger.info(
+                f"Finished synchronized capture: {self.statistics}")
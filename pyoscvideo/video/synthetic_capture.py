@@ -0,0 +1,145 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import logging
+import time
+import numpy as np
+import cv2
+
+from typing import Any, Optional, Tuple
+
+from cv2.cv2 import (
+    CAP_PROP_FOURCC,
+    CAP_PROP_FPS,
+    CAP_PROP_FRAME_HEIGHT,
+    CAP_PROP_FRAME_WIDTH,
+    CAP_PROP_POS_FRAMES,
+    CAP_PROP_POS_MSEC,
+    VideoCapture)
+
+
+class SyntheticCapture:
+    """
+    Capture source producing frames at a fixed rate without a camera.
+
+    Without `filename` a moving test pattern with the frame number is
+    generated, otherwise the frames of the given video file are played in
+    a loop. Frames are paced to the frame rate like a camera would deliver
+    them, which makes it possible to run the whole capture and recording
+    chain on machines without cameras.
+
+    Mimics the subset of the cv2.VideoCapture interface used by
+    CameraReader. The size and frame rate can be set for the test pattern,
+    a video file is delivered as it is.
+    """
+    timestamp: float
+    sequence: int
+
+    def __init__(self, filename: Optional[str] = None, width: int = 640,
+                 height: int = 480, fps: float = 30.0):
+        self._logger = logging.getLogger(__name__ + ".SyntheticCapture")
+        self._file: Optional[VideoCapture] = None
+        self._size = (width, height)
+        self._fps = fps
+        self._opened = True
+        if filename:
+            self._logger.info(f"Playing file: {filename}")
+            self._file = VideoCapture(filename)
+            self._opened = self._file.isOpened()
+            if self._opened:
+                self._size = (int(self._file.get(CAP_PROP_FRAME_WIDTH)),
+                              int(self._file.get(CAP_PROP_FRAME_HEIGHT)))
+                self._fps = self._file.get(CAP_PROP_FPS) or fps
+        self._next_time = 0.0
+        self.timestamp = 0.0
+        self.sequence = -1
+
+    def isOpened(self) -> bool:
+        return self._opened
+
+    def set(self, prop_id: int, value: Any) -> bool:
+        if self._file is not None:
+            return False
+        if prop_id == CAP_PROP_FRAME_WIDTH:
+            self._size = (int(value), self._size[1])
+        elif prop_id == CAP_PROP_FRAME_HEIGHT:
+            self._size = (self._size[0], int(value))
+        elif prop_id == CAP_PROP_FPS:
+            self._fps = float(value)
+        elif prop_id != CAP_PROP_FOURCC:
+            return False
+        return True
+
+    def get(self, prop_id: int) -> float:
+        if prop_id == CAP_PROP_FRAME_WIDTH:
+            return float(self._size[0])
+        if prop_id == CAP_PROP_FRAME_HEIGHT:
+            return float(self._size[1])
+        if prop_id == CAP_PROP_FPS:
+            return self._fps
+        if prop_id == CAP_PROP_POS_MSEC:
+            return self.timestamp * 1000
+        return 0.0
+
+    def grab(self) -> bool:
+        """Wait until the next frame is due."""
+        if not self._opened:
+            return False
+        now = time.monotonic()
+        if self._next_time > now:
+            time.sleep(self._next_time - now)
+            now = self._next_time
+        self._next_time = max(now, self._next_time) + 1.0 / self._fps
+        self.timestamp = now
+        self.sequence += 1
+        return True
+
+    def retrieve(self, image: Optional[np.ndarray] = None
+                 ) -> Tuple[bool, Optional[np.ndarray]]:
+        """Get the current frame, written into `image` if it fits."""
+        width, height = self._size
+        if image is None or image.shape != (height, width, 3):
+            image = np.empty((height, width, 3), dtype=np.uint8)
+
+        if self._file is not None:
+            success, frame = self._file.read(image)
+            if not success:
+                # start over at the end of the file
+                self._file.set(CAP_PROP_POS_FRAMES, 0)
+                success, frame = self._file.read(image)
+            return success, frame
+
+        image[:] = (self.sequence * 4) % 256
+        bar = (self.sequence * 8) % max(width, 1)
+        image[:, bar:bar + width // 16] = 255
+        cv2.putText(image, str(self.sequence), (10, height // 2),
+                    cv2.FONT_HERSHEY_SIMPLEX, height / 240, (0, 0, 255), 2)
+        return True, image
+
+    def read(self, image: Optional[np.ndarray] = None
+             ) -> Tuple[bool, Optional[np.ndarray]]:
+        """Grab and retrieve the next frame."""
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def release(self):
+        if self._file is not None:
+            self._file.release()
+        self._opened = False
@@ -0,0 +1,426 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import select
+import numpy as np
+import cv2
+
+from typing import Any, List, Optional, Tuple, Union
+
+from cv2.cv2 import (
+    CAP_PROP_BUFFERSIZE,
+    CAP_PROP_CONVERT_RGB,
+    CAP_PROP_FOURCC,
+    CAP_PROP_FPS,
+    CAP_PROP_FRAME_HEIGHT,
+    CAP_PROP_FRAME_WIDTH,
+    CAP_PROP_POS_MSEC)
+
+import pyoscvideo.helpers.v4l2 as v4l2
+
+
+def _copy(view: np.ndarray, image: Optional[np.ndarray]) -> np.ndarray:
+    """Copy a view into `image` if it has the same shape, or a new array."""
+    if (image is not None and image.shape == view.shape and
+            image.dtype == view.dtype):
+        np.copyto(image, view)
+        return image
+    return view.copy()
+
+
+class V4L2Device:
+    """
+    Thin wrapper around a V4L2 device node.
+
+    Implements the small protocol V4L2Capture relies on: ioctl(), mmap(),
+    wait() and close(). Any object implementing the same methods (e.g. a
+    FakeV4L2Device) can be handed to V4L2Capture instead.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR)
+
+    def ioctl(self, request: int, arg: Any) -> None:
+        """Run an ioctl, the ctypes structure `arg` is updated in place."""
+        # ioctl apparently can't handle a ctypes.Structure in type hints
+        fcntl.ioctl(self._fd, request, arg)  # type: ignore
+
+    def mmap(self, length: int, offset: int) -> mmap.mmap:
+        """Map a kernel buffer into our address space."""
+        return mmap.mmap(self._fd, length, mmap.MAP_SHARED,
+                         mmap.PROT_READ | mmap.PROT_WRITE, offset=offset)
+
+    def wait(self, timeout: float) -> bool:
+        """Wait until a buffer is ready to be dequeued."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        return bool(readable)
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class V4L2Capture:
+    """
+    Capture frames straight from a V4L2 device using memory mapped buffers.
+
+    Mimics the subset of the cv2.VideoCapture interface used by
+    CameraReader (isOpened, set, get, grab, retrieve, read and release) so
+    it can be used as a drop-in replacement for it.
+
+    Frames are handed over as numpy views over the kernel buffers, which
+    avoids the copies done by VideoCapture. A view is only valid until the
+    next call to grab()/read(), when the buffer is given back to the driver.
+    Consumers that need to hold on to it must take a copy. When
+    CAP_PROP_CONVERT_RGB is set (the default) read()/retrieve() decode the
+    buffer to BGR as VideoCapture does, but directly from the mapped memory.
+
+    The timestamp and sequence number of the last dequeued buffer are
+    available as `timestamp` (seconds, CLOCK_MONOTONIC when the driver
+    supports it) and `sequence`.
+    """
+    buffer_count: int
+    timestamp: float
+    sequence: int
+
+    def __init__(self, device: Union[str, Any], buffer_count: int = 4,
+                 timeout: float = 1.0):
+        """
+        Init the capture, `device` is either a device path or an object
+        implementing the V4L2Device protocol.
+        """
+        self._logger = logging.getLogger(__name__ + ".V4L2Capture")
+        if isinstance(device, str):
+            self._logger.info("Opening device: %s", device)
+            self._device = V4L2Device(device)
+        else:
+            self._device = device
+        self._timeout = timeout
+        self._streaming = False
+        self._buffers: List[Any] = []
+        self._views: List[np.ndarray] = []
+        self._current: Optional[v4l2.v4l2_buffer] = None
+
+        self.buffer_count = buffer_count
+        self.timestamp = 0.0
+        self.sequence = 0
+        self.timestamp_monotonic = False
+        self.convert_rgb = True
+
+        self._pix_format = v4l2.v4l2_pix_format()
+        self._fps = 0.0
+
+        self._opened = False
+        try:
+            cap = v4l2.v4l2_capability()
+            self._device.ioctl(v4l2.VIDIOC_QUERYCAP, cap)
+            if not cap.device_caps & v4l2.V4L2_CAP_STREAMING:
+                raise RuntimeError("Device does not support streaming I/O")
+            self._read_format()
+        except (OSError, RuntimeError):
+            self._device.close()
+            raise
+        self._opened = True
+        self._read_frame_rate()
+
+    @property
+    def width(self) -> int:
+        return self._pix_format.width
+
+    @property
+    def height(self) -> int:
+        return self._pix_format.height
+
+    @property
+    def pixel_format(self) -> int:
+        return self._pix_format.pixelformat
+
+    def isOpened(self) -> bool:
+        return self._opened
+
+    def _read_format(self):
+        fmt = v4l2.v4l2_format()
+        fmt.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        self._device.ioctl(v4l2.VIDIOC_G_FMT, fmt)
+        self._pix_format = fmt.fmt.pix
+
+    def set_format(self, width: Optional[int] = None,
+                   height: Optional[int] = None,
+                   pixelformat: Optional[int] = None) -> bool:
+        """
+        Set the size and pixel format with a single VIDIOC_S_FMT, values
+        not given are kept. Returns False if the driver adjusted any of
+        them.
+
+        Setting them one at a time through set() makes the driver pick a
+        format for each intermediate combination, which it might adjust
+        to something else than asked for.
+        """
+        if self._streaming:
+            self._logger.warning("Can't change the format while streaming")
+            return False
+        width = self.width if width is None else width
+        height = self.height if height is None else height
+        if pixelformat is None:
+            pixelformat = self.pixel_format
+        fmt = v4l2.v4l2_format()
+        fmt.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        fmt.fmt.pix.width = width
+        fmt.fmt.pix.height = height
+        fmt.fmt.pix.pixelformat = pixelformat
+        fmt.fmt.pix.field = v4l2.V4L2_FIELD_ANY
+        try:
+            self._device.ioctl(v4l2.VIDIOC_S_FMT, fmt)
+        except OSError as err:
+            self._logger.warning(f"Could not set format: {err}")
+            return False
+        # the driver adjusts the values to the closest supported ones
+        self._pix_format = fmt.fmt.pix
+        return (fmt.fmt.pix.width == width and
+                fmt.fmt.pix.height == height and
+                fmt.fmt.pix.pixelformat == pixelformat)
+
+    def _read_frame_rate(self):
+        parm = v4l2.v4l2_streamparm()
+        parm.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        try:
+            self._device.ioctl(v4l2.VIDIOC_G_PARM, parm)
+        except OSError:
+            return
+        timeperframe = parm.parm.capture.timeperframe
+        if timeperframe.numerator:
+            self._fps = timeperframe.denominator / timeperframe.numerator
+
+    def _set_frame_rate(self, fps: float) -> bool:
+        parm = v4l2.v4l2_streamparm()
+        parm.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        parm.parm.capture.timeperframe.numerator = 1000
+        parm.parm.capture.timeperframe.denominator = int(fps * 1000)
+        try:
+            self._device.ioctl(v4l2.VIDIOC_S_PARM, parm)
+        except OSError as err:
+            self._logger.warning(f"Could not set frame rate: {err}")
+            return False
+        # the driver returns the frame interval it actually applied
+        timeperframe = parm.parm.capture.timeperframe
+        if timeperframe.numerator:
+            self._fps = timeperframe.denominator / timeperframe.numerator
+        return True
+
+    def set(self, prop_id: int, value: Any) -> bool:
+        """
+        Set a capture property, only possible before streaming starts.
+        """
+        if self._streaming:
+            self._logger.warning("Can't change properties while streaming")
+            return False
+
+        value = int(value)
+        if prop_id == CAP_PROP_FRAME_WIDTH:
+            return self.set_format(width=value)
+        if prop_id == CAP_PROP_FRAME_HEIGHT:
+            return self.set_format(height=value)
+        if prop_id == CAP_PROP_FOURCC:
+            return self.set_format(pixelformat=value)
+        if prop_id == CAP_PROP_FPS:
+            return self._set_frame_rate(value)
+        if prop_id == CAP_PROP_BUFFERSIZE:
+            self.buffer_count = max(2, value)
+            return True
+        if prop_id == CAP_PROP_CONVERT_RGB:
+            self.convert_rgb = bool(value)
+            return True
+        return False
+
+    def get(self, prop_id: int) -> float:
+        """Get a capture property, returns 0 for unknown properties."""
+        if prop_id == CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop_id == CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop_id == CAP_PROP_FOURCC:
+            return float(self.pixel_format)
+        if prop_id == CAP_PROP_FPS:
+            return self._fps
+        if prop_id == CAP_PROP_BUFFERSIZE:
+            return float(self.buffer_count)
+        if prop_id == CAP_PROP_CONVERT_RGB:
+            return float(self.convert_rgb)
+        if prop_id == CAP_PROP_POS_MSEC:
+            return self.timestamp * 1000
+        return 0.0
+
+    def _new_buffer(self, index: int = 0) -> v4l2.v4l2_buffer:
+        buf = v4l2.v4l2_buffer()
+        buf.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = v4l2.V4L2_MEMORY_MMAP
+        buf.index = index
+        return buf
+
+    def _start_streaming(self):
+        """
+        Request and map the kernel buffers, queue them and start streaming.
+        """
+        req = v4l2.v4l2_requestbuffers()
+        req.count = self.buffer_count
+        req.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
+        req.memory = v4l2.V4L2_MEMORY_MMAP
+        self._device.ioctl(v4l2.VIDIOC_REQBUFS, req)
+        if req.count < 2:
+            raise RuntimeError("Not enough buffer memory")
+        # the driver might give us a different number of buffers
+        self.buffer_count = req.count
+        self._logger.info("Using %s mmap buffers", self.buffer_count)
+
+        for index in range(self.buffer_count):
+            buf = self._new_buffer(index)
+            self._device.ioctl(v4l2.VIDIOC_QUERYBUF, buf)
+            mapped = self._device.mmap(buf.length, buf.m.offset)
+            self._buffers.append(mapped)
+            self._views.append(np.frombuffer(mapped, dtype=np.uint8))
+            self._device.ioctl(v4l2.VIDIOC_QBUF, buf)
+
+        buf_type = v4l2.c_int(v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE)
+        self._device.ioctl(v4l2.VIDIOC_STREAMON, buf_type)
+        self._streaming = True
+
+    def _stop_streaming(self):
+        if self._streaming:
+            buf_type = v4l2.c_int(v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE)
+            try:
+                self._device.ioctl(v4l2.VIDIOC_STREAMOFF, buf_type)
+            except OSError as err:
+                self._logger.warning(f"Could not stop streaming: {err}")
+            self._streaming = False
+        self._current = None
+        # views must go before the mmaps can be closed
+        self._views = []
+        for mapped in self._buffers:
+            try:
+                mapped.close()
+            except BufferError:
+                # a consumer still holds a view, it will be unmapped once
+                # the view is garbage collected
+                pass
+        self._buffers = []
+
+    def grab(self) -> bool:
+        """
+        Dequeue the next filled buffer, giving the previous one back to the
+        driver.
+        """
+        if not self._opened:
+            return False
+        try:
+            if not self._streaming:
+                self._start_streaming()
+
+            if self._current is not None:
+                self._device.ioctl(v4l2.VIDIOC_QBUF, self._current)
+                self._current = None
+
+            if not self._device.wait(self._timeout):
+                self._logger.debug("Timed out waiting for a buffer")
+                return False
+
+            buf = self._new_buffer()
+            self._device.ioctl(v4l2.VIDIOC_DQBUF, buf)
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                self._logger.warning(f"Could not dequeue buffer: {err}")
+            return False
+
+        self._current = buf
+        self.sequence = buf.sequence
+        self.timestamp = buf.timestamp.secs + buf.timestamp.usecs / 1e6
+        self.timestamp_monotonic = (
+                buf.flags & v4l2.V4L2_BUF_FLAG_TIMESTAMP_MASK ==
+                v4l2.V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC)
+        return True
+
+    def retrieve_buffer(self) -> Optional[np.ndarray]:
+        """
+        Get the raw content of the current buffer as a view over the mapped
+        kernel memory.
+
+        Compressed formats are returned as a flat array of bytes, packed YUV
+        formats as a (height, width, 2) array.
+        """
+        if self._current is None:
+            return None
+        view = self._views[self._current.index][:self._current.bytesused]
+        if self.pixel_format in (v4l2.V4L2_PIX_FMT_YUYV,
+                                 v4l2.V4L2_PIX_FMT_UYVY):
+            fmt = self._pix_format
+            view = view.reshape(fmt.height, fmt.bytesperline)
+            view = view[:, :fmt.width * 2].reshape(fmt.height, fmt.width, 2)
+        return view
+
+    def retrieve(self, image: Optional[np.ndarray] = None
+                 ) -> Tuple[bool, Optional[np.ndarray]]:
+        """
+        Get the current frame, decoded to BGR if CAP_PROP_CONVERT_RGB is
+        set.
+
+        As with VideoCapture, packed YUV frames are converted into `image`
+        if it has the right shape. JPEG decoding always allocates a new
+        array since cv2.imdecode has no output argument.
+
+        Frames that are not converted are copied, into `image` if it has
+        the right shape, as the buffer goes back to the driver on the next
+        grab.
+        """
+        view = self.retrieve_buffer()
+        if view is None:
+            return False, None
+        if not self.convert_rgb:
+            return True, _copy(view, image)
+
+        if (image is not None and
+                image.shape != (self.height, self.width, 3)):
+            image = None
+        if self.pixel_format == v4l2.V4L2_PIX_FMT_MJPEG:
+            frame = cv2.imdecode(view, cv2.IMREAD_COLOR)
+        elif self.pixel_format == v4l2.V4L2_PIX_FMT_YUYV:
+            frame = cv2.cvtColor(view, cv2.COLOR_YUV2BGR_YUYV, dst=image)
+        elif self.pixel_format == v4l2.V4L2_PIX_FMT_UYVY:
+            frame = cv2.cvtColor(view, cv2.COLOR_YUV2BGR_UYVY, dst=image)
+        else:
+            frame = _copy(view, image)
+        return frame is not None, frame
+
+    def read(self, image: Optional[np.ndarray] = None
+             ) -> Tuple[bool, Optional[np.ndarray]]:
+        """Grab and retrieve the next frame, see retrieve()."""
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def release(self):
+        """Stop streaming, unmap the buffers and close the device."""
+        if not self._opened:
+            return
+        self._stop_streaming()
+        self._device.close()
+        self._opened = False
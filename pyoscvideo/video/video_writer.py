@@ -22,32 +22,158 @@
 import logging
 import os
 import queue
+import threading
 import time
 import numpy as np
-import cv2
 
-from typing import Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from PyQt5.QtCore import QThread
 from cv2.cv2 import VideoWriter as cvVideoWriter
 from cv2.cv2 import VideoWriter_fourcc
 
+from pyoscvideo.video.ffmpeg_writer import FFmpegWriter
+from pyoscvideo.video.frame import Frame
+from pyoscvideo.video.frame_ring import FrameRing
+from pyoscvideo.video.mov_writer import MovWriter
+from pyoscvideo.video.pacing import FramePacer
+from pyoscvideo.video.resize_pool import Resizer, ResizeJob
+from pyoscvideo.video.segmented_writer import (
+    SegmentedWriter,
+    index_filename,
+    read_index,
+    segment_filename)
+from pyoscvideo.video.write_queue import DEFAULT_MAX_BYTES, SpillingQueue
+
+
+class TimestampedWriter:
+    """
+    Writer keeping the capture time of each frame written with write_at()
+    in `<filename>.timestamps.txt`, the images being encoded by `writer`
+    (a cv2.VideoWriter or an FFmpegWriter).
+
+    The timestamps are in the "timestamp format v2" of mkvmerge, one
+    presentation time in milliseconds per frame, so the recording can be
+    remuxed with its real timing:
+
+        mkvmerge -o out.mkv --timestamps 0:<filename>.timestamps.txt <filename>
+    """
+
+    def __init__(self, writer: Union[cvVideoWriter, FFmpegWriter],
+                 filename: str):
+        self._logger = logging.getLogger(__name__ + ".TimestampedWriter")
+        self._writer = writer
+        self._first_timestamp: Optional[float] = None
+        self._timestamps_file: Optional[Any] = None
+        try:
+            self._timestamps_file = open(filename + ".timestamps.txt", "w")
+        except OSError as err:
+            self._logger.error(f"Could not open timestamps file: {err}")
+            return
+        self._timestamps_file.write("# timestamp format v2\n")
+
+    def isOpened(self) -> bool:
+        return (self._timestamps_file is not None and
+                self._writer.isOpened())
+
+    def write_at(self, image: np.ndarray, timestamp: float) -> None:
+        """Write an image captured at `timestamp` seconds."""
+        assert self._timestamps_file is not None
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+        self._writer.write(image)
+        self._timestamps_file.write(
+                f"{(timestamp - self._first_timestamp) * 1000:.3f}\n")
+
+    def release(self) -> None:
+        self._writer.release()
+        if self._timestamps_file is not None:
+            self._timestamps_file.close()
+            self._timestamps_file = None
+
+
+class _RepeatLast:
+    """
+    Queued in place of a frame to write the previous one again. Writers
+    having a repeat() method do it without encoding the image again.
+
+    Takes no room in the write queue, see SpillingQueue.
+    """
+    nbytes = 0
+
+    def __repr__(self) -> str:
+        return "REPEAT_LAST"
+
+
+REPEAT_LAST = _RepeatLast()
+
+
+# The writers of the files, see VideoWriter.prepare_writing()
+FileWriter = Union[cvVideoWriter, FFmpegWriter, MovWriter, TimestampedWriter,
+                   SegmentedWriter]
+
 
 class VideoWriter:
     """
     Video writer class for synchronous video writing to file.
 
-    Consumes frames from a queue and will keep a constant FPS, skipping
+    Consumes frames from a FrameRing and will keep a constant FPS, skipping
     or repeating frames if needed.
-    """
 
-    def __init__(self, frame_queue: queue.LifoQueue, fourcc: int,
+    prepare_writing() arms the writer: the file is opened and the writing
+    threads are started, parked until start_writing() triggers them, so
+    the recording starts without delay.
+
+    MJPG recordings are written by a MovWriter, which repeats a frame
+    without encoding or storing it again.
+
+    When `passthrough` is set, the compressed MJPEG packets of the frames
+    are stored in the file as they are instead of encoding the images.
+    This requires the frames to be captured in the recording size.
+
+    When `variable_frame_rate` is set, every frame is written once with its
+    capture time instead of keeping a constant FPS. MJPG recordings then
+    store the real duration of each frame (see MovWriter.write_at()), other
+    codecs get a file with the timestamps of the frames next to the video,
+    see TimestampedWriter.
+
+    When `segment_duration` is set, the recording is split into files of
+    that many seconds, see SegmentedWriter.
+
+    With `encoder` set to "ffmpeg", the images are encoded by an ffmpeg
+    subprocess instead of OpenCV, configured with the `ffmpeg` options
+    (codec, preset, threads, pix_fmt, options and binary, see
+    FFmpegWriter). The codec is then chosen by those options, not by the
+    fourcc.
+
+    Images are decoded and resized in a pool shared by all cameras with
+    the `resize_interpolation` ("nearest", "linear", "cubic" or "area"),
+    using `resize_workers` threads (see shared_executor()). Compressed
+    frames are decoded for `decode_size`, if set, instead of the recording
+    size (see Resizer).
+
+    At most `max_queue_bytes` of frames wait for the encoder in memory,
+    the rest go to an overflow file in `spill_dir` (the directory of the
+    recording if empty), see SpillingQueue.
+    """
+    passthrough: bool
+    variable_frame_rate: bool
+    segment_duration: float
+    encoder: str
+    ffmpeg: Dict[str, Any]
+    max_queue_bytes: int
+    spill_dir: str
+    resize_interpolation: str
+    resize_workers: int
+    decode_size: Optional[Tuple[int, int]]
+
+    def __init__(self, frame_ring: FrameRing, fourcc: str,
                  frame_rate: int, size: Tuple[int, int]):
         """Init the VideoWriter Object."""
         # pylint: disable=unused-argument
         self._logger = logging.getLogger(__name__ + '.VideoWriter')
         self._logger.info("Initializing")
-        self._queue = frame_queue
+        self._frame_ring = frame_ring
 
         # parsing option arguments
         fourcc_id = fourcc
@@ -59,8 +185,21 @@ class VideoWriter:
         self._logger.info("Stream size: %s", self._size)
         self._logger.info("Frame rate: %s", self._fps)
 
+        self.passthrough = False
+        self.variable_frame_rate = False
+        self.segment_duration = 0.0
+        self.encoder = "opencv"
+        self.ffmpeg = {}
+        self.max_queue_bytes = DEFAULT_MAX_BYTES
+        self.spill_dir = ""
+        self.resize_interpolation = "linear"
+        self.resize_workers = 0
+        self.decode_size = None
+
         # init writer thread
-        self._writer = None
+        self._writer: Optional[FileWriter] = None
+        self._filename = ""
+        self._spill_path = ""
         self._writing = False
         self._write_thread: Optional[WriteThread] = None
 
@@ -93,196 +232,557 @@ class VideoWriter:
             (bool) If preparation was successful
         """
         if not self._writing:
-            if os.path.isfile(filename):
-                self._logger.warning(f"File {filename} already exists!")
+            self._disarm()
+            if self.segment_duration > 0:
+                first_file = segment_filename(filename, 0)
+            else:
+                first_file = filename
+            if os.path.isfile(first_file):
+                self._logger.warning(f"File {first_file} already exists!")
                 return False
-            self._writer = cvVideoWriter(filename, self._fourcc, self._fps,
-                                         (self._size[0], self._size[1]))
+            self._filename = filename
+            self._spill_path = os.path.join(
+                    self.spill_dir or os.path.dirname(filename),
+                    os.path.basename(filename) + ".overflow")
+            if self.passthrough:
+                self._logger.info("Storing compressed frames as captured")
+            elif self.encoder == "ffmpeg":
+                self._logger.info("Encoding with ffmpeg")
+            if self.segment_duration > 0:
+                self._logger.info(
+                        f"Splitting into segments of "
+                        f"{self.segment_duration}s")
+                self._writer = SegmentedWriter(
+                        filename, self._open_writer, self._fps,
+                        self.segment_duration)
+            else:
+                self._writer = self._open_writer(filename)
             if self.ready:
+                self._arm()
                 return True
             return False
         else:
             self._logger.info("Already writing")
             return False
 
-    def start_writing(self) -> bool:
+    def _open_writer(self, filename: str
+                     ) -> Union[cvVideoWriter, FFmpegWriter, MovWriter,
+                                TimestampedWriter]:
+        """Create the writer of a file for the configured mode."""
+        use_ffmpeg = self.encoder == "ffmpeg"
+        mjpeg = not use_ffmpeg and self._fourcc == VideoWriter_fourcc(*"MJPG")
+        if self.passthrough or mjpeg:
+            return MovWriter(filename, self._fps, self._size)
+        writer: Union[cvVideoWriter, FFmpegWriter]
+        if use_ffmpeg:
+            writer = FFmpegWriter(filename, self._fps,
+                                  (self._size[0], self._size[1]),
+                                  **self.ffmpeg)
+        else:
+            writer = cvVideoWriter(filename, self._fourcc, self._fps,
+                                   (self._size[0], self._size[1]))
+        if self.variable_frame_rate:
+            return TimestampedWriter(writer, filename)
+        return writer
+
+    def _arm(self) -> None:
+        """Start the writing threads, waiting for start_writing()."""
+        resizer = None
+        if not self.passthrough:
+            resizer = Resizer(self._size, self.resize_interpolation,
+                              self.resize_workers,
+                              decode_size=self.decode_size)
+            resizer.warm_up()
+        write_queue = SpillingQueue(
+                self._spill_path, self.max_queue_bytes,
+                resizer.give_back if resizer is not None else None)
+        self._write_thread = WriteThread(self._frame_ring, self._writer,
+                                         write_queue, resizer,
+                                         self._fps, self._size,
+                                         self.passthrough,
+                                         self.variable_frame_rate)
+        self._write_thread.start()
+
+    def _disarm(self) -> None:
+        """Stop writing threads armed but never triggered."""
+        if self._write_thread is not None and not self._writing:
+            self._write_thread.stop()
+            self._write_thread.wait()
+            self._write_thread = None
+
+    def start_writing(self, pre_roll: Optional[Tuple[List[Frame], int]] = None,
+                      start_time: Optional[float] = None) -> bool:
         """
-        Spawns the writing thread.
+        Trigger the writing thread armed by prepare_writing().
+
+        The recording starts with the frames in `pre_roll` and continues
+        with the frames put in the ring after the position given with them,
+        see PreRollBuffer.take().
+
+        With a `start_time` (on the time.monotonic() clock) the recording
+        starts with the frame captured closest to it instead.
         """
-        if not self.ready:
+        if not self.ready or self._write_thread is None or self._writing:
             self._logger.warning("Not ready for writing")
+            if pre_roll is not None:
+                for frame in pre_roll[0]:
+                    frame.release()
             return False
 
-        self._write_thread = WriteThread(self._queue, self._writer, self._fps,
-                                         self._size)
-        self._write_thread.start()
+        self._write_thread.trigger(pre_roll, start_time)
         self._writing = True
         return True
 
-    def stop_writing(self) -> Tuple[int, float, int]:
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Get the live counters of the recording, see WriteThread.metrics,
+        and the bytes written to its files so far. Empty if not writing.
+        """
+        if not self._writing or self._write_thread is None:
+            return {}
+        return dict(self._write_thread.metrics,
+                    bytes_written=self._bytes_written())
+
+    def _bytes_written(self) -> int:
+        """Get the size of the files of the recording."""
+        paths = [self._filename]
+        if self.segment_duration > 0:
+            index = read_index(index_filename(self._filename))
+            if index is None:
+                # not written before the second segment is opened
+                paths = [segment_filename(self._filename, 0)]
+            else:
+                folder = os.path.dirname(self._filename)
+                paths = [os.path.join(folder, name) for name in
+                         [segment["file"] for segment in index["segments"]] +
+                         index["unfinished"]]
+        total = 0
+        for path in paths:
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
+
+    def request_stop(self, last_timestamp: Optional[float] = None):
+        """
+        Ask the writing thread to stop without waiting for it, so several
+        outputs can be stopped together, stop_writing() then waits for it.
+        """
+        if self._writing and self._write_thread is not None:
+            self._write_thread.stop(last_timestamp)
+
+    def stop_writing(self, last_timestamp: Optional[float] = None
+                     ) -> Dict[str, Any]:
         """
-        Stop the writing thread returning the number of frames written and
-        the total recording time in seconds.
+        Stop the writing thread returning the recording statistics: the
+        number of frames written and repeated, the total recording time in
+        seconds and the capture timestamps of the first and last frames.
+
+        With `last_timestamp` the recording ends with the frames captured
+        up to that time, see WriteThread.stop().
         """
         if not self._writing:
             self._logger.warning("Not writing, nothing to stop")
-            return 0, 0.0, 0
+            return {"frames": 0, "time": 0.0, "frames_repeated": 0}
 
         assert self._write_thread is not None
 
         self._logger.info('Stop writing')
         self._writing = False
-        self._write_thread.stop()
+        self._write_thread.stop(last_timestamp)
         self._write_thread.quit()
         self._write_thread.wait()
-        return (self._write_thread.frames_written,
-                self._write_thread.recording_time,
-                self._write_thread.frames_repeated)
+        return self._write_thread.statistics
 
     def release(self):
         if self._writing:
             self.stop_writing()
+        else:
+            self._disarm()
 
 
 class WriteThread(QThread):
     """Thread for consuming captured frames.
 
-    This will consume captured frames in variable FPS from a queue and produce
-    another queue keeping the frames in the specified frame rate.
+    This will consume captured frames in variable FPS from a FrameRing and
+    produce a queue keeping the frames in the specified frame rate.
 
     Will skip frames when capturing frame rate is too fast and repeat last
     frame when capturing frame rate is too slow.
+
+    In passthrough mode the compressed packets are forwarded instead of the
+    resized images, repeating and skipping works the same way.
+
+    Each slot of the output gets the frame captured closest to it, see
+    FramePacer. The output starts with the `pre_roll` frames, if any.
+
+    With `variable_frame_rate` there is no pacing: every frame is queued
+    once along with its capture time.
+
+    The images are resized by `resizer` (None in passthrough mode), then
+    encoded and written from `write_queue` by a QueuedWriterThread.
+
+    Once started, the thread waits for trigger() before taking frames
+    from the ring. The time from the trigger until the first frame was
+    available is reported as the `start_latency`.
+
+    When triggered for a `start_time`, the output starts with the frame
+    captured closest to that time, the difference is reported as the
+    `start_error`.
     """
 
     frames_written: int
     frames_repeated: int
-    recording_time: int
-
-    def __init__(self, frame_queue: queue.LifoQueue,
-                 cv_video_writer: cvVideoWriter, fps: int,
-                 size: Tuple[int, int]):
+    frames_skipped: int
+    frames_dropped: int
+    recording_time: float
+    first_timestamp: Optional[float]
+    last_timestamp: Optional[float]
+    trigger_time: Optional[float]
+    start_latency: Optional[float]
+    start_time: Optional[float]
+    start_error: Optional[float]
+
+    def __init__(self, frame_ring: FrameRing,
+                 cv_video_writer: FileWriter, write_queue: SpillingQueue,
+                 resizer: Optional[Resizer],
+                 fps: int, size: Tuple[int, int], passthrough: bool = False,
+                 variable_frame_rate: bool = False):
         """Init the WriteThread Object."""
         super().__init__()
-        self._queue = frame_queue
-        self._towrite_queue: queue.Queue = queue.Queue()
+        self._frame_ring = frame_ring
+        self._pre_roll: List[Frame] = []
+        # replaced when triggered
+        self._cursor = frame_ring.cursor()
+        self._triggered = threading.Event()
+        self._towrite_queue = write_queue
+        self._resizer = resizer
         self._filesystem_writer_thread = QueuedWriterThread(
-                self._towrite_queue, cv_video_writer)
+                self._towrite_queue, cv_video_writer, resizer)
 
         self._stop = False
+        self._stop_timestamp: Optional[float] = None
         self._size = size
-        self._frame_duration = 1. / fps
+        self._passthrough = passthrough
+        self._variable_frame_rate = variable_frame_rate
+        self._pacer = FramePacer(fps)
         self._logger = logging.getLogger(__name__ + ".WriteThread")
 
         self.frames_written = 0
         self.frames_repeated = 0
-        self.recording_time = 0
+        self.frames_skipped = 0
+        self.frames_dropped = 0
+        self.recording_time = 0.0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.trigger_time = None
+        self.start_latency = None
+        self.start_time = None
+        self.start_error = None
+        self._first_sequence = 0
+        self._first_position = 0
+        self._frames_received = 0
+        self._last_written_frame: Optional[Frame] = None
+        self._last_output: Optional[Any] = None
+
+    def trigger(self, pre_roll: Optional[Tuple[List[Frame], int]] = None,
+                start_time: Optional[float] = None):
+        """
+        Start writing, from the `pre_roll` frames if given (see
+        VideoWriter.start_writing()), from the frame closest to
+        `start_time` if given, else from the most recent frame.
+        """
+        self.trigger_time = time.monotonic()
+        self.start_time = start_time
+        if pre_roll is not None and pre_roll[0]:
+            self._pre_roll, position = pre_roll
+            self._cursor = self._frame_ring.cursor(position=position)
+        else:
+            self._cursor = self._frame_ring.cursor(include_latest=True)
+        self._triggered.set()
 
-    def stop(self):
-        self._filesystem_writer_thread.stop = True
+    def stop(self, last_timestamp: Optional[float] = None):
+        """
+        Stop writing, once the frames captured up to `last_timestamp` are
+        written if given, so outputs of the same frames stopped at the same
+        time end with the same frame.
+        """
+        self._stop_timestamp = last_timestamp
         self._stop = True
+        self._triggered.set()
 
-    def _write_frame(self, frame: np.array):
-        frame_resized = cv2.resize(frame, self._size)
-        self._towrite_queue.put(frame_resized)
-        self._last_written_frame = frame
-        self.frames_written += 1
+    @property
+    def statistics(self) -> Dict[str, Any]:
+        """Get the statistics of the recording."""
+        return {
+            "frames": self.frames_written,
+            "time": self.recording_time,
+            "frames_repeated": self.frames_repeated,
+            "frames_skipped": self.frames_skipped,
+            "frames_dropped": self.frames_dropped,
+            "first_timestamp": self.first_timestamp,
+            "last_timestamp": self.last_timestamp,
+            "trigger_time": self.trigger_time,
+            "start_latency": self.start_latency,
+            "start_time": self.start_time,
+            "start_error": self.start_error,
+            **self._towrite_queue.statistics,
+        }
 
-    def run(self):
+    @property
+    def metrics(self) -> Dict[str, Any]:
         """
-        Thread worker for writing frames to queue at quasi constant frame rate.
+        Get the live counters of the recording: the frames queued for the
+        encoder and written by it, the frames skipped and repeated so far
+        and the frames waiting, in total and in the overflow file.
         """
-        self._logger.info("Started writing")
-        first_frame_time = 0
-        last_frame_time = 0
-        frames_repeated = 0
+        waiting, spilled = self._towrite_queue.depth
+        return {
+            "frames_queued": self.frames_written,
+            "frames_encoded": self._filesystem_writer_thread.frames_written,
+            "frames_skipped": (self._cursor.frames_skipped +
+                               self._pacer.frames_skipped),
+            "frames_repeated": self._pacer.frames_repeated,
+            "queue_depth": waiting,
+            "spill_depth": spilled,
+        }
+
+    def _receive_frames(self, timeout: float) -> List[Frame]:
+        """
+        Get the frames captured since the last call, see FrameSource.
 
-        while first_frame_time == 0 and not self._stop:
-            try:
-                frame = self._queue.get_nowait()
-            except queue.Empty:
-                continue
-            else:
-                first_frame_time = time.time()
-                self._write_frame(frame)
-                self._filesystem_writer_thread.start()
-
-        while not self._stop:
-            calculated_time = (first_frame_time +
-                               self.frames_written * self._frame_duration)
-            time_difference = calculated_time - time.time()
-            if time_difference > 0:
-                # if we are ahead of time we should wait
-                self._logger.debug(f"Sleeping for {time_difference} seconds")
-                time.sleep(time_difference)
-            elif time_difference < -self._frame_duration:
-                # if we are too late, we should repeat the last frame.
-                # this helps when the camera FPS is too slow to keep up with
-                # our recording FPS...
-                self._logger.debug(f'We are too late, repeat frame')
-                frames_repeated += 1
-                self._write_frame(self._last_written_frame)
-            else:
-                # get most recent frame and write it to the file stream
-                try:
-                    frame = self._queue.get(block=True,
-                                            timeout=abs(time_difference))
-                except queue.Empty:
-                    self._logger.debug(f'Queue empty, no frames available')
+        Compares the sequence numbers of the frames taken from the ring
+        with their positions in it, to find out how many frames were lost
+        before reaching us.
+        """
+        frames = self._cursor.get_new(timeout)
+        if not frames:
+            return frames
+        if self._frames_received == 0:
+            self._first_sequence = frames[-1].sequence
+            self._first_position = self._cursor.position
+        self._frames_received += len(frames)
+        self.frames_dropped = (
+                (frames[-1].sequence - self._first_sequence) -
+                (self._cursor.position - self._first_position))
+        return frames
+
+    def _write_frame(self, frame: Frame):
+        """
+        Queue a frame for writing. Both the packet and the resized image
+        are independent of the frame buffer, we only keep a reference to
+        the last frame written to be able to repeat it.
+
+        Images are queued as ResizeJobs, decoded and resized in the pool
+        while we go on pacing, see QueuedWriterThread for frames that
+        can't be decoded.
+
+        Repeating the last frame written queues REPEAT_LAST, the image
+        is not decoded and resized again.
+        """
+        if frame is self._last_written_frame and self._last_output is not None:
+            self._towrite_queue.put(REPEAT_LAST)
+            self.frames_written += 1
+            return
+        if self._passthrough:
+            self._last_output = frame.packet
+        else:
+            assert self._resizer is not None
+            self._last_output = self._resizer.submit(frame)
+        if self._last_output is None:
+            # nothing to fall back to yet
+            frame.release()
+            return
+        self._towrite_queue.put(
+                self._last_output,
+                frame.timestamp if self._variable_frame_rate else None)
+        if frame is not self._last_written_frame:
+            if self._last_written_frame is not None:
+                self._last_written_frame.release()
+            self._last_written_frame = frame
+        self.frames_written += 1
+
+    def _frames_at(self, start_time: float, frames: List[Frame]
+                   ) -> List[Frame]:
+        """
+        Wait for the frames around `start_time`, get the one captured
+        closest to it followed by any later ones. The pre-roll `frames`
+        come first, so a start time that already passed can be met too.
+        """
+        before: Optional[Frame] = None
+        after: List[Frame] = []
+        while True:
+            for frame in frames:
+                if after or frame.timestamp > start_time:
+                    after.append(frame)
+                else:
+                    if before is not None:
+                        before.release()
+                    before = frame
+            if after or self._stop:
+                break
+            frames = self._receive_frames(0.1)
+        if before is not None and (
+                not after or start_time - before.timestamp <=
+                after[0].timestamp - start_time):
+            frames = [before] + after
+        else:
+            if before is not None:
+                before.release()
+            frames = after
+        if frames:
+            self.start_error = frames[0].timestamp - start_time
+        return frames
+
+    def _write_all(self, frames: List[Frame]):
+        """Queue every frame received until stopped."""
+        self.first_timestamp = frames[0].timestamp
+        while True:
+            for frame in frames:
+                if (self._stop_timestamp is not None and
+                        frame.timestamp > self._stop_timestamp):
+                    frame.release()
                     continue
+                self.last_timestamp = frame.timestamp
+                self._write_frame(frame)
+            if self._stop and (
+                    self._stop_timestamp is None or not frames or
+                    frames[-1].timestamp >= self._stop_timestamp):
+                break
+            frames = self._receive_frames(0.1)
 
+    def _write_paced(self, frames: List[Frame], backlog: bool = False):
+        """
+        Queue a frame for each slot until stopped, see FramePacer. With
+        `backlog` the output starts with the oldest of `frames`.
+        """
+        frame = self._pacer.start(frames, backlog)
+        self.first_timestamp = self.last_timestamp = frame.timestamp
+        self._write_frame(frame.retain())
+        while not self._stop or (
+                self._stop_timestamp is not None and
+                not self._pacer.next_slot_after(self._stop_timestamp)):
+            frame = self._pacer.next_frame(self._receive_frames)
+            if frame is self._last_written_frame:
+                self._logger.debug("No new frame for this slot, repeat")
                 self._write_frame(frame)
-                last_frame_time = time.time()
+            else:
+                self._write_frame(frame.retain())
+                self.last_timestamp = frame.timestamp
 
-            # afterwards discard remaining frames
-            skipped_frames = 0
-            while not self._queue.empty():
-                self._queue.get_nowait()
-                self._logger.debug("skipping frame")
-                skipped_frames += 1
+    def run(self):
+        """
+        Thread worker for writing frames to queue at constant frame rate,
+        or as captured with a variable frame rate.
+        """
+        self._filesystem_writer_thread.start()
+        self._triggered.wait()
+        self._logger.info("Started writing")
 
-            if skipped_frames > 0:
-                # Frames are skipped when camera capturing FPS is greater
-                # than our recording FPS.
-                self._logger.debug("skipped %s frames", skipped_frames)
+        frames = self._pre_roll
+        self._pre_roll = []
+        backlog = bool(frames)
+        if self.start_time is not None:
+            frames = self._frames_at(self.start_time, frames)
+            backlog = True
+        while not frames and not self._stop:
+            frames = self._receive_frames(0.1)
+        if frames:
+            assert self.trigger_time is not None
+            self.start_latency = time.monotonic() - max(
+                    self.trigger_time, self.start_time or 0.0)
+            if self._variable_frame_rate:
+                self._write_all(frames)
+            else:
+                self._write_paced(frames, backlog)
 
         self._logger.info("Finished writing")
-        self.recording_time = last_frame_time - first_frame_time
-        self.frames_repeated = frames_repeated
+        self.frames_skipped = (self._cursor.frames_skipped +
+                               self._pacer.frames_skipped)
+        self.frames_repeated = self._pacer.frames_repeated
+        if self.first_timestamp is not None:
+            self.recording_time = self.last_timestamp - self.first_timestamp
+        self._pacer.clear()
+        if self._last_written_frame is not None:
+            self._last_written_frame.release()
+            self._last_written_frame = None
+        # only now, no more frames will be queued
+        self._filesystem_writer_thread.stop = True
         self._filesystem_writer_thread.wait()
+        self._towrite_queue.close()
 
 
 class QueuedWriterThread(QThread):
     """
     Thread for filesystem writing
 
-    Consumes a queue of frames and write to the filesystem.
+    Consumes a queue of frames and write to the filesystem. Frames queued
+    with a capture time are written with write_at(), REPEAT_LAST with the
+    repeat() of the writer if it has one.
+
+    Waits for the ResizeJobs in the queue, handing the images back to
+    `resizer` once written. A frame that can't be decoded is replaced by
+    the previous one, or left out with a variable frame rate, where the
+    previous one then lasts longer.
     """
 
     stop: bool
+    frames_written: int
 
-    def __init__(self, frame_queue: queue.Queue,
-                 cv_video_writer: cvVideoWriter):
+    def __init__(self, frame_queue: SpillingQueue,
+                 cv_video_writer: FileWriter,
+                 resizer: Optional[Resizer] = None):
         """Init the WriteThread Object."""
         super().__init__()
         self._queue = frame_queue
         self._cv_video_writer = cv_video_writer
+        self._resizer = resizer
         self._logger = logging.getLogger(__name__ + ".QueueCvWriteThread")
         self.stop = False
+        self.frames_written = 0
 
     def run(self):
         self._logger.info("Starting filesystem writer")
-        frames_written = 0
+        last_frame = None
         while not self.stop or not self._queue.empty():
             try:
-                frame = self._queue.get(True, 0.1)
+                frame, timestamp = self._queue.get(0.1)
             except queue.Empty:
-                break
+                continue
             if self.stop:
                 self._logger.info("Waiting for filesystem writer to finish...")
-            self._cv_video_writer.write(frame)
-            frames_written += 1
+            if isinstance(frame, ResizeJob):
+                frame = frame.result()
+            if frame is None:
+                self._logger.warning("Could not decode frame")
+                if timestamp is not None:
+                    continue
+                frame = REPEAT_LAST
+            if frame is REPEAT_LAST:
+                repeat = getattr(self._cv_video_writer, "repeat", None)
+                if repeat is not None and repeat():
+                    self.frames_written += 1
+                    continue
+                frame = last_frame
+                if frame is None:
+                    # nothing to fall back to yet
+                    continue
+            if timestamp is None:
+                self._cv_video_writer.write(frame)
+            else:
+                self._cv_video_writer.write_at(frame, timestamp)
+            self.frames_written += 1
+            if (self._resizer is not None and last_frame is not None and
+                    last_frame is not frame):
+                self._resizer.give_back(last_frame)
+            last_frame = frame
+        if self._resizer is not None and last_frame is not None:
+            self._resizer.give_back(last_frame)
 
         self._logger.info("Releasing cv.VideoWriter")
         self._cv_video_writer.release()
         self._logger.info(
-            f"Filesystem writer finished, frames written: {frames_written}")
+            f"Filesystem writer finished, frames written: "
+            f"{self.frames_written}")
@@ -0,0 +1,256 @@
+# *****************************************************************************
+#  Copyright (c) 2020. Pascal Staudt, Bruno Gola                              *
+#                                                                             *
+#  This file is part of pyOscVideo.                                           *
+#                                                                             *
+#  pyOscVideo is free software: you can redistribute it and/or modify         *
+#  it under the terms of the GNU General Public License as published by       *
+#  the Free Software Foundation, either version 3 of the License, or          *
+#  (at your option) any later version.                                        *
+#                                                                             *
+#  pyOscVideo is distributed in the hope that it will be useful,              *
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of             *
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the              *
+#  GNU General Public License for more details.                               *
+#                                                                             *
+#  You should have received a copy of the GNU General Public License          *
+#  along with pyOscVideo.  If not, see <https://www.gnu.org/licenses/>.       *
+# *****************************************************************************
+
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+from typing import Any, Callable, Deque, Dict, NamedTuple, Optional, Tuple
+
+
+# Default byte budget of the frames kept in memory
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class _Spilled(NamedTuple):
+    """Location of a frame in the overflow file."""
+    offset: int
+    size: int
+    shape: Optional[Tuple[int, ...]]
+    dtype: Optional[str]
+
+
+class SpillingQueue:
+    """
+    FIFO of the frames waiting to be written to the file, holding at most
+    `max_bytes` of them in memory.
+
+    When the encoder falls behind and the budget is used up, further frames
+    are appended to the overflow file `spill_path` and read back from there
+    when their turn comes, keeping the order. The file is read and written
+    without holding the lock, its space is reused once all spilled frames
+    were taken and it is removed on close(). If it can't be written, put()
+    blocks until there is room in memory instead, slowing the producer
+    down.
+
+    Items are images (numpy arrays), compressed packets (bytes) or images
+    still being prepared (objects with `nbytes` and a result() method
+    giving the image or None, see ResizeJob), queued with their capture
+    time or None. Those are waited for when they have to be spilled, and
+    their images handed to `recycle`, if given, once in the file. Like
+    queue.Queue.get(), get() raises queue.Empty after waiting `timeout`
+    seconds for an item.
+    """
+
+    def __init__(self, spill_path: str, max_bytes: int = DEFAULT_MAX_BYTES,
+                 recycle: Optional[Callable[[np.ndarray], None]] = None):
+        self._logger = logging.getLogger(__name__ + ".SpillingQueue")
+        self._spill_path = spill_path
+        self._max_bytes = max_bytes
+        self._recycle = recycle
+        self._items: Deque[Tuple[Any, Optional[float]]] = collections.deque()
+        self._condition = threading.Condition()
+        self._memory_bytes = 0
+        self._spill_fd: Optional[int] = None
+        self._spill_end = 0
+        self._spilled_pending = 0
+        self._spill_failed = False
+
+        self.max_depth = 0
+        self.max_spill_depth = 0
+        self.frames_spilled = 0
+        self.bytes_spilled = 0
+        self.blocked_time = 0.0
+
+    @property
+    def statistics(self) -> Dict[str, Any]:
+        """
+        Get the largest number of frames waiting at once, in total and in
+        the overflow file, the number of frames and bytes spilled and the
+        seconds put() blocked.
+        """
+        return {
+            "queue_max_depth": self.max_depth,
+            "spill_max_depth": self.max_spill_depth,
+            "frames_spilled": self.frames_spilled,
+            "bytes_spilled": self.bytes_spilled,
+            "queue_blocked_time": self.blocked_time,
+        }
+
+    @property
+    def depth(self) -> Tuple[int, int]:
+        """
+        Get the number of frames waiting, in total and in the overflow
+        file.
+        """
+        with self._condition:
+            return len(self._items), self._spilled_pending
+
+    def empty(self) -> bool:
+        with self._condition:
+            return not self._items
+
+    def put(self, item: Any, timestamp: Optional[float] = None) -> None:
+        size = _item_bytes(item)
+        with self._condition:
+            spill = self._over_budget(size) and not self._spill_failed
+        recycle = None
+        if spill and hasattr(item, "result"):
+            # wait for the job without holding the lock, the consumer
+            # keeps taking frames meanwhile
+            item = item.result()
+            recycle = self._recycle
+            if item is None:
+                # nothing to spill
+                spill = False
+                size = 0
+        if spill:
+            with self._condition:
+                offset = self._reserve(size)
+            # the file is written without holding the lock as well
+            spilled = self._spill(item, size, offset)
+            with self._condition:
+                if spilled is not None:
+                    self.frames_spilled += 1
+                    self.bytes_spilled += size
+                    self._append(spilled, timestamp)
+                    self.max_spill_depth = max(self.max_spill_depth,
+                                               self._spilled_pending)
+                else:
+                    self._release_spilled()
+            if spilled is not None:
+                if recycle is not None:
+                    recycle(item)
+                return
+        with self._condition:
+            if self._over_budget(size):
+                start = time.monotonic()
+                while self._over_budget(size):
+                    self._condition.wait()
+                self.blocked_time += time.monotonic() - start
+            self._memory_bytes += size
+            self._append(item, timestamp)
+
+    def _over_budget(self, size: int) -> bool:
+        return bool(size and self._memory_bytes + size > self._max_bytes and
+                    self._items)
+
+    def _append(self, item: Any, timestamp: Optional[float]) -> None:
+        self._items.append((item, timestamp))
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._condition.notify_all()
+
+    def get(self, timeout: Optional[float] = None
+            ) -> Tuple[Any, Optional[float]]:
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._items, timeout):
+                raise queue.Empty
+            item, timestamp = self._items.popleft()
+            if not isinstance(item, _Spilled):
+                self._memory_bytes -= _item_bytes(item)
+                self._condition.notify_all()
+                return item, timestamp
+        try:
+            return self._unspill(item), timestamp
+        finally:
+            with self._condition:
+                self._release_spilled()
+
+    def _reserve(self, size: int) -> int:
+        """
+        Reserve the space for an item at the end of the overflow file,
+        returns its offset. Until released, the space is counted as a
+        spilled frame, so it is not reused before the item is read back.
+        """
+        offset = self._spill_end
+        self._spill_end += size
+        self._spilled_pending += 1
+        return offset
+
+    def _release_spilled(self) -> None:
+        """Release the space of a spilled frame."""
+        self._spilled_pending -= 1
+        if self._spilled_pending == 0:
+            # caught up, reuse the space of the file
+            self._spill_end = 0
+
+    def _spill(self, item: Any, size: int, offset: int) -> Optional[_Spilled]:
+        """
+        Write an item to the overflow file at `offset`, None if not
+        possible.
+        """
+        try:
+            if self._spill_fd is None:
+                self._spill_fd = os.open(
+                        self._spill_path,
+                        os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+                self._logger.warning(
+                        f"Writer falling behind, spilling frames to "
+                        f"{self._spill_path}")
+            if isinstance(item, np.ndarray):
+                data = np.ascontiguousarray(item).data
+            else:
+                data = item
+            written = os.pwrite(self._spill_fd, data, offset)
+            if written != size:
+                raise OSError(f"short write ({written} of {size} bytes)")
+        except OSError as err:
+            self._logger.error(
+                    f"Could not spill frames, blocking instead: {err}")
+            self._spill_failed = True
+            return None
+        return _Spilled(offset, size, getattr(item, "shape", None),
+                        item.dtype.str if isinstance(item, np.ndarray)
+                        else None)
+
+    def _unspill(self, spilled: _Spilled) -> Any:
+        """Read an item back from the overflow file."""
+        assert self._spill_fd is not None
+        data = os.pread(self._spill_fd, spilled.size, spilled.offset)
+        if spilled.shape is None:
+            return data
+        return np.frombuffer(data, dtype=spilled.dtype).reshape(spilled.shape)
+
+    def close(self) -> None:
+        """Remove the overflow file, queued frames are discarded."""
+        with self._condition:
+            self._items.clear()
+            self._memory_bytes = 0
+            self._spilled_pending = 0
+            if self._spill_fd is not None:
+                os.close(self._spill_fd)
+                self._spill_fd = None
+                try:
+                    os.remove(self._spill_path)
+                except OSError as err:
+                    self._logger.warning(
+                            f"Could not remove {self._spill_path}: {err}")
+            self._condition.notify_all()
+
+
+def _item_bytes(item: Any) -> int:
+    if item is None:
+        return 0
+    if hasattr(item, "nbytes"):
+        return item.nbytes
+    return len(item)
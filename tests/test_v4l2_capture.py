@@ -0,0 +1,66 @@
+"""
+Checks of V4L2Capture against a FakeV4L2Device: setting the format,
+mapping the buffers and cycling them through VIDIOC_DQBUF and VIDIOC_QBUF
+for MJPEG and YUYV frames.
+"""
+
+import numpy as np
+import pytest
+
+from cv2 import CAP_PROP_CONVERT_RGB
+
+import pyoscvideo.helpers.v4l2 as v4l2
+
+from pyoscvideo.video.fake_v4l2 import FakeV4L2Device
+from pyoscvideo.video.v4l2_capture import V4L2Capture
+
+
+FRAMES = 10
+
+
+@pytest.mark.parametrize("pixelformat", [v4l2.V4L2_PIX_FMT_MJPEG,
+                                         v4l2.V4L2_PIX_FMT_YUYV])
+def test_capture(pixelformat):
+    device = FakeV4L2Device()
+    capture = V4L2Capture(device, buffer_count=4)
+    assert capture.set_format(320, 240, pixelformat)
+    # the format is set with a single VIDIOC_S_FMT
+    assert device.requests.count(v4l2.VIDIOC_S_FMT) == 1
+
+    for number in range(FRAMES):
+        assert capture.grab()
+        assert capture.sequence == number
+        assert capture.timestamp_monotonic
+        # the buffer being read is held by us, all others by the driver
+        assert len(device.queued) == capture.buffer_count - 1
+        success, image = capture.retrieve()
+        assert success and image is not None
+        assert image.shape == (240, 320, 3)
+        if pixelformat == v4l2.V4L2_PIX_FMT_MJPEG:
+            assert abs(int(image[0, 0, 0]) - number % 256) <= 2
+    assert device.requests.count(v4l2.VIDIOC_DQBUF) == FRAMES
+    assert (device.requests.count(v4l2.VIDIOC_QBUF) ==
+            capture.buffer_count + FRAMES - 1)
+
+    capture.release()
+    assert not device.streaming and device.closed
+
+
+def test_unconverted_frames_are_copied():
+    device = FakeV4L2Device()
+    capture = V4L2Capture(device, buffer_count=2)
+    assert capture.set_format(320, 240, v4l2.V4L2_PIX_FMT_YUYV)
+    capture.set(CAP_PROP_CONVERT_RGB, 0)
+
+    buffer = np.empty((240, 320, 2), np.uint8)
+    assert capture.grab()
+    success, image = capture.retrieve(buffer)
+    assert success and image is buffer
+    success, other = capture.retrieve()
+    assert success and other.flags.owndata
+
+    # the driver fills the buffers again, the frames keep their content
+    for _ in range(capture.buffer_count * 2):
+        assert capture.grab()
+    assert (image == 0).all() and (other == 0).all()
+    capture.release()